@@ -0,0 +1,72 @@
+"""Module for Sharing Decoded Geometry Between Entities"""
+
+import moderngl_window as mglw
+
+
+class PatchResources(object):
+    """A decoded patch living on the GPU, shared by every entity that uses the geometry
+
+    Attributes:
+        mesh (mglw.scene.Mesh): template mesh with the shared VAO and attribute info, entities copy it
+        bounding_sphere (tuple): local (center, radius) around the vertices
+        bvh (TriangleBVH): triangle BVH for CPU picking, None for points and lines
+        lods (list): simplified LevelOfDetails, coarser ones later, see lod.py
+        references (int): number of entities using these resources
+    """
+
+    def __init__(self, mesh, bounding_sphere, bvh, lods=()):
+        self.mesh = mesh
+        self.bounding_sphere = bounding_sphere
+        self.bvh = bvh
+        self.lods = list(lods)
+        self.references = 0
+
+    def instanced_vao(self, level=None):
+        """Get a new VAO over the shared buffers that an entity can add its own instance buffer to
+
+        Given a LevelOfDetail, the VAO draws its simplified triangles instead of the patch's.
+        """
+        shared = self.mesh.vao
+        vao = mglw.opengl.vao.VAO(name=f"{shared.name} Instanced", mode=shared.mode)
+        for buffer_info in shared._buffers:
+            buffer_format = " ".join(attr_format.format for attr_format in buffer_info.attrib_formats)
+            vao.buffer(buffer_info.buffer, buffer_format, list(buffer_info.attributes))
+        if level is not None:
+            vao.index_buffer(level.index_buffer, 4)
+        elif shared._index_buffer:
+            vao.index_buffer(shared._index_buffer, shared._index_element_size)
+        return vao
+
+
+class GeometryCache(object):
+    """Reference counted cache of decoded patches keyed by (GeometryID, patch index)
+
+    The first entity to render a patch decodes and uploads it, later entities just take a reference
+    and create their own lightweight mesh. The cache lets go of a patch when the last entity using it
+    is removed, and the window's context garbage collection frees the buffers once nothing else
+    holds them. Releasing them directly doesn't mix with the context_gc mode.
+
+    Attributes:
+        patches (dict): (GeometryID, patch index) -> PatchResources
+    """
+
+    def __init__(self):
+        self.patches = {}
+
+    def acquire(self, key, build):
+        """Get the resources for a patch, calling build to create them if they aren't cached"""
+        resources = self.patches.get(key)
+        if resources is None:
+            resources = build()
+            self.patches[key] = resources
+        resources.references += 1
+        return resources
+
+    def release(self, key):
+        """Drop a reference to a patch, forgetting it once no entity is using it"""
+        resources = self.patches.get(key)
+        if resources is None:
+            return
+        resources.references -= 1
+        if resources.references <= 0:
+            del self.patches[key]
@@ -0,0 +1,301 @@
+"""Module for Frustum Culling the Scene
+
+Every mesh has a bounding sphere in its own local space. Whenever the transform store changes, the
+spheres are moved into world space with its global matrices and boxes around them are merged up the
+hierarchy a level at a time, so each node's box holds everything below it. Each frame the boxes are
+tested walking down the levels, only looking at nodes whose parent straddles the edge of the view, so
+a subtree that's entirely in or out costs one test. A camera moving through a still scene never has
+to touch the matrices.
+
+Big instanced meshes are also culled instance by instance on the GPU, see InstanceCuller, and meshes
+hidden behind others can be skipped with occlusion queries, see OcclusionCuller.
+"""
+
+import numpy as np
+import moderngl
+
+# Radius for meshes without a bounding sphere, like widgets, so they're never culled
+UNBOUNDED = 1e30
+
+# Instanced meshes with at least this many instances get culled per instance
+GPU_CULL_INSTANCES = 4096
+
+# Bytes per instance, 16 floats of position, color, rotation, and scale
+INSTANCE_BYTES = 64
+
+# Largest float32, stands in for an infinite distance in shaders
+FLOAT_MAX = float(np.finfo(np.float32).max)
+
+# Box around a unit sphere, drawn in place of a mesh to check whether it's hidden
+PROXY_CORNERS = np.array([(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], np.float32)
+PROXY_TRIANGLES = np.array([
+    0, 1, 3, 0, 3, 2,  4, 5, 7, 4, 7, 6,  # -x, +x
+    0, 1, 5, 0, 5, 4,  2, 3, 7, 2, 7, 6,  # -y, +y
+    0, 2, 6, 0, 6, 4,  1, 3, 7, 1, 7, 5,  # -z, +z
+], np.uint32)
+
+# How many frames of camera movement proxies are grown by, covers the view shifting before results are used
+OCCLUSION_MARGIN = 2.0
+
+
+def frustum_planes(projection_matrix, camera_matrix):
+    """Left, right, bottom, top, near, and far planes as (a, b, c, d) rows, inside is a*x + b*y + c*z + d >= 0
+
+    Matrices are row vector like the rest of the scene, so the planes come from the columns of the
+    combined view projection matrix.
+    """
+    matrix = np.asarray(camera_matrix, np.float64) @ np.asarray(projection_matrix, np.float64)
+    w = matrix[:, 3]
+    planes = np.array([w + matrix[:, 0], w - matrix[:, 0], w + matrix[:, 1], w - matrix[:, 1],
+                       w + matrix[:, 2], w - matrix[:, 2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def spheres_visible(planes, centers, radii):
+    """Whether each sphere is at least partly inside every plane"""
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    return (distances >= -radii[:, None]).all(axis=1)
+
+
+def classify_boxes(planes, box_min, box_max):
+    """Whether each box is at least partly inside every plane, and whether it's entirely inside them
+
+    A box is outside a plane when even its corner farthest along the plane's normal is behind it,
+    which is the center's distance plus the half extents projected onto the normal. Empty boxes are
+    neither.
+    """
+    with np.errstate(invalid="ignore"):  # Empty boxes are inf, which turns into nan
+        centers = (box_min + box_max) * 0.5
+        extents = (box_max - box_min) * 0.5
+        distances = centers @ planes[:, :3].T + planes[:, 3]
+        reach = extents @ np.abs(planes[:, :3]).T
+        return (distances + reach >= 0).all(axis=1), (distances - reach >= 0).all(axis=1)
+
+
+def world_spheres(world, centers, radii):
+    """Move local spheres by global matrices, radii grow by the largest scale of each matrix"""
+    rotation = world[:, :3, :3]
+    centers = np.matmul(centers[:, None], rotation)[:, 0] + world[:, 3, :3]
+    scales = np.sqrt(np.einsum("nij,nij->ni", rotation, rotation).max(axis=1))
+    return centers, radii * scales
+
+
+class Bounds(object):
+    """World space bounds for a set of meshes and every node above them
+
+    Attributes:
+        levels (list): the store's levels when the bounds were built
+        centers (np.ndarray): (n, 3) world space sphere center of each mesh
+        radii (np.ndarray): world space sphere radius of each mesh
+        box_min (np.ndarray): (store capacity, 3) lower corner of the box around each node's subtree
+        box_max (np.ndarray): (store capacity, 3) upper corner, boxes of nodes without meshes are empty
+    """
+
+    def __init__(self, store, slots, centers, radii):
+        with store.lock:
+            if store.levels is None:
+                store.build_levels()
+            self.levels = store.levels
+        parents = store.parents
+        self.centers, self.radii = world_spheres(store.world[slots], centers, radii)
+
+        # Boxes are kept as min and negated max so merging is a single minimum
+        bounds = np.full((len(parents), 6), np.inf, np.float32)
+        bounds[slots, :3] = self.centers - self.radii[:, None]
+        bounds[slots, 3:] = -self.centers - self.radii[:, None]
+
+        # Bottom up, roots hang off slot 0 which is never tested so the top level isn't merged
+        for level in reversed(self.levels[1:]):
+            level_parents = parents[level]
+            starts = np.flatnonzero(np.concatenate([[True], level_parents[1:] != level_parents[:-1]]))
+            merged = level_parents[starts]  # Siblings are next to each other, see TransformStore.build_levels
+            children = bounds[level]
+            if len(starts) < len(level):
+                children = np.minimum.reduceat(children, starts)
+            bounds[merged] = np.minimum(bounds[merged], children)
+        self.box_min, self.box_max = bounds[:, :3], -bounds[:, 3:]
+
+
+def cull(parents, slots, bounds, planes):
+    """Find which meshes are in view
+
+    Args:
+        parents (np.ndarray): parent slot of each slot in the transform store
+        slots (np.ndarray): store slot of each mesh's node
+        bounds (Bounds): world space bounds built for the same meshes
+        planes (np.ndarray): frustum planes from frustum_planes
+
+    Returns:
+        tuple: mask of meshes in view and the number of nodes that were tested
+    """
+    visible = np.zeros(len(bounds.box_min), bool)
+    inside = np.zeros(len(bounds.box_min), bool)
+    visible[0] = True
+    tested = 0
+    for level in bounds.levels:
+        level_parents = parents[level]
+
+        # Everything under a node that's entirely in view is too
+        inherited = level[inside[level_parents]]
+        visible[inherited] = inside[inherited] = True
+
+        candidates = level[visible[level_parents] & ~inside[level_parents]]
+        visible[candidates], inside[candidates] = classify_boxes(planes, bounds.box_min[candidates],
+                                                                 bounds.box_max[candidates])
+        tested += len(candidates)
+
+    # A mesh's own sphere only needs testing if its node's box is straddling the edge of the view
+    in_view = visible[slots]
+    edge = in_view & ~inside[slots]
+    in_view[edge] = spheres_visible(planes, bounds.centers[edge], bounds.radii[edge])
+    return in_view, tested
+
+
+class InstanceCuller(object):
+    """Transform feedback pass that copies the instances of a mesh in view into a compacted buffer
+
+    Each instance goes through as a point. The vertex shader tests its bounding sphere against the
+    frustum and the geometry shader only emits the ones that pass, so the captured buffer holds just
+    the visible instances in the same layout as the original. GL 3.3 has no indirect draws, so the
+    number kept comes back through a query, which waits on the pass. The pass is cheap next to
+    shading millions of instances, and it's skipped while the camera and the mesh stay put.
+
+    Distance ranges split the kept instances into buckets, one buffer each, so farther instances can
+    be drawn with a simpler mesh, see lod.py. Each bucket is a pass of its own since capturing to
+    several buffers at once needs GL 4.
+
+    Attributes:
+        count (int): number of instances in the source buffer
+        ranges (tuple): (near, far) distance from the camera kept in each bucket, in the mesh's own units
+        outputs (list): compacted instance buffer for each bucket
+        counts (list): instances kept in each bucket by the last pass
+    """
+
+    def __init__(self, ctx, program, instance_buffer, count, local_sphere, ranges=((0.0, np.inf),)):
+        self.program = program
+        self.count = count
+        self.ranges = ranges
+        center, radius = local_sphere
+        self.local_sphere = (*map(float, center), float(radius))
+        self.vao = ctx.vertex_array(program, [(instance_buffer, "16f", "instance_matrix")])
+        self.outputs = [ctx.buffer(reserve=count * INSTANCE_BYTES) for _ in ranges]
+        self.counts = [count] * len(ranges)
+        self.query = ctx.query(primitives=True)
+        self._key = None
+
+    def cull(self, model_matrix, planes, camera_position, ranges=None):
+        """Refill the buckets for a model matrix and view, unless they're already up to date
+
+        Args:
+            ranges (tuple): new distance ranges, as many as there are buckets, otherwise they're kept
+
+        Returns:
+            list: number of instances in each bucket
+        """
+        model = np.ascontiguousarray(model_matrix, np.float32)
+        planes = planes.astype(np.float32)
+        camera_position = np.asarray(camera_position, np.float32)
+        if ranges is not None:
+            self.ranges = tuple(ranges)
+        key = (model.tobytes(), planes.tobytes(), camera_position.tobytes(), self.ranges)
+        if key == self._key:
+            return self.counts
+        self._key = key
+
+        program = self.program
+        program["m_model"].write(model)
+        program["planes"].write(planes)
+        program["local_sphere"].value = self.local_sphere
+        program["model_scale"].value = float(np.sqrt((model[:3, :3] ** 2).sum(axis=1).max()))
+        program["camera_position"].value = tuple(camera_position)
+
+        counts = []
+        for (near, far), output in zip(self.ranges, self.outputs):
+            if near >= far:
+                counts.append(0)  # Bucket isn't in use
+                continue
+            program["distance_range"].value = (float(near), min(float(far), FLOAT_MAX))
+            with self.query:
+                self.vao.transform(output, mode=moderngl.POINTS, vertices=self.count)
+            counts.append(self.query.primitives)
+        self.counts = counts
+        return counts
+
+
+class OcclusionCuller(object):
+    """Occlusion queries that find meshes hidden behind the rest of the scene
+
+    After the opaque meshes are drawn, a box around each mesh's world space bounding sphere is drawn
+    inside a query without writing color or depth. Meshes whose box had no samples pass are skipped
+    the next frame. Their boxes are still drawn, so they come back as soon as they're uncovered.
+
+    Results are a frame old, so they're kept conservative. Boxes are grown by how far the camera just
+    moved, so a mesh the camera is about to see around an edge still counts as visible. Boxes that
+    reach the near plane are never tested since they'd be clipped, and everything is drawn again once
+    the scene changes, since the old results are for meshes that have since moved.
+
+    Attributes:
+        queries (list): pool of moderngl queries, one for each mesh tested in a frame
+        tested (np.ndarray): indices of the meshes whose boxes were drawn last frame
+    """
+
+    def __init__(self, ctx, program):
+        self.ctx = ctx
+        self.program = program
+        self.vao = ctx.vertex_array(program, [(ctx.buffer(PROXY_CORNERS), "3f", "in_position")],
+                                    ctx.buffer(PROXY_TRIANGLES), 4)
+        self.queries = []
+        self.tested = np.zeros(0, np.int64)
+        self._key = None
+        self._camera_position = None
+
+    def hidden_mask(self, count, key):
+        """Which of count meshes were hidden last frame, key should change whenever the meshes do
+
+        Reading a result waits for its query, but they were issued a frame ago so they're usually done.
+        """
+        hidden = np.zeros(count, bool)
+        if key != self._key:
+            self._key = key
+            self.tested = np.zeros(0, np.int64)
+        elif len(self.tested):
+            samples = np.fromiter((query.samples for query in self.queries[:len(self.tested)]), np.int64,
+                                  len(self.tested))
+            hidden[self.tested] = samples == 0
+        return hidden
+
+    def query(self, indices, centers, radii, planes, camera_position):
+        """Draw the boxes for meshes in view into the current depth buffer
+
+        Args:
+            indices (np.ndarray): indices of the meshes to test
+            centers (np.ndarray): world space sphere center of every mesh
+            radii (np.ndarray): world space sphere radius of every mesh, UNBOUNDED ones are skipped
+            planes (np.ndarray): frustum planes, the near plane is used to skip boxes around the camera
+            camera_position (np.ndarray): world position of the camera
+        """
+        camera_position = np.asarray(camera_position, np.float64)
+        margin = 0.0
+        if self._camera_position is not None:
+            margin = OCCLUSION_MARGIN * float(np.linalg.norm(camera_position - self._camera_position))
+        self._camera_position = camera_position
+
+        # Half size of each box, its corners reach sqrt(3) times that from the center
+        sizes = radii[indices] + margin
+        near = centers[indices] @ planes[4, :3] + planes[4, 3]
+        indices = indices[(radii[indices] < UNBOUNDED) & (near > sizes * np.sqrt(3))]
+        while len(self.queries) < len(indices):
+            self.queries.append(self.ctx.query(samples=True))
+
+        framebuffer = self.ctx.fbo
+        framebuffer.color_mask = False, False, False, False
+        framebuffer.depth_mask = False
+        sphere = self.program["sphere"]
+        for query, index in zip(self.queries, indices):
+            x, y, z = centers[index]
+            sphere.value = (float(x), float(y), float(z), float(radii[index] + margin))
+            with query:
+                self.vao.render()
+        framebuffer.color_mask = True, True, True, True
+        framebuffer.depth_mask = True
+        self.tested = indices
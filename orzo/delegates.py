@@ -21,7 +21,7 @@ import quaternion
 from PIL import Image as img
 import imgui
 
-from . import programs
+from . import programs, picking, geometry, cache, pipeline, transforms, culling, lod
 
 
 @dataclass
@@ -66,11 +66,11 @@ FORMAT_MAP = {
 }
 
 NP_FORMAT_MAP = {
-    "U8": np.int8,
-    "U16": np.int16,
-    "U32": np.int32,
-    "U8VEC4": np.int8,
-    "U16VEC2": np.int16,
+    "U8": np.uint8,
+    "U16": np.uint16,
+    "U32": np.uint32,
+    "U8VEC4": np.uint8,
+    "U16VEC2": np.uint16,
     "VEC2": np.single,
     "VEC3": np.single,
     "VEC4": np.single,
@@ -78,6 +78,18 @@ NP_FORMAT_MAP = {
     "MAT4": np.single
 }
 
+# Attributes the mesh shaders read, missing ones are generated or given defaults
+REQUIRED_ATTRIBUTES = {"POSITION", "NORMAL", "TEXTURE", "COLOR"}
+
+
+def attribute_format(semantic, attr_format):
+    """Get the moderngl format for an attribute, u8 colors are normalized to [0, 1] in the shader"""
+    format_info = FORMAT_MAP[attr_format]
+    if semantic == "COLOR" and attr_format == "U8VEC4":
+        return "4f1"
+    return f"{format_info.num_components}{format_info.format}"
+
+
 MODE_MAP = {
     "TRIANGLES": moderngl.TRIANGLES,
     "POINTS": moderngl.POINTS,
@@ -282,10 +294,11 @@ class EntityDelegate(Entity):
         name (str): Name of the entity, defaults to 'No-Name Entity'
     """
 
-    node: Optional[mglw.scene.Node] = None
+    node: Optional[transforms.TransformNode] = None
     patch_nodes: list = []
     light_delegates: list[LightDelegate] = []
     geometry_delegate: Optional[GeometryDelegate] = None
+    render_request: Optional[pipeline.LoadRequest] = None
     methods_list: Optional[List[MethodID]] = []
     signals_list: Optional[List[SignalID]] = []
     method_delegates: Optional[list[MethodDelegate]] = None
@@ -303,30 +316,56 @@ class EntityDelegate(Entity):
     def render_entity(self, window):
         """Render the mesh associated with this delegate
         
-        Will be called as callback from window. Largely hands the work off to the geometry delegate
+        Will be called as callback from window. Largely hands the work off to the geometry delegate.
+        Any meshes from an old render representation are removed first.
         """
+        self.remove_meshes(window)
+        if self.render_rep is None:
+            return
 
-        assert self.render_rep is not None, "Entity must have a render representation to render"
-
-        # Prepare Mesh
+        # Prepare Mesh, decoding happens in the background and the rest is finished once it's ready
         geometry = self.client.get_delegate(self.render_rep.mesh)
         self.geometry_delegate = geometry
-        self.patch_nodes, self.num_instances = geometry.render(window, self)
+        self.render_request = window.decode_pipeline.load(geometry, lambda decoded: self.add_meshes(window, decoded))
+
+    def add_meshes(self, window, decoded=None):
+        """Add meshes to the scene once the geometry is decoded"""
+        self.render_request = None
+        self.patch_nodes, self.num_instances = self.geometry_delegate.render(window, self, decoded)
 
         # Add geometry patch nodes as children to main
         for node in self.patch_nodes:
             node.matrix = np.identity(4, np.float64)
             window.add_node(node, parent=self.node)
 
+    def remove_meshes(self, window):
+        """Remove the entity's meshes and release the geometry they were using, the node stays in the scene"""
+        if self.render_request:
+            self.render_request.cancel()
+            self.render_request = None
+
+        for node in self.patch_nodes:
+            window.remove_node(node, parent=self.node)
+        if self.node is not None and self.node.mesh is not None:
+            window.scene.meshes.remove(self.node.mesh)
+            self.node.mesh = None
+            window.draw_list.invalidate()
+
+        if self.geometry_delegate:
+            self.geometry_delegate.release(window, self)
+        self.patch_nodes = []
+
     def remove_from_render(self, window):
-        """Remove mesh from render"""
+        """Remove mesh from render along with the entity's node"""
+        self.remove_meshes(window)
         window.remove_node(self.node)
 
     def attach_lights(self, window):
         """Callback to handle lights attached to an entity
 
-        Light info is stored directly in the window. This info is used in the
-        mesh program to pass lights into the shader.
+        Light info is stored directly in the window's LightTable, which packs it into a light data
+        texture and bins it into view space clusters each frame, see lighting.py. Mesh programs read the
+        lights through those textures and a small uniform buffer with the cluster grid's parameters.
         """
 
         self.light_delegates = []  # Reset in case of update
@@ -394,13 +433,13 @@ class EntityDelegate(Entity):
     def set_up_node(self, window):
 
         # Create node with local transform
-        self.node = mglw.scene.Node(f"{self.id}'s Node", matrix=self.np_transform)
+        self.node = transforms.TransformNode(window.transform_store, f"{self.id}'s Node", matrix=self.np_transform)
 
         # Update Scene / State
         if self.parent:
-            window.add_node(self.node, parent=self.client.get_delegate(self.parent).node)
+            window.add_node(self.node, parent=self.client.get_delegate(self.parent).node, entity_id=self.id)
         else:
-            window.add_node(self.node, parent=None)
+            window.add_node(self.node, parent=None, entity_id=self.id)
 
     def update_matrices(self, window):
         """Update global matrices for all nodes in scene"""
@@ -450,9 +489,8 @@ class EntityDelegate(Entity):
             if self.lights:
                 self.client.callback_queue.put((self.update_lights, []))
 
-        # New mesh on entity
+        # New mesh on entity, render_entity clears out the old one
         if "render_rep" in message:
-            self.client.callback_queue.put((self.remove_from_render, []))
             self.client.callback_queue.put((self.render_entity, []))
 
         # Update lights attached and light positions
@@ -539,26 +577,21 @@ class PlotDelegate(Plot):
 
 
 class GeometryDelegate(Geometry):
+    """Delegate for geometry, turns each patch into a mesh when an entity is rendered
+
+    Patches are decoded and uploaded once into the window's geometry cache, and every entity using the
+    geometry gets a lightweight mesh sharing those buffers.
+    """
 
     @staticmethod
-    def calculate_bounding_sphere(vertices, instance_positions, entity):
+    def calculate_bounding_sphere(local_sphere, entity):
         """Calculate bounding sphere for a mesh
 
-        If we are dealing with instance rendering, assume instances are small and box them all in.
-        If dealing with vertices calculate it around the mesh. Center is more like a center of mass
-        as opposed to a geometric center.
+        Local spheres come from geometry.bounding_sphere. If we are dealing with instance rendering,
+        they box all the instance positions in, assuming instances are small. Otherwise they're around
+        the vertices. This moves the center into world space.
         """
-
-        if instance_positions is not None:
-            points = instance_positions
-        else:
-            points = vertices
-
-        # Calculate the center of the bounding sphere
-        center = np.mean(points, axis=0)
-
-        # Calculate the maximum distance from the center to any vertex
-        max_distance = np.max(np.linalg.norm(points - center, axis=1))
+        center, max_distance = local_sphere
 
         # Translate center to world space
         world_transform = entity.get_world_transform()
@@ -567,133 +600,160 @@ class GeometryDelegate(Geometry):
         return center[:3], max_distance
 
     @staticmethod
-    def calculate_normals(vertices, indices):
+    def calculate_normals(vertices, indices, angle_weighted=False):
         """Calculate Normals for a Mesh that doesn't have them
 
         Modeled off of three.js approach here: https://github.com/mrdoob/three.js/blob/dev/src/core/BufferGeometry.js
+        but batched with NumPy, see geometry.calculate_normals. Indices are (n, 3) triangles.
         """
-        normals = np.zeros(vertices.shape, dtype=np.single)
-        for triangle in indices:
-            v0 = vertices[triangle[0]]
-            v1 = vertices[triangle[1]]
-            v2 = vertices[triangle[2]]
-            normal = np.cross(v2 - v1, v0 - v1)
-            normals[triangle[0]] += normal
-            normals[triangle[1]] += normal
-            normals[triangle[2]] += normal
-
-        # normalize normals
-        return normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
-
-    @staticmethod
-    def extract_bytes(raw_bytes, attr_offset, length, attr_stride, attr_format):
-        if attr_stride == 0:
-            attr_stride = attr_format.size * attr_format.num_components
-        starts = range(attr_offset, attr_offset + length, attr_stride)
-        byte_chunks = [memoryview(raw_bytes)[start:start + (attr_format.size * attr_format.num_components)] for
-                       start in starts]  # Slicing with memory view is much, much faster
-        return b''.join(byte_chunks)
+        return geometry.calculate_normals(vertices, indices, angle_weighted)
 
     @staticmethod
-    def reformat_color(raw_bytes, color_format):
-        """Reformat all colors to consistent u8vec4's"""
-
-        if color_format == "U8VEC4":
-            return raw_bytes
-
-        vals = np.frombuffer(raw_bytes, dtype=NP_FORMAT_MAP[color_format])
-        max_val = np.finfo(np.single).max
-        vals *= max_val  # not sure about this
-
-        if color_format == "VEC3":
-            # Pad to 4
-            grouped = vals.reshape((-1, 3))
-            col = np.array([1] * len(grouped))
-            vals = np.append(grouped, col, axis=1)
-
-        reformatted = vals.astype(np.int8).tobytes()
-        return reformatted
-
-    def set_up_indices(self, patch, vao):
-        """Create index buffer for mesh
-
-        Also returns the indices as a numpy array
+    def extract_array(raw_bytes, offset, count, stride, attr_format):
+        """Get a zero-copy (count, components) view of an attribute or index in a buffer
+
+        Args:
+            raw_bytes (bytes): bytes of the whole buffer
+            offset (int): byte offset from the start of the buffer
+            count (int): number of elements
+            stride (int): bytes between elements, 0 for tightly packed
+            attr_format (str): NOODLES format like "VEC3"
         """
+        format_info = FORMAT_MAP[attr_format]
+        return geometry.strided_view(raw_bytes, offset, count, stride, NP_FORMAT_MAP[attr_format],
+                                     format_info.num_components)
+
+    def decode_indices(self, patch):
+        """Get the flat index array for a patch and the size of each index in bytes"""
         index = patch.indices
         if index:
             index_view = self.client.get_delegate(index.view)
-            index_format = FORMAT_MAP[index.format]
-            index_size = index_format.size
-            stride = index_view.stride if index.stride != 0 else index_size * index_format.num_components
+            index_size = FORMAT_MAP[index.format].size
             offset = index_view.offset + index.offset
-            index_bytes = GeometryDelegate.extract_bytes(index_view.buffer_delegate.bytes, offset, index_view.length,
-                                                         stride, index_format)
-            indices = np.frombuffer(index_bytes, dtype=NP_FORMAT_MAP[index.format])
+            indices = GeometryDelegate.extract_array(index_view.buffer_delegate.bytes, offset, index.count,
+                                                     index.stride, index.format)
+            indices = geometry.packed(indices).ravel()
         else:
             # Non-indexed primitives just use range - 0, 1, 2, 3, etc...
-            indices = np.arange(patch.vertex_count, dtype=np.single)
-            index_bytes = indices.tobytes()
-            index_size = 4  # four bytes / 32 bits for np.single
+            indices = np.arange(patch.vertex_count, dtype=np.uint32)
+            index_size = 4  # four bytes / 32 bits for np.uint32
+
+        return indices, index_size
 
-        # Create the buffer and store it in the VAO
-        vao.index_buffer(index_bytes, index_size)
-        return indices.reshape((-1, 3))
+    def interleaved_view_format(self, patch):
+        """Get a format string to upload a patch's attributes straight from an interleaved view
 
-    def set_up_attributes(self, patch, mesh, indices):
-        """Take care of setting up attributes for a mesh
+        Works when every attribute the shaders need comes from the same buffer view with the same
+        stride, so the view can be uploaded as a single buffer. Bytes between attributes are covered by
+        unused attributes that moderngl skips over. A stride of 0 means an attribute is tightly packed
+        on its own, so attributes sharing a view that way are planar blocks, not records.
 
-        Breaks buffer into separate VAOs for each attribute
+        Returns:
+            (start, size, format, names) to upload, or None if the view can't be used as is, in which case
+            decode_attributes packs the attributes into one buffer itself
+        """
+        attributes = sorted(patch.attributes, key=lambda attr: attr.offset)
+        semantics = set(attr.semantic for attr in attributes)
+        views = set((attr.view.slot, attr.view.gen) for attr in attributes)
+        strides = set(attr.stride for attr in attributes)
+        if not REQUIRED_ATTRIBUTES <= semantics or len(views) != 1 or len(strides) != 1 or 0 in strides:
+            return None
+
+        formats, names, position = [], [], attributes[0].offset
+        for attribute in attributes:
+            gap = attribute.offset - position
+            if gap < 0:
+                return None  # Overlapping attributes
+            if gap > 0:
+                formats.append(f"{gap}u1")
+                names.append(f"unused_{len(names)}")
+            format_info = FORMAT_MAP[attribute.format]
+            formats.append(attribute_format(attribute.semantic, attribute.format))
+            names.append(f"in_{attribute.semantic.lower()}")
+            position = attribute.offset + format_info.size * format_info.num_components
+
+        stride = strides.pop()
+        if position - attributes[0].offset > stride:
+            return None
+        if position - attributes[0].offset < stride:
+            formats.append(f"{stride - position + attributes[0].offset}u1")
+            names.append(f"unused_{len(names)}")
+
+        view = self.client.get_delegate(attributes[0].view)
+        start = view.offset + attributes[0].offset
+        size = stride * patch.vertex_count
+        if start + size > len(view.buffer_delegate.bytes):
+            return None  # Last vertex's padding runs off the end of the buffer
+        return start, size, " ".join(formats), names
+
+    def decode_attributes(self, patch, triangles, angle_weighted=False, tangents=False, interleaved=False):
+        """Get GPU ready vertex buffers for a patch
+
+        Missing normals are generated from the triangles, and tangents can be generated for textured
+        meshes. By default each attribute gets its own buffer. With interleaved on, a server view that
+        already interleaves every attribute is uploaded once as is, and otherwise attributes are packed
+        together once into a single buffer.
+
+        Returns:
+            (buffers, attributes, vertices) where buffers are (array, format, names) to upload and
+            attributes are (semantic, name, components) for the mesh
         """
-        vertices = None
 
-        # Break buffer up into VAO by attribute for robustness
-        attribute_semantics = set([attr.semantic for attr in patch.attributes])
+        # View each attribute in place, it's only copied if it needs to be packed
+        data, formats = {}, {}
         for attribute in patch.attributes:
             view: BufferViewDelegate = self.client.get_delegate(attribute.view)
-            buffer_bytes = view.buffer_delegate.bytes
-
-            # Get format info
-            format_info = FORMAT_MAP[attribute.format]
-            buffer_format = f"{format_info.num_components}{format_info.format}"
-
-            # Extract bytes and create buffer for attr
-            attr_bytes = GeometryDelegate.extract_bytes(buffer_bytes, attribute.offset, view.length,
-                                                        attribute.stride, format_info)
-
-            # Reformat colors to consistent u8vec4's
-            if attribute.semantic == "COLOR":
-                attr_bytes = GeometryDelegate.reformat_color(attr_bytes, attribute.format)
-                buffer_format = "4u1"
-
-            # Calculate normals if they are missing
-            if attribute.semantic == "POSITION":
-                vertices = np.frombuffer(attr_bytes, np.float32).reshape((-1, 3))
-                if "NORMAL" not in attribute_semantics:
-                    normals = GeometryDelegate.calculate_normals(vertices, indices).flatten()
-                    mesh.vao.buffer(normals, '3f', 'in_normal')
-                    mesh.add_attribute("NORMAL", "in_normal", 3)
-
-            attribute_name = f"in_{attribute.semantic.lower()}"  # What is passed into the shader
-            mesh.vao.buffer(attr_bytes, buffer_format, attribute_name)
-            mesh.add_attribute(attribute.semantic, attribute_name, format_info.num_components)
-            # Add attribute doesn't let you specify type for some reason, i'm not sure if type is used somewhere
-            # couldn't find it in docs / src. Another option would be to construct a dict and set mesh.attributes
-            # manually.
+            data[attribute.semantic] = GeometryDelegate.extract_array(view.buffer_delegate.bytes,
+                                                                      view.offset + attribute.offset,
+                                                                      patch.vertex_count, attribute.stride,
+                                                                      attribute.format)
+            formats[attribute.semantic] = attribute_format(attribute.semantic, attribute.format)
+        source_semantics = set(data)
+
+        vertices = data.get("POSITION")
+        normals = data.get("NORMAL") if formats.get("NORMAL") == "3f" else None
+        texcoords = data.get("TEXTURE") if formats.get("TEXTURE") == "2f" else None
+
+        # Calculate normals if they are missing, lines and points don't have faces so they get zeros
+        if vertices is not None and "NORMAL" not in data:
+            if triangles is not None:
+                normals = GeometryDelegate.calculate_normals(vertices, triangles, angle_weighted)
+            else:
+                normals = np.zeros(vertices.shape, np.float32)
+            data["NORMAL"], formats["NORMAL"] = normals, "3f"
 
         # Add default attributes for those that are missing
-        if "COLOR" not in attribute_semantics:
-            default_colors = [1.0, 1.0, 1.0, 1.0] * patch.vertex_count
-            buffer_data = np.array(default_colors, np.int8)
-            mesh.vao.buffer(buffer_data, '4u1', 'in_color')
-            mesh.add_attribute("COLOR", "in_color", 4)  # Could check changing this to 1
-
-        if "TEXTURE" not in attribute_semantics:
-            default_texture_coords = [0.0, 0.0] * patch.vertex_count
-            buffer_data = np.array(default_texture_coords, np.single)
-            mesh.vao.buffer(buffer_data, '2f', 'in_texture')
-            mesh.add_attribute("TEXTURE", "in_texture", 2)
+        if "COLOR" not in data:
+            data["COLOR"], formats["COLOR"] = np.full((patch.vertex_count, 4), 255, np.uint8), "4f1"
+        if "TEXTURE" not in data:
+            data["TEXTURE"], formats["TEXTURE"] = np.zeros((patch.vertex_count, 2), np.single), "2f"
+
+        # Tangents for textured meshes
+        generate = tangents and "TANGENT" not in data and triangles is not None
+        if generate and vertices is not None and normals is not None and texcoords is not None:
+            data["TANGENT"] = geometry.calculate_tangents(vertices, normals, texcoords, triangles)
+            formats["TANGENT"] = "4f"
+
+        interleaved_view = self.interleaved_view_format(patch) if interleaved and set(data) == source_semantics else None
+        if interleaved_view:
+            # Server already interleaves everything, upload the range once without touching it
+            start, size, buffer_format, names = interleaved_view
+            view = self.client.get_delegate(patch.attributes[0].view)
+            raw = np.frombuffer(view.buffer_delegate.bytes, np.uint8, count=size, offset=start)
+            buffers = [(raw, buffer_format, names)]
+        elif interleaved:
+            # Pack everything into one buffer, a single copy per attribute
+            semantics = list(data)
+            packed = geometry.interleave([data[semantic] for semantic in semantics])
+            names = [f"in_{semantic.lower()}" for semantic in semantics]
+            buffers = [(packed, " ".join(formats[semantic] for semantic in semantics), names)]
+        else:
+            # Separate buffer for each attribute
+            buffers = [(geometry.packed(attr_data), formats[semantic], [f"in_{semantic.lower()}"])
+                       for semantic, attr_data in data.items()]
 
-        return vertices
+        attributes = [(semantic, f"in_{semantic.lower()}", attr_data.shape[1]) for semantic, attr_data in data.items()]
+        return buffers, attributes, vertices
 
     def set_up_instances(self, instances, mesh, window):
         """Set up instance buffer, program depends on whether there is instancing"""
@@ -701,68 +761,143 @@ class GeometryDelegate(Geometry):
         # Add instances to vao if applicable, also add appropriate mesh program
         if instances:
             instance_view = self.client.get_delegate(instances.view)
-            instance_buffer = instance_view.buffer_delegate
-            instance_bytes = instance_buffer.bytes
-            mesh.vao.buffer(instance_bytes, '16f/i', 'instance_matrix')
+            instance_bytes = instance_view.buffer_delegate.bytes
+            stride = instances.stride or 64  # 16 4 byte floats per instance
+            num_instances = (instance_view.length - 64) // stride + 1
+            insts = geometry.strided_view(instance_bytes, instance_view.offset, num_instances, stride, np.single, 16)
+            insts = geometry.packed(insts).reshape((num_instances, 4, 4))
+            mesh.instance_buffer = mesh.vao.ctx.buffer(insts)
+            mesh.vao.buffer(mesh.instance_buffer, '16f/i', 'instance_matrix')
 
-            num_instances = int(instance_buffer.size / 64)  # 16 4 byte floats per instance
             mesh.mesh_program = programs.PhongProgram(window, num_instances)
 
             # Extract positions from instance buffer, used for calculating bounding sphere
-            insts = np.frombuffer(instance_bytes, np.single).reshape((num_instances, 4, 4))
             positions = insts[:, 0, :3]
+            mesh.instances = insts
 
         else:
             positions = None
             num_instances = 0
+            mesh.instances = None
+            mesh.instance_buffer = None
             mesh.mesh_program = programs.PhongProgram(window, num_instances=-1)
 
         return positions, num_instances
 
-    def render(self, window, entity):
+    def render(self, window, entity, decoded=None):
 
         # Render each patch using the instances
         nodes = []
         num_instances = 0
-        for patch in self.patches:
-            node, num_instances = self.render_patch(patch, window, entity)
+        for index, patch in enumerate(self.patches):
+            node, num_instances = self.render_patch(patch, window, entity, index, decoded)
             nodes.append(node)
         return nodes, num_instances
 
-    def render_patch(self, patch, window, entity):
+    def release(self, window, entity):
+        """Drop an entity's references to this geometry's cached patches"""
+        for index in range(len(entity.patch_nodes)):
+            window.geometry_cache.release((self.id, index))
+
+    def decode(self, window):
+        """Decode every patch into GPU ready arrays, safe to run on a worker thread"""
+        return [self.decode_patch(patch, window) for patch in self.patches]
+
+    def decode_patch(self, patch, window):
+        """Do the CPU side work for a patch so the render thread only has to upload it"""
+        indices, index_size = self.decode_indices(patch)
+        triangles = geometry.triangulate(indices, patch.type)
+        buffers, attributes, vertices = self.decode_attributes(patch, triangles, window.angle_weighted_normals,
+                                                               window.generate_tangents,
+                                                               window.interleaved_attributes)
+
+        bvh = picking.TriangleBVH(vertices, triangles) if triangles is not None and vertices is not None else None
+        lods = lod.build_levels(vertices, triangles) if window.generate_lods and patch.type == "TRIANGLES" else []
+        return pipeline.DecodedPatch(MODE_MAP[patch.type], indices, index_size, buffers, attributes,
+                                     geometry.bounding_sphere(vertices), bvh, lods)
+
+    def upload_patch(self, decoded, window, index):
+        """Upload a decoded patch, done once per patch no matter how many entities use it"""
+        ctx = window.ctx
+
+        # Initialize VAO to store buffers and indices for this patch, arrays are uploaded without going through bytes
+        vao = mglw.opengl.vao.VAO(name=f"{self.name} Patch {index} VAO", mode=decoded.mode)
+        vao.index_buffer(ctx.buffer(decoded.indices), decoded.index_size)
+        for data, buffer_format, names in decoded.buffers:
+            vao.buffer(ctx.buffer(data), buffer_format, names)
+
+        mesh = mglw.scene.Mesh(f"{self.name} Mesh", vao=vao)
+        mesh.geometry_id = self.id
+        for semantic, name, components in decoded.attributes:
+            mesh.add_attribute(semantic, name, components)
+            # Add attribute doesn't let you specify type for some reason, i'm not sure if type is used somewhere
+            # couldn't find it in docs / src. Another option would be to construct a dict and set mesh.attributes
+            # manually.
+
+        # Levels of detail only need their own indices
+        resources = cache.PatchResources(mesh, decoded.bounding_sphere, decoded.bvh, decoded.lods)
+        for level in resources.lods:
+            level.index_buffer = ctx.buffer(level.triangles)
+            level.vao = resources.instanced_vao(level)
+        return resources
+
+    def render_patch(self, patch, window, entity, index=0, decoded=None):
 
         # Extract key attributes
         scene = window.scene
         transform = entity.np_transform
         instances = entity.render_rep.instances
 
-        # Initialize VAO to store buffers and indices for this patch
-        vao = mglw.opengl.vao.VAO(name=f"{self.name} Patch VAO", mode=MODE_MAP[patch.type])
+        # Shared buffers are only created by the first entity to use the patch
+        resources = window.geometry_cache.acquire((self.id, index),
+                                                  lambda: self.upload_patch(decoded[index], window, index))
 
         # Get Material - for now material delegate uses default texture
         material = self.client.get_delegate(patch.material)
         scene.materials.append(material.mglw_material)
 
-        # Create the mesh object
-        mesh = mglw.scene.Mesh(f"{self.name} Mesh", vao=vao, material=material.mglw_material)
-        mesh.geometry_id = self.id
+        # Create the mesh object, instanced entities get their own VAO for the instance buffer
+        mesh = copy.copy(resources.mesh)
+        mesh.vao = resources.instanced_vao() if instances else resources.mesh.vao
+        mesh.material = material.mglw_material
         mesh.entity_id = entity.id  # Can get delegate from mesh in click detection
         mesh.ghosting = False  # Ghosting turned off then will be turned on when dragged
+        mesh.resources = resources  # Meshes sharing a patch can be batched, see render.Batch
         entity.node.mesh = mesh  # Add mesh to entity's node, used as preview and to delete from scene graph later
 
-        # Create buffers for indices, attributes, and instances
-        indices = self.set_up_indices(patch, mesh.vao)
-        vertices = self.set_up_attributes(patch, mesh, indices)
         instance_positions, num_instances = self.set_up_instances(instances, mesh, window)
 
-        # Calculate normals and bounding sphere if needed
-        mesh.bounding_sphere = GeometryDelegate.calculate_bounding_sphere(vertices, instance_positions, entity)
+        # Calculate bounding sphere if needed
+        local_sphere = geometry.bounding_sphere(instance_positions) if num_instances else resources.bounding_sphere
+        mesh.bounding_sphere = GeometryDelegate.calculate_bounding_sphere(local_sphere, entity)
         mesh.has_bounding_sphere = True
+        mesh.bvh = resources.bvh
+
+        # Culling needs a sphere in the mesh's own space that covers whole instances, not just their positions
+        if num_instances:
+            mesh.local_sphere = geometry.instanced_bounding_sphere(mesh.instances, resources.bounding_sphere)
+        else:
+            mesh.local_sphere = resources.bounding_sphere
+
+        # Big instanced meshes are culled per instance on the GPU, drawing from a compacted copy of the instances
+        # with a bucket for each level of detail. Smaller instanced meshes are always drawn in full.
+        mesh.instance_culler = None
+        mesh.lods = [] if instances else resources.lods
+        if num_instances >= culling.GPU_CULL_INSTANCES:
+            program = window.program_registry.instance_cull_program
+            ranges = [(0.0, np.inf)] + [(np.inf, np.inf)] * len(resources.lods)
+            mesh.instance_culler = culling.InstanceCuller(window.ctx, program, mesh.instance_buffer, num_instances,
+                                                          resources.bounding_sphere, ranges)
+            mesh.culled_vaos = [resources.instanced_vao(level) for level in [None] + resources.lods]
+            for vao, output in zip(mesh.culled_vaos, mesh.instance_culler.outputs):
+                vao.buffer(output, '16f/i', 'instance_matrix')
+            mesh.lods = resources.lods
 
         # Add mesh as new node to scene graph
         mesh_copy = copy.copy(mesh)
         scene.meshes.append(mesh)
-        new_mesh_node = mglw.scene.Node(f"{entity.name}'s Mesh Preview", mesh=mesh_copy, matrix=transform)
+        new_mesh_node = transforms.TransformNode(window.transform_store, f"{entity.name}'s Mesh Preview",
+                                                 mesh=mesh_copy, matrix=transform)
 
         return new_mesh_node, num_instances
 
@@ -872,6 +1007,7 @@ class MaterialDelegate(Material):
         mglw_texture.repeat_y = mglw_sampler.repeat_y
 
         self.mglw_material.mat_texture = mglw.scene.MaterialTexture(mglw_texture, mglw_sampler)
+        window.draw_list.invalidate()  # Draws are sorted by texture
 
     def on_new(self, message: dict):
         """"Create mglw_material from noodles message"""
@@ -0,0 +1,251 @@
+"""Module for Batched Geometry Processing with NumPy
+
+These functions work on whole arrays at once so decoding big meshes never loops over triangles
+or vertices in Python.
+"""
+
+import numpy as np
+
+
+def strided_view(data, offset, count, stride, dtype, components=1):
+    """Zero-copy (count, components) view of elements laid out in a buffer
+
+    Offset, stride, and format from a NOODLES attribute map directly onto NumPy strides, so
+    interleaved or padded layouts can be read without slicing out each vertex. The view is read
+    only when data is bytes, and it keeps data alive for as long as it's around.
+
+    Args:
+        data (bytes): raw buffer, anything supporting the buffer protocol works
+        offset (int): byte offset of the first element
+        count (int): number of elements
+        stride (int): bytes between elements, 0 means tightly packed
+        dtype (np.dtype): type of each component
+        components (int): number of components per element
+    """
+    dtype = np.dtype(dtype)
+    stride = stride or dtype.itemsize * components
+    return np.ndarray((count, components), dtype, buffer=data, offset=offset, strides=(stride, dtype.itemsize))
+
+
+def packed(view):
+    """Tightly packed version of a view, only copies when the layout is strided or misaligned"""
+    if view.flags.c_contiguous and view.flags.aligned:
+        return view
+    return np.array(view, order='C')
+
+
+def interleave(arrays):
+    """Pack (n, components) arrays into one array with a record per vertex
+
+    Records have no padding between fields, so the result can be uploaded as a single vertex buffer
+    with the fields' formats joined in order.
+    """
+    dtype = np.dtype([(f"f{i}", array.dtype, (array.shape[1],)) for i, array in enumerate(arrays)])
+    records = np.empty(len(arrays[0]), dtype)
+    for i, array in enumerate(arrays):
+        records[f"f{i}"] = array
+    return records
+
+
+def triangulate(indices, mode):
+    """Turn a flat index array into an (n, 3) array of triangles
+
+    Strips alternate winding so every triangle keeps the same facing. Modes that aren't made of
+    triangles like points and lines return None.
+
+    Args:
+        indices (np.ndarray): flat array of vertex indices
+        mode (str): primitive type like "TRIANGLES" or "TRIANGLE_STRIP"
+    """
+    indices = np.asarray(indices).ravel().astype(np.int64)
+    if mode == "TRIANGLES":
+        count = len(indices) - len(indices) % 3
+        return indices[:count].reshape((-1, 3))
+
+    if len(indices) < 3:
+        return np.zeros((0, 3), np.int64)
+
+    if mode == "TRIANGLE_STRIP":
+        triangles = np.stack([indices[:-2], indices[1:-1], indices[2:]], axis=1)
+        odd = triangles[1::2]
+        odd[:, [0, 1]] = odd[:, [1, 0]]
+        return triangles
+
+    if mode == "TRIANGLE_FAN":
+        first = np.full(len(indices) - 2, indices[0])
+        return np.stack([first, indices[1:-1], indices[2:]], axis=1)
+
+    return None
+
+
+def face_normals(vertices, triangles):
+    """Unnormalized normal for each triangle, length is twice the triangle's area"""
+    v0 = vertices[triangles[:, 0]]
+    v1 = vertices[triangles[:, 1]]
+    v2 = vertices[triangles[:, 2]]
+    return np.cross(v2 - v1, v0 - v1)
+
+
+def degenerate_triangles(triangles, normals):
+    """Mask of triangles with repeated indices or no area, these don't contribute to normals
+
+    Args:
+        triangles (np.ndarray): (m, 3) vertex indices for each triangle
+        normals (np.ndarray): (m, 3) unnormalized face normals from face_normals
+    """
+    repeated = ((triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2]) |
+                (triangles[:, 0] == triangles[:, 2]))
+    squared_area = np.einsum('ij,ij->i', normals, normals)
+    return repeated | (squared_area <= np.finfo(np.float32).tiny)
+
+
+def normalize(vectors):
+    """Normalize rows, rows with no length are left as zeros instead of becoming NaN"""
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
+
+
+def accumulate(values, triangles, num_vertices):
+    """Sum per corner values, shaped (triangles, 3, components), into their vertices"""
+    flat = triangles.ravel()
+    components = values.shape[-1]
+    values = values.reshape((-1, components))
+    return np.stack([np.bincount(flat, weights=values[:, i], minlength=num_vertices)
+                     for i in range(components)], axis=1)
+
+
+def corner_angles(vertices, triangles):
+    """Interior angle at each corner of each triangle, shaped (triangles, 3)"""
+    corners = vertices[triangles]
+    angles = np.empty(triangles.shape, np.float64)
+    for i in range(3):
+        a = normalize(corners[:, (i + 1) % 3] - corners[:, i])
+        b = normalize(corners[:, (i + 2) % 3] - corners[:, i])
+        angles[:, i] = np.arccos(np.clip(np.einsum('ij,ij->i', a, b), -1.0, 1.0))
+    return angles
+
+
+def bounding_sphere(points):
+    """Sphere around points as (center, radius)
+
+    The center is the mean, more like a center of mass than a geometric center, but it's cheap and
+    good enough for culling and framing.
+    """
+    center = np.mean(points, axis=0)
+    radius = np.max(np.linalg.norm(points - center, axis=1))
+    return center, radius
+
+
+def instanced_bounding_sphere(instances, sphere):
+    """Sphere around every instance of a mesh as (center, radius)
+
+    Instances are (n, 4, 4) rows of position, color, rotation, and scale. Each instance is covered by
+    the mesh's own sphere grown by the instance's largest scale, which holds whatever the rotation.
+    """
+    center, radius = sphere
+    positions = instances[:, 0, :3]
+    reach = (np.linalg.norm(center) + radius) * np.abs(instances[:, 3, :3]).max(axis=1)
+    middle = positions.mean(axis=0)
+    return middle, float(np.max(np.linalg.norm(positions - middle, axis=1) + reach))
+
+
+def cluster_vertices(vertices, triangles, cell_size):
+    """Simplify a mesh by merging the vertices in each cell of a grid
+
+    Each cluster collapses onto the vertex closest to its mean, so the result still indexes the
+    original vertices and can be drawn with their buffers. Triangles that collapse into a line or a
+    point are dropped along with duplicates, and the rest keep their order and winding.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex positions
+        triangles (np.ndarray): (m, 3) vertex indices for each triangle
+        cell_size (float): width of the grid's cells, vertices closer than this get merged
+    """
+    vertices = np.asarray(vertices, np.float64)
+    triangles = np.asarray(triangles, np.int64)
+    used = np.unique(triangles)
+    points = vertices[used]
+
+    # One integer key per cell, grids are small enough that the key can't overflow
+    cells = np.floor((points - points.min(axis=0)) / cell_size).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+    _, clusters = np.unique(keys, return_inverse=True)
+
+    # Closest vertex to each cluster's mean, first in each cluster once sorted by distance
+    counts = np.bincount(clusters)
+    means = np.stack([np.bincount(clusters, weights=points[:, i]) for i in range(3)], axis=1) / counts[:, None]
+    distances = np.einsum("ij,ij->i", points - means[clusters], points - means[clusters])
+    order = np.lexsort((distances, clusters))
+    closest = order[np.concatenate([[True], clusters[order][1:] != clusters[order][:-1]])]
+    representative = np.zeros(len(vertices), np.int64)
+    representative[used] = used[closest[clusters]]
+
+    merged = representative[triangles]
+    keep = (merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) & (merged[:, 0] != merged[:, 2])
+    merged = merged[keep]
+    _, first = np.unique(np.sort(merged, axis=1), axis=0, return_index=True)
+    return merged[np.sort(first)]
+
+
+def calculate_normals(vertices, triangles, angle_weighted=False):
+    """Calculate smooth vertex normals for a mesh that doesn't have them
+
+    Face normals are summed into each of their corners. By default they're weighted by area like
+    three.js, or they can be weighted by the angle at each corner which holds up better on meshes
+    with long thin triangles. Degenerate triangles are skipped and vertices that aren't used by any
+    triangle get a zero normal.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex positions
+        triangles (np.ndarray): (m, 3) vertex indices for each triangle
+        angle_weighted (bool): weight by corner angle instead of triangle area
+    """
+    vertices = np.asarray(vertices, np.float64)
+    triangles = np.asarray(triangles, np.int64)
+    normals = face_normals(vertices, triangles)
+    keep = ~degenerate_triangles(triangles, normals)
+    triangles, normals = triangles[keep], normals[keep]
+
+    if angle_weighted:
+        corner_normals = normalize(normals)[:, None, :] * corner_angles(vertices, triangles)[:, :, None]
+    else:
+        corner_normals = np.repeat(normals[:, None, :], 3, axis=1)
+
+    summed = accumulate(corner_normals, triangles, len(vertices))
+    return normalize(summed).astype(np.float32)
+
+
+def calculate_tangents(vertices, normals, texcoords, triangles):
+    """Calculate per vertex tangents for normal mapping on textured meshes
+
+    Uses the usual texture space method where each triangle's tangent and bitangent come from its
+    edges and uv deltas. Tangents are made orthogonal to the normal, and w stores the handedness.
+
+    Returns:
+        np.ndarray: (n, 4) tangents as xyz and handedness
+    """
+    vertices = np.asarray(vertices, np.float64)
+    normals = np.asarray(normals, np.float64)
+    texcoords = np.asarray(texcoords, np.float64)
+    triangles = np.asarray(triangles, np.int64)
+    triangles = triangles[~degenerate_triangles(triangles, face_normals(vertices, triangles))]
+
+    p0, p1, p2 = (vertices[triangles[:, i]] for i in range(3))
+    uv0, uv1, uv2 = (texcoords[triangles[:, i]] for i in range(3))
+    e1, e2 = p1 - p0, p2 - p0
+    duv1, duv2 = uv1 - uv0, uv2 - uv0
+
+    det = duv1[:, 0] * duv2[:, 1] - duv2[:, 0] * duv1[:, 1]
+    inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=np.abs(det) > 1e-12)[:, None]
+    tangent = (e1 * duv2[:, 1:2] - e2 * duv1[:, 1:2]) * inv_det
+    bitangent = (e2 * duv1[:, 0:1] - e1 * duv2[:, 0:1]) * inv_det
+
+    num_vertices = len(vertices)
+    tangents = accumulate(np.repeat(tangent[:, None, :], 3, axis=1), triangles, num_vertices)
+    bitangents = accumulate(np.repeat(bitangent[:, None, :], 3, axis=1), triangles, num_vertices)
+
+    # Gram-Schmidt against the normal, then handedness from the bitangent
+    tangents = normalize(tangents - normals * np.einsum('ij,ij->i', normals, tangents)[:, None])
+    handedness = np.where(np.einsum('ij,ij->i', np.cross(normals, tangents), bitangents) < 0.0, -1.0, 1.0)
+    return np.hstack([tangents, handedness[:, None]]).astype(np.float32)
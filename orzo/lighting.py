@@ -0,0 +1,344 @@
+"""Module for Clustered Lighting
+
+Lights are kept packed in a structured array and uploaded to a float texture, five texels per light.
+Each frame the view frustum is split into a grid of clusters, tiles on screen by slices in depth,
+and every light is binned into the clusters its sphere of influence touches. Fragments look up their
+cluster and only evaluate the lights binned there, so a scene can have hundreds or thousands of lights
+as long as any one spot is only lit by a few of them.
+
+Binning is done on the CPU with NumPy and uploaded as textures, which works on GL 3.3. A small uniform
+buffer with the grid's parameters is bound once per frame for every program to read.
+"""
+
+import moderngl
+import numpy as np
+
+# Tiles across, tiles down, and depth slices the view frustum is split into
+CLUSTER_GRID = (16, 9, 24)
+
+# Lights without a range are cut off where their contribution drops below this
+LIGHT_THRESHOLD = 1 / 256
+
+# Uniform block binding point and texture units shared by every program that reads lights
+LIGHT_BINDING = 0
+LIGHT_DATA_UNIT = 1
+LIGHT_CLUSTER_UNIT = 2
+LIGHT_INDEX_UNIT = 3
+LIGHT_SAMPLERS = {
+    "light_data": LIGHT_DATA_UNIT,
+    "light_clusters": LIGHT_CLUSTER_UNIT,
+    "light_indices": LIGHT_INDEX_UNIT,
+}
+
+# Width of the texture holding the flattened per cluster light lists, the largest size GL 3.3 guarantees
+INDEX_TEXTURE_WIDTH = 1024
+
+# Layout of a light in the data texture, 80 bytes is five RGBA32F texels
+LIGHT_DTYPE = np.dtype({
+    "names": ["world_position", "type", "color", "ambient", "info", "direction"],
+    "formats": [("f4", 3), "i4", ("f4", 4), ("f4", 3), ("f4", 4), ("f4", 3)],
+    "offsets": [0, 12, 16, 32, 48, 64],
+    "itemsize": 80,
+})
+TEXELS_PER_LIGHT = LIGHT_DTYPE.itemsize // 16
+
+# Lights added after the scene's lights when default lighting is on
+DEFAULT_LIGHTS = [
+    {
+        "world_position": (0, 500, 1000),
+        "color": (1, 1, 1, 1),
+        "ambient": (.5, .5, .5),
+        "type": 2,
+        "info": (.9, -1, 0, 0),
+        "direction": (0, 0, 0)
+    },
+    {
+        "world_position": (0, 0, 4),
+        "color": (1, 1, 1, 1),
+        "ambient": (.1, .1, .1),
+        "type": 0,
+        "info": (1, -1, 0, 0),
+        "direction": (0, 0, 0)
+    },
+]
+
+
+def pack_light(rows, row, info):
+    """Write a light info dict into a row of a LIGHT_DTYPE array"""
+    for name in LIGHT_DTYPE.names:
+        rows[name][row] = info[name]
+
+
+def pack_lights(infos):
+    """Get a LIGHT_DTYPE array from a list of light info dicts"""
+    rows = np.zeros(len(infos), LIGHT_DTYPE)
+    for row, info in enumerate(infos):
+        pack_light(rows, row, info)
+    return rows
+
+
+DEFAULT_LIGHT_ROWS = pack_lights(DEFAULT_LIGHTS)
+
+
+def light_texels(rows):
+    """Get the data texture contents for lights, (n, 5, 4) float32 with the type stored as a float"""
+    texels = np.ascontiguousarray(rows).view(np.float32).reshape(len(rows), TEXELS_PER_LIGHT, 4).copy()
+    texels[:, 0, 3] = rows["type"]
+    return texels
+
+
+def light_radii(rows, spec_strength):
+    """Distance each light reaches, directional lights reach everything
+
+    Point and spot lights stop at their range if they have one. Otherwise the 1 / (1 + d^2) falloff is
+    cut off where the most a light could add, diffuse plus specular, drops below LIGHT_THRESHOLD.
+    """
+    intensity = np.abs(rows["info"][:, 0])
+    peak = (rows["color"][:, :3].max(axis=1, initial=0) + spec_strength) * intensity
+    radii = np.sqrt(np.maximum(peak / LIGHT_THRESHOLD - 1, 0))
+
+    light_range = rows["info"][:, 1]
+    radii = np.where(light_range > 0, np.minimum(radii, light_range), radii)
+    return np.where(rows["type"] == 2, np.inf, radii)
+
+
+def cluster_bounds(centers, radii, projection, near, far, grid=CLUSTER_GRID):
+    """Range of clusters each light's sphere could touch, conservatively
+
+    Args:
+        centers (np.ndarray): (n, 3) view space light positions, the camera looks down -z
+        radii (np.ndarray): (n,) radius of each light, inf for lights that reach everything
+        projection (np.ndarray): perspective projection matrix
+        near (float): near plane distance
+        far (float): far plane distance
+        grid (tuple): tiles across, tiles down, and depth slices
+
+    Returns:
+        tuple: (n, 3) first and (n, 3) last cluster in x, y, and depth for each light, lights that
+            don't touch any cluster have a last cluster of -1
+    """
+    grid = np.array(grid)
+    depth = -centers[:, 2]
+    reaches_all = ~np.isfinite(radii)
+    radii = np.where(reaches_all, 0, radii)
+    w_min, w_max = depth - radii, depth + radii
+    outside = (w_max < near) | (w_min > far)
+
+    # Depth slices are spaced exponentially, matching the lookup in the fragment shader
+    slice_scale = grid[2] / np.log(far / near)
+    first_slice = np.floor(np.log(np.clip(w_min, near, far) / near) * slice_scale)
+    last_slice = np.floor(np.log(np.clip(w_max, near, far) / near) * slice_scale)
+
+    # Largest and smallest x / w and y / w over the sphere's bounding box, lights crossing the near plane
+    # could be anywhere on screen
+    crosses_near = w_min <= near
+    w_min = np.maximum(w_min, near)[:, None]
+    w_max = np.maximum(w_max, near)[:, None]
+    scale = np.array([projection[0][0], projection[1][1]])
+    low = centers[:, :2] - radii[:, None]
+    high = centers[:, :2] + radii[:, None]
+    ndc_low = np.where(low < 0, low / w_min, low / w_max) * scale
+    ndc_high = np.where(high > 0, high / w_min, high / w_max) * scale
+    ndc_low[crosses_near] = -1
+    ndc_high[crosses_near] = 1
+
+    tiles = grid[:2]
+    first_tile = np.floor((np.clip(ndc_low, -1, 1) * .5 + .5) * tiles)
+    last_tile = np.floor((np.clip(ndc_high, -1, 1) * .5 + .5) * tiles)
+
+    first = np.column_stack([first_tile, first_slice])
+    last = np.column_stack([last_tile, last_slice])
+    first[reaches_all] = 0
+    last[reaches_all] = grid - 1
+    first = np.maximum(first, 0).astype(np.int64)
+    last = np.minimum(last, grid - 1).astype(np.int64)
+    last[outside & ~reaches_all] = -1
+    return first, last
+
+
+def assign_lights(first, last, grid=CLUSTER_GRID):
+    """Bin lights into clusters given the range of clusters each one touches
+
+    Returns:
+        tuple: (depth slices, tiles down, tiles across, 2) uint32 offset and count into the light list for
+            each cluster, and the uint32 light list with each cluster's lights in order
+    """
+    grid = np.array(grid)
+    num_clusters = int(np.prod(grid))
+    extent = np.maximum(last - first + 1, 0)
+    counts = extent.prod(axis=1)
+    total = int(counts.sum())
+
+    # Expand every light's box of clusters into one entry per cluster
+    lights = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    width, height = extent[lights, 0], extent[lights, 1]
+    x = first[lights, 0] + step % width
+    y = first[lights, 1] + (step // width) % height
+    z = first[lights, 2] + step // (width * height)
+    clusters = (z * grid[1] + y) * grid[0] + x
+
+    order = np.argsort(clusters, kind="stable")
+    indices = lights[order].astype(np.uint32)
+    cluster_counts = np.bincount(clusters, minlength=num_clusters)
+    table = np.empty((num_clusters, 2), np.uint32)
+    table[:, 0] = np.cumsum(cluster_counts) - cluster_counts
+    table[:, 1] = cluster_counts
+    return table.reshape(grid[2], grid[1], grid[0], 2), indices
+
+
+class LightTable(object):
+    """Scene lights packed into a structured array and binned into clusters for the shader
+
+    Delegates add and remove lights by id like a dict. Rows stay packed, a removed light is replaced
+    by the last row, so the array can be uploaded as is. Light data is only uploaded after lights
+    change or default lighting is toggled, and lights are only rebinned when that or the view changes.
+
+    Every light's ambient term is added everywhere no matter how far away it is, so those are summed
+    here once instead of being evaluated per cluster.
+
+    Attributes:
+        ctx (moderngl.Context): context the buffers and textures live in
+        rows (np.ndarray): LIGHT_DTYPE array, the first len(self) rows are in use
+        ids (dict): light id -> row
+        order (list): light id in each row
+        grid (tuple): tiles across, tiles down, and depth slices
+        radii (np.ndarray): reach of each uploaded light
+        dirty (bool): whether lights changed since the last upload
+        uploads (int): number of times light data has been uploaded
+        binned (int): light to cluster entries in the last binning
+    """
+
+    def __init__(self, ctx, capacity=64, grid=CLUSTER_GRID):
+        self.ctx = ctx
+        self.rows = np.zeros(capacity, LIGHT_DTYPE)
+        self.ids = {}
+        self.order = []
+        self.grid = grid
+        self.radii = np.zeros(0)
+        self.dirty = True
+        self.uploads = 0
+        self.binned = 0
+
+        self.header = None
+        self.data_texture = None
+        self.cluster_texture = None
+        self.index_texture = None
+        self._lights = DEFAULT_LIGHT_ROWS[:0]
+        self._default_lighting = None
+        self._spec_strength = None
+        self._view_key = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, light_id):
+        return light_id in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, light_id):
+        return self.rows[self.ids[light_id]]
+
+    def __setitem__(self, light_id, info):
+        row = self.ids.get(light_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.rows):
+                rows = np.zeros(2 * len(self.rows), LIGHT_DTYPE)
+                rows[:row] = self.rows
+                self.rows = rows
+            self.ids[light_id] = row
+            self.order.append(light_id)
+        pack_light(self.rows, row, info)
+        self.dirty = True
+
+    def __delitem__(self, light_id):
+        row = self.ids.pop(light_id)
+        moved = self.order.pop()
+        if moved != light_id:
+            self.rows[row] = self.rows[len(self.order)]
+            self.ids[moved] = row
+            self.order[row] = moved
+        self.dirty = True
+
+    def packed(self, default_lighting):
+        """Get every light to upload, the scene's then the defaults"""
+        defaults = DEFAULT_LIGHT_ROWS if default_lighting else DEFAULT_LIGHT_ROWS[:0]
+        rows = np.zeros(len(self.ids) + len(defaults), LIGHT_DTYPE)  # Concatenating would drop the padding
+        rows[:len(self.ids)] = self.rows[:len(self.ids)]
+        rows[len(self.ids):] = defaults
+        return rows
+
+    def upload_lights(self, default_lighting, spec_strength):
+        """Write light data to its texture, growing the texture if needed"""
+        self._lights = self.packed(default_lighting)
+        self.radii = light_radii(self._lights, spec_strength)
+        texels = light_texels(self._lights)
+        if self.data_texture is None or self.data_texture.height < len(texels):
+            height = max(64, 2 * len(texels))
+            self.data_texture = self.ctx.texture((TEXELS_PER_LIGHT, height), 4, dtype='f4')
+            self.data_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        if len(texels):
+            self.data_texture.write(texels, viewport=(0, 0, TEXELS_PER_LIGHT, len(texels)))
+
+        self.dirty = False
+        self._default_lighting = default_lighting
+        self._spec_strength = spec_strength
+        self._view_key = None
+        self.uploads += 1
+
+    def bin_lights(self, view, projection, near, far):
+        """Assign lights to clusters for the current view and upload the results"""
+        positions = np.column_stack([self._lights["world_position"], np.ones(len(self._lights))])
+        centers = (positions @ view)[:, :3]
+        first, last = cluster_bounds(centers, self.radii, projection, near, far, self.grid)
+        table, indices = assign_lights(first, last, self.grid)
+        self.binned = len(indices)
+
+        if self.cluster_texture is None:
+            self.cluster_texture = self.ctx.texture3d(self.grid, 2, dtype='u4')
+            self.cluster_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        self.cluster_texture.write(table)
+
+        rows = max(-(-len(indices) // INDEX_TEXTURE_WIDTH), 1)
+        if self.index_texture is None or self.index_texture.height < rows:
+            self.index_texture = self.ctx.texture((INDEX_TEXTURE_WIDTH, 2 * rows), 1, dtype='u4')
+            self.index_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        padded = np.zeros(rows * INDEX_TEXTURE_WIDTH, np.uint32)
+        padded[:len(indices)] = indices
+        self.index_texture.write(padded, viewport=(0, 0, INDEX_TEXTURE_WIDTH, rows))
+
+    def write_header(self, viewport, near, far):
+        """Write the grid, depth slicing, viewport, and summed ambient light to the uniform buffer"""
+        intensity = self._lights["info"][:, 0]
+        header = np.zeros(16, np.float32)
+        header[:4] = np.array([*self.grid, len(self._lights)], np.int32).view(np.float32)
+        header[4:7] = near, far, self.grid[2] / np.log(far / near)
+        header[8:10] = viewport
+        header[12:15] = (self._lights["ambient"] * intensity[:, None]).sum(axis=0)
+        header[15] = intensity.sum()
+        if self.header is None:
+            self.header = self.ctx.buffer(reserve=header.nbytes)
+        self.header.write(header)
+
+    def use(self, window):
+        """Bring light data and clusters up to date and bind them for this frame's draws"""
+        if self.dirty or (window.default_lighting, window.spec_strength) != (self._default_lighting,
+                                                                             self._spec_strength):
+            self.upload_lights(window.default_lighting, window.spec_strength)
+
+        projection = window.camera.projection
+        view = np.asarray(window.camera.matrix, np.float64)
+        viewport = tuple(window.wnd.buffer_size)
+        view_key = (view.tobytes(), np.asarray(projection.matrix).tobytes(), viewport)
+        if view_key != self._view_key:
+            self.bin_lights(view, projection.matrix, projection.near, projection.far)
+            self.write_header(viewport, projection.near, projection.far)
+            self._view_key = view_key
+
+        self.header.bind_to_uniform_block(LIGHT_BINDING)
+        window.gl_state.texture(self.data_texture, location=LIGHT_DATA_UNIT)
+        window.gl_state.texture(self.cluster_texture, location=LIGHT_CLUSTER_UNIT)
+        window.gl_state.texture(self.index_texture, location=LIGHT_INDEX_UNIT)
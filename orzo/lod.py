@@ -0,0 +1,91 @@
+"""Module for Simplified Levels of Detail
+
+Big triangle patches are simplified when they're decoded by clustering their vertices on coarser and
+coarser grids, see geometry.cluster_vertices. Levels keep indexing the patch's own vertices, so each
+one only adds an index buffer. When drawing, the coarsest level whose grid cells would cover less
+than about a pixel is used, so a far away scan costs a fraction of its triangles.
+
+Distances here are from the camera to the nearest point of a mesh's bounding sphere, measured in the
+mesh's own units so a level's thresholds don't depend on how the mesh is scaled.
+"""
+
+import numpy as np
+
+from . import geometry
+
+# Patches with fewer triangles are always drawn in full
+LOD_MIN_TRIANGLES = 20_000
+
+# Grid cells across the longest side of a patch for each simplified level, finest first
+LOD_GRIDS = (128, 32, 8)
+
+# Levels are only kept if they have at most this fraction of the previous level's triangles
+LOD_MAX_RATIO = 0.5
+
+# Screen space size in pixels a level's cells can reach before a finer level is used
+LOD_PIXEL_ERROR = 1.0
+
+
+class LevelOfDetail(object):
+    """Simplified indices for a patch
+
+    Attributes:
+        triangles (np.ndarray): (n, 3) uint32 indices into the patch's vertices
+        error (float): size of the cells the vertices were merged in, in the patch's own units
+        index_buffer (moderngl.Buffer): the triangles on the GPU, set when the patch is uploaded
+        vao (VAO): shared VAO drawing this level, set when the patch is uploaded
+    """
+
+    def __init__(self, triangles, error):
+        self.triangles = triangles
+        self.error = error
+        self.index_buffer = None
+        self.vao = None
+
+
+def build_levels(vertices, triangles):
+    """Simplified levels for a patch, coarser ones later, empty if the patch is small
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex positions
+        triangles (np.ndarray): (m, 3) vertex indices for each triangle
+    """
+    if vertices is None or triangles is None or len(triangles) < LOD_MIN_TRIANGLES:
+        return []
+
+    size = float(np.ptp(vertices, axis=0).max())
+    levels, count = [], len(triangles)
+    for grid in LOD_GRIDS:
+        simplified = geometry.cluster_vertices(vertices, triangles, size / grid)
+        if len(simplified) == 0 or len(simplified) > count * LOD_MAX_RATIO:
+            continue
+        levels.append(LevelOfDetail(simplified.astype(np.uint32), size / grid))
+        count = len(simplified)
+    return levels
+
+
+def thresholds(levels, focal_pixels):
+    """Distance at which each level starts being used
+
+    A level's cells cover error * focal_pixels / distance pixels, so it can be used once that's under
+    LOD_PIXEL_ERROR. Full detail is used below the first threshold.
+
+    Args:
+        levels (list): LevelOfDetails, coarser ones later
+        focal_pixels (float): vertical focal length in pixels, see render.FrameState
+    """
+    return np.array([level.error for level in levels]) * (focal_pixels / LOD_PIXEL_ERROR)
+
+
+def mesh_distance(local_sphere, model_matrix, camera_position):
+    """Distance from the camera to a mesh's sphere in the mesh's own units, 0 when the camera is inside it"""
+    center, radius = local_sphere
+    model = np.asarray(model_matrix, np.float64)
+    scale = np.sqrt((model[:3, :3] ** 2).sum(axis=1).max())
+    world_center = np.asarray(center, np.float64) @ model[:3, :3] + model[3, :3]
+    return max(np.linalg.norm(world_center - camera_position) / scale - radius, 0.0)
+
+
+def select(levels, distance, focal_pixels):
+    """Index of the level to draw at a distance, 0 is full detail and i is levels[i - 1]"""
+    return int(np.searchsorted(thresholds(levels, focal_pixels), distance, side="right"))
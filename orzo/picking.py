@@ -0,0 +1,513 @@
+"""Module for Selecting Entities in the Scene"""
+
+from dataclasses import dataclass
+from time import time
+
+import moderngl
+import numpy as np
+import penne
+
+from . import programs, render
+
+# Size in pixels of the region drawn around the cursor when picking is scissored
+PICK_REGION = 1
+
+# Frames to wait before reading back an asynchronous pick, more frames means less chance of stalling
+PICK_LATENCY = 1
+
+
+def pick_matrix(x, y, width, height, region=PICK_REGION):
+    """Get a matrix that narrows a projection down to a small region around a pixel
+
+    Same idea as gluPickMatrix, the region centered on (x, y) is stretched to fill clip space so
+    everything outside it is clipped before rasterization. The result is in the same row-major
+    layout as the camera matrices, so it is applied with np.matmul(projection, pick).
+
+    Args:
+        x (float): pixel x in framebuffer coordinates
+        y (float): pixel y in framebuffer coordinates, origin at the bottom
+        width (int): width of the full viewport
+        height (int): height of the full viewport
+        region (int): width and height of the region in pixels
+    """
+    matrix = np.identity(4, np.float32)
+    matrix[0, 0] = width / region
+    matrix[1, 1] = height / region
+    matrix[3, 0] = (width - 2.0 * x) / region
+    matrix[3, 1] = (height - 2.0 * y) / region
+    return matrix
+
+
+def decode_pixel(pixel_data):
+    """Unpack raw id framebuffer bytes into (slot, gen, instance, hit)"""
+    return tuple(int(val) for val in np.frombuffer(pixel_data, dtype=np.uint32)[:4])
+
+
+class PickingPass(object):
+    """Persistent render pass used for GPU accelerated selection
+
+    The scene is drawn into an unsigned integer framebuffer where each pixel stores
+    [entity_id_slot, entity_id_gen, instance_number, hit_value]. One select program is shared per
+    vertex variant, so clicking never compiles shaders or touches the meshes' own programs.
+
+    When scissored, only a tiny region around the cursor is drawn using a narrowed projection, so
+    almost nothing is rasterized or shaded. Picks can also be requested asynchronously, in which case
+    the pixel is copied into a pixel buffer object and read back a frame or two later in update()
+    instead of stalling the pipeline.
+
+    Attributes:
+        window (Window): window with the scene to pick from
+        framebuffer (moderngl.Framebuffer): full window id framebuffer used when not scissored
+        region_framebuffer (moderngl.Framebuffer): small id framebuffer for scissored picks
+        select_programs (dict): vertex variant -> shared FrameSelectProgram
+        scissored (bool): whether to only draw the region around the cursor
+        pending (list): asynchronous picks waiting on readback as (frame they can be read in, pbo, callback)
+        last_time (float): seconds spent in the most recent pick
+    """
+
+    def __init__(self, wnd):
+        self.window = wnd
+        self.ctx = wnd.ctx
+        self.framebuffer = None
+        self.region_framebuffer = self.ctx.simple_framebuffer((PICK_REGION, PICK_REGION), dtype='u4')
+        self.select_programs = {}
+        self.frame_state = render.FrameState(self.ctx)  # Picks use their own projection
+        self.scissored = True
+        self.pending = []
+        self.free_buffers = []
+        self.frame = 0
+        self.last_time = 0.0
+        self.resize(wnd.wnd.width, wnd.wnd.height)
+
+    def resize(self, width, height):
+        """Recreate the id framebuffer to match the window size"""
+        if self.framebuffer is not None:
+            if self.framebuffer.size == (width, height):
+                return
+            self.framebuffer.release()
+        self.framebuffer = self.ctx.simple_framebuffer((width, height), dtype='u4')
+
+    def select_program(self, mesh):
+        """Get the shared select program for the mesh's vertex variant"""
+        num_instances = mesh.mesh_program.num_instances
+        variant = programs.vertex_variant(num_instances)
+        if variant not in self.select_programs:
+            self.select_programs[variant] = programs.FrameSelectProgram(self.window, num_instances)
+        return self.select_programs[variant]
+
+    def draw_scene(self, projection_matrix):
+        """Draw the whole scene into the currently bound framebuffer, using the window's draw list"""
+        camera_matrix = self.window.camera.matrix.astype('f4')
+        draw_list = self.window.draw_list
+        indices, _ = draw_list.visible(projection_matrix, camera_matrix)  # A narrowed pick culls almost everything
+
+        self.frame_state.update(projection_matrix, camera_matrix)
+        self.frame_state.use()
+        models = self.window.transform_store.world[draw_list.slots[indices]]
+        for index, model in zip(indices, models):
+            record = draw_list.records[index]
+            self.select_program(record.mesh).draw(
+                record.mesh,
+                projection_matrix=projection_matrix,
+                model_matrix=model,
+                camera_matrix=camera_matrix
+            )
+
+    def draw_pick(self, x, y):
+        """Draw the scene for a pick at window coordinates (x, y)
+
+        Returns:
+            tuple: framebuffer that was drawn into and the viewport holding the picked pixel
+        """
+        projection_matrix = self.window.camera.projection.matrix.astype('f4')
+        width, height = self.framebuffer.size
+        y = height - 1 - y  # Framebuffer origin is at the bottom
+
+        previous = self.ctx.fbo
+        if self.scissored:
+            framebuffer = self.region_framebuffer
+            narrowed = pick_matrix(x + .5, y + .5, width, height)
+            projection_matrix = np.matmul(projection_matrix, narrowed).astype('f4')
+            center = PICK_REGION // 2
+            viewport = (center, center, 1, 1)
+        else:
+            framebuffer = self.framebuffer
+            viewport = (x, y, 1, 1)
+
+        # Scissor to the picked pixel so nothing else gets shaded, the GUI may have changed state since the frame.
+        # State is set to something known again so the meshes' enables can be skipped, blending means nothing for ids.
+        self.window.gl_state.reset()
+        self.window.gl_state.enable_only(moderngl.DEPTH_TEST | moderngl.CULL_FACE)
+        framebuffer.use()
+        framebuffer.clear()
+        framebuffer.scissor = viewport
+        self.draw_scene(projection_matrix)
+        framebuffer.scissor = None
+        previous.use()
+        return framebuffer, viewport
+
+    def pick(self, x, y):
+        """Get the selection info under a window coordinate, waiting on the result
+
+        Returns:
+            tuple: (slot, gen, instance, hit) where a hit of 0 means nothing is under the cursor
+        """
+        start_time = time()
+        framebuffer, viewport = self.draw_pick(x, y)
+        pixel_data = framebuffer.read(components=4, viewport=viewport, dtype='u4')
+        self.last_time = time() - start_time
+        return decode_pixel(pixel_data)
+
+    def request(self, x, y, callback):
+        """Start a pick without waiting on the GPU
+
+        The pixel is copied into a pixel buffer object, and the callback is called from update() with
+        (slot, gen, instance, hit) once the copy has had time to finish, PICK_LATENCY frames later.
+        """
+        start_time = time()
+        framebuffer, viewport = self.draw_pick(x, y)
+        pbo = self.free_buffers.pop() if self.free_buffers else self.ctx.buffer(reserve=16)
+        framebuffer.read_into(pbo, viewport=viewport, components=4, dtype='u4')
+        self.pending.append((self.frame + PICK_LATENCY, pbo, callback))
+        self.last_time = time() - start_time
+
+    def update(self):
+        """Resolve asynchronous picks that are ready to read, then move on to the next frame
+
+        Called once a frame, a pick requested before the call is only read in the next frame's call.
+        """
+        while self.pending and self.pending[0][0] <= self.frame:
+            _, pbo, callback = self.pending.pop(0)
+            result = decode_pixel(pbo.read())
+            self.free_buffers.append(pbo)
+            callback(*result)
+        self.frame += 1
+
+
+@dataclass
+class RayHit:
+    """Result of casting a ray into the scene"""
+    entity_id: penne.EntityID
+    instance: int
+    distance: float
+    hit: int  # Same hit values as the select shader
+
+
+def morton_codes(points):
+    """Get 30 bit morton codes for points, used to sort primitives along a space filling curve"""
+    low, high = points.min(axis=0), points.max(axis=0)
+    extent = np.where(high - low > 0, high - low, 1.0)
+    cells = ((points - low) / extent * 1023).astype(np.uint64)
+
+    # Spread the 10 bits of each axis out so they can be interleaved
+    cells &= np.uint64(0x3ff)
+    cells = (cells | (cells << np.uint64(16))) & np.uint64(0x30000ff)
+    cells = (cells | (cells << np.uint64(8))) & np.uint64(0x300f00f)
+    cells = (cells | (cells << np.uint64(4))) & np.uint64(0x30c30c3)
+    cells = (cells | (cells << np.uint64(2))) & np.uint64(0x9249249)
+    return cells[:, 0] | (cells[:, 1] << np.uint64(1)) | (cells[:, 2] << np.uint64(2))
+
+
+def quat_transform(q, v):
+    """Rotate vectors the same way instance_vertex.glsl does, q is (x, y, z, w)"""
+    xyz, w = q[..., :3], q[..., 3:]
+    return v + 2.0 * np.cross(np.cross(v, xyz) + w * v, xyz)
+
+
+def intersect_boxes(origin, inv_direction, box_min, box_max, max_distance=np.inf):
+    """Slab test one ray against many boxes
+
+    Zero components in the direction give infinite inverses, callers should ignore invalid
+    floating point warnings since the NaNs that can come from 0 * inf are skipped by fmin and fmax.
+
+    Returns:
+        tuple: mask of boxes that were hit and the entry distance for each box
+    """
+    t1 = (box_min - origin) * inv_direction
+    t2 = (box_max - origin) * inv_direction
+    t_near = np.fmax.reduce(np.fmin(t1, t2), axis=1)
+    t_far = np.fmin.reduce(np.fmax(t1, t2), axis=1)
+    hit = (t_far >= np.maximum(t_near, 0.0)) & (t_near <= max_distance)
+    return hit, t_near
+
+
+def intersect_triangles(origin, direction, v0, e1, e2):
+    """Moller-Trumbore test of one ray against many triangles, both faces count
+
+    Returns:
+        np.ndarray: distance along the ray for each triangle, inf where there is no hit
+    """
+    p = np.cross(direction, e2)
+    det = np.einsum('ij,ij->i', e1, p)
+    valid = np.abs(det) > 1e-12
+    inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=valid)
+
+    s = origin - v0
+    u = np.einsum('ij,ij->i', s, p) * inv_det
+    q = np.cross(s, e1)
+    v = np.einsum('j,ij->i', direction, q) * inv_det
+    t = np.einsum('ij,ij->i', e2, q) * inv_det
+
+    hit = valid & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > 1e-7)
+    return np.where(hit, t, np.inf)
+
+
+class BoundsTree(object):
+    """Linear bounding volume hierarchy over axis aligned boxes
+
+    Primitives are sorted along a morton curve and grouped into leaves of leaf_size, then the tree
+    is a complete binary tree over the leaves stored level by level. Building is a single sort plus
+    a few reductions per level, and queries walk every node of a level at once, so nothing loops
+    in Python per primitive or per node.
+
+    Attributes:
+        order (np.ndarray): primitive index for each sorted position
+        levels (list): (min, max) bounds arrays for each level, root first
+        leaf_size (int): max primitives per leaf
+    """
+
+    def __init__(self, box_min, box_max, leaf_size=8):
+        count = len(box_min)
+        self.leaf_size = leaf_size
+        self.count = count
+        self.order = np.argsort(morton_codes((box_min + box_max) * 0.5), kind='stable')
+
+        # Leaf bounds, padded out to a power of two with empty boxes that can never be hit
+        starts = np.arange(0, count, leaf_size)
+        leaf_min = np.minimum.reduceat(box_min[self.order], starts, axis=0)
+        leaf_max = np.maximum.reduceat(box_max[self.order], starts, axis=0)
+        depth = int(np.ceil(np.log2(len(starts)))) if len(starts) > 1 else 0
+        padding = 2 ** depth - len(starts)
+        leaf_min = np.vstack([leaf_min, np.full((padding, 3), np.inf)])
+        leaf_max = np.vstack([leaf_max, np.full((padding, 3), -np.inf)])
+
+        # Reduce pairs of children up to the root
+        self.levels = [(leaf_min, leaf_max)]
+        while len(self.levels[0][0]) > 1:
+            child_min, child_max = self.levels[0]
+            self.levels.insert(0, (np.minimum(child_min[0::2], child_min[1::2]),
+                                   np.maximum(child_max[0::2], child_max[1::2])))
+
+    @property
+    def bounds(self):
+        """Bounds of everything in the tree as (min, max)"""
+        root_min, root_max = self.levels[0]
+        return root_min[0], root_max[0]
+
+    def query(self, origin, direction, max_distance=np.inf):
+        """Get sorted positions of primitives in leaves hit by a ray
+
+        Returns:
+            tuple: positions into order for candidate primitives, and the entry distance of their leaf
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_direction = 1.0 / direction
+            nodes = np.zeros(1, dtype=np.int64)
+            t_near = np.zeros(1)
+            for depth, (level_min, level_max) in enumerate(self.levels):
+                hit, t_near = intersect_boxes(origin, inv_direction, level_min[nodes], level_max[nodes], max_distance)
+                nodes, t_near = nodes[hit], t_near[hit]
+                if depth < len(self.levels) - 1:
+                    nodes = (nodes[:, None] * 2 + np.arange(2)).ravel()
+
+        positions = (nodes[:, None] * self.leaf_size + np.arange(self.leaf_size)).ravel()
+        leaf_t = np.repeat(t_near, self.leaf_size)
+        valid = positions < self.count
+        return positions[valid], leaf_t[valid]
+
+
+class TriangleBVH(BoundsTree):
+    """Bounding volume hierarchy over a geometry's triangles in its local space
+
+    Built once when a patch is decoded, triangle corners are stored in tree order as one vertex and
+    two edges so intersection tests can run straight off of contiguous arrays.
+    """
+
+    def __init__(self, vertices, triangles, leaf_size=8):
+        corners = vertices[triangles]
+        super().__init__(corners.min(axis=1), corners.max(axis=1), leaf_size)
+        corners = corners[self.order]
+        self.v0 = corners[:, 0]
+        self.e1 = corners[:, 1] - corners[:, 0]
+        self.e2 = corners[:, 2] - corners[:, 0]
+
+    def intersect(self, origin, direction, max_distance=np.inf):
+        """Get the distance to the closest triangle hit by a ray, inf if there is none"""
+        if self.count == 0:
+            return np.inf
+        positions, _ = self.query(origin, direction, max_distance)
+        if len(positions) == 0:
+            return np.inf
+        t = intersect_triangles(origin, direction, self.v0[positions], self.e1[positions], self.e2[positions])
+        return t.min()
+
+
+def vao_positions(vao):
+    """Read vertex positions back out of a VAO, used for meshes loaded from files like widgets"""
+    for buffer_info in vao._buffers:
+        if not buffer_info.has_attribute("in_position"):
+            continue
+        floats = np.frombuffer(buffer_info.buffer.read(), np.float32)
+        floats = floats.reshape((-1, buffer_info.vertex_size // 4))
+        offset = 0
+        for attr_format, name in zip(buffer_info.attrib_formats, buffer_info.attributes):
+            if name == "in_position":
+                return floats[:, offset // 4:offset // 4 + 3]
+            offset += attr_format.bytes_total
+    return None
+
+
+class RayPicker(object):
+    """CPU selection by casting rays against bounding volume hierarchies
+
+    Each mesh with a TriangleBVH contributes one item per instance to a top level tree over world
+    space bounds. A ray walks the top level tree, then the closest candidates are tested against
+    their geometry's triangles in local space. Nothing here touches OpenGL, so it also works without
+    a framebuffer.
+
+    Attributes:
+        window (Window): window with the scene to pick from
+        tree (BoundsTree): top level tree over mesh and instance bounds
+        items (list): meshes in the tree, instances of a mesh each get their own box
+        last_time (float): seconds spent in the most recent pick
+    """
+
+    def __init__(self, wnd):
+        self.window = wnd
+        self.tree = None
+        self.items = []
+        self.item_meshes = None
+        self.item_instances = None
+        self.item_min = None
+        self.item_max = None
+        self.inverse_models = []
+        self.dirty = True
+        self.last_time = 0.0
+
+    def invalidate(self):
+        """Mark the top level tree as out of date, it is rebuilt on the next cast"""
+        self.dirty = True
+
+    @staticmethod
+    def instance_bounds(mesh, model):
+        """World space boxes for every instance of a mesh"""
+        local_min, local_max = mesh.bvh.bounds
+        center, radius = (local_min + local_max) * 0.5, np.linalg.norm(local_max - local_min) * 0.5
+        model_scale = np.linalg.norm(model[:3, :3], axis=1).max()
+
+        instances = getattr(mesh, "instances", None)
+        if instances is None:
+            centers = center[None, :]
+            radii = np.array([radius])
+        else:
+            scales = instances[:, 3, :3]
+            centers = quat_transform(instances[:, 2], center * scales) + instances[:, 0, :3]
+            radii = radius * np.abs(scales).max(axis=1)
+
+        centers = np.matmul(centers, model[:3, :3]) + model[3, :3]
+        radii = (radii * model_scale)[:, None]
+        return centers - radii, centers + radii
+
+    def refresh(self):
+        """Rebuild the top level tree from the current scene"""
+        box_mins, box_maxs = [], []
+        self.items = []
+        self.inverse_models = []
+        item_meshes, item_instances = [], []
+        seen = set()
+        for node in self.window.scene.nodes:
+            mesh = node.mesh
+            if mesh is None or getattr(mesh, "bvh", None) is None or node.matrix_global is None:
+                continue
+
+            # Entity preview meshes usually sit right on top of their patch mesh, only keep one
+            model = np.asarray(node.matrix_global, np.float64)
+            key = (tuple(mesh.entity_id), id(mesh.bvh), model.tobytes())
+            if key in seen:
+                continue
+            seen.add(key)
+
+            box_min, box_max = self.instance_bounds(mesh, model)
+            box_mins.append(box_min)
+            box_maxs.append(box_max)
+            item_meshes.append(np.full(len(box_min), len(self.items)))
+            item_instances.append(np.arange(len(box_min)))
+            self.items.append(mesh)
+            self.inverse_models.append(np.linalg.inv(model))
+
+        if self.items:
+            self.item_min, self.item_max = np.vstack(box_mins), np.vstack(box_maxs)
+            self.tree = BoundsTree(self.item_min, self.item_max)
+            self.item_meshes = np.concatenate(item_meshes)
+            self.item_instances = np.concatenate(item_instances)
+        else:
+            self.tree = None
+        self.dirty = False
+
+    def cast(self, origin, direction):
+        """Find the closest mesh along a world space ray
+
+        Returns:
+            RayHit: info about the closest hit, or None if nothing was hit
+        """
+        if self.dirty:
+            self.refresh()
+        if self.tree is None:
+            return None
+
+        origin = np.asarray(origin, np.float64)
+        direction = np.asarray(direction, np.float64)
+        direction = direction / np.linalg.norm(direction)
+
+        # Candidates from the top level, then exact box tests sorted closest first so farther ones can be skipped
+        positions, _ = self.tree.query(origin, direction)
+        candidates = self.tree.order[positions]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hit, t_near = intersect_boxes(origin, 1.0 / direction, self.item_min[candidates],
+                                          self.item_max[candidates])
+        sorting = np.argsort(t_near[hit])
+        candidates = candidates[hit][sorting]
+        t_near = t_near[hit][sorting]
+
+        best, best_item = np.inf, None
+        for candidate, entry in zip(candidates, t_near):
+            if entry > best:
+                break
+            mesh_index, instance = self.item_meshes[candidate], self.item_instances[candidate]
+            mesh = self.items[mesh_index]
+
+            # Bring ray into the mesh's local space, direction isn't normalized so distances stay in world units
+            inverse_model = self.inverse_models[mesh_index]
+            local_origin = np.matmul(np.append(origin, 1.0), inverse_model)[:3]
+            local_direction = np.matmul(direction, inverse_model[:3, :3])
+            instances = getattr(mesh, "instances", None)
+            if instances is not None:
+                inst = instances[instance].astype(np.float64)
+                inverse_rotation = inst[2] * np.array([-1.0, -1.0, -1.0, 1.0])
+                local_origin = quat_transform(inverse_rotation, local_origin - inst[0, :3]) / inst[3, :3]
+                local_direction = quat_transform(inverse_rotation, local_direction) / inst[3, :3]
+
+            distance = mesh.bvh.intersect(local_origin, local_direction, best)
+            if distance < best:
+                best, best_item = distance, (mesh, int(instance) if instances is not None else 0)
+
+        if best_item is None:
+            return None
+        mesh, instance = best_item
+        return RayHit(mesh.entity_id, instance, float(best), programs.HIT_VALUES.get(mesh.name, 1))
+
+    def pick(self, x, y):
+        """Get the selection info under a window coordinate by casting a ray from the camera
+
+        Returns:
+            tuple: (slot, gen, instance, hit) in the same format as PickingPass.pick
+        """
+        start_time = time()
+        origin = np.linalg.inv(self.window.camera.matrix)[3, :3]
+        direction = self.window.get_ray_from_click(x, y, world=False)
+        result = self.cast(origin, direction)
+        self.last_time = time() - start_time
+
+        if result is None:
+            return 0, 0, 0, 0
+        return result.entity_id.slot, result.entity_id.gen, result.instance, result.hit
@@ -0,0 +1,135 @@
+"""Module for Decoding Geometry off the Render Thread
+
+Loading a geometry happens in two stages. Worker threads do the CPU side decode, pulling arrays out
+of buffers, generating normals, and building picking BVHs, which is mostly NumPy work that releases
+the GIL. Finished patches are handed back to the render thread, which only has to upload them.
+"""
+
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+# Finished geometries handed to the scheduler per frame, spreads out uploads for big loads
+UPLOADS_PER_FRAME = 4
+
+
+@dataclass
+class DecodedPatch:
+    """GPU ready arrays for one patch, built on a worker thread
+
+    Attributes:
+        mode (int): moderngl primitive mode
+        indices (np.ndarray): flat index array to upload
+        index_size (int): bytes per index
+        buffers (list): (array, moderngl format, attribute names) for each vertex buffer
+        attributes (list): (semantic, attribute name, components) for the mesh's attribute info
+        bounding_sphere (tuple): local (center, radius) around the vertices
+        bvh (TriangleBVH): triangle BVH for CPU picking, None for points and lines
+        lods (list): simplified LevelOfDetails for big triangle patches, see lod.py
+    """
+    mode: int
+    indices: np.ndarray
+    index_size: int
+    buffers: list
+    attributes: list
+    bounding_sphere: tuple
+    bvh: Optional[object] = None
+    lods: list = field(default_factory=list)
+
+
+class LoadRequest(object):
+    """Callback waiting on a geometry to finish decoding, cancelled if its entity goes away first"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+        self.decoded = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finish(self, window):
+        """Scheduled on the render thread once decoding is done"""
+        if not self.cancelled:
+            self.callback(self.decoded)
+
+
+class DecodePipeline(object):
+    """Decodes geometry on a thread pool and uploads it on the render thread
+
+    Entities that need the same geometry while it's decoding wait on a single decode. With background
+    off, geometry is decoded inline like before, which is handy for debugging.
+
+    Attributes:
+        window (Window): window whose geometry cache patches end up in
+        executor (ThreadPoolExecutor): workers for decoding
+        pending (dict): GeometryID -> (geometry, future, requests) for decodes in flight
+        background (bool): whether to decode on worker threads
+    """
+
+    def __init__(self, window, max_workers=None):
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="orzo-decode")
+        self.pending = {}
+        self.background = True
+
+    def cached(self, geometry):
+        """Check whether every patch of a geometry is already uploaded"""
+        patches = self.window.geometry_cache.patches
+        return all((geometry.id, index) in patches for index in range(len(geometry.patches)))
+
+    def load(self, geometry, callback):
+        """Get a geometry ready to render, then call callback with its decoded patches
+
+        The callback runs on the render thread, right away if the geometry is already cached and
+        otherwise through the window's callback scheduler. Decoded patches are None if the geometry
+        was already cached, since nothing needs to be uploaded.
+
+        Returns:
+            LoadRequest: can be cancelled if the geometry is no longer needed
+        """
+        request = LoadRequest(callback)
+        if geometry.id not in self.pending and self.cached(geometry):
+            callback(None)
+            return request
+
+        if geometry.id not in self.pending:
+            if self.background:
+                future = self.executor.submit(geometry.decode, self.window)
+            else:
+                future = Future()
+                future.set_result(geometry.decode(self.window))
+            self.pending[geometry.id] = (geometry, future, [])
+        self.pending[geometry.id][2].append(request)
+
+        if not self.background:
+            self.update(limit=None)
+        return request
+
+    def update(self, limit=UPLOADS_PER_FRAME):
+        """Hand finished decodes to the entities waiting on them, called each frame on the render thread
+
+        Waiting entities are scheduled with the window's other callbacks so uploads share the frame budget.
+        """
+        finished = [key for key, (_, future, _) in self.pending.items() if future.done()]
+        for key in finished[:limit]:
+            geometry, future, requests = self.pending.pop(key)
+            decoded = future.result()
+            for request in requests:
+                request.decoded = decoded
+                self.window.callback_scheduler.add(request.finish)
+
+    def finish(self):
+        """Block until everything in flight is decoded and handed off"""
+        while self.pending:
+            for _, future, _ in list(self.pending.values()):
+                future.result()
+            self.update(limit=None)
+
+    def shutdown(self):
+        """Stop the workers without waiting on queued decodes"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending = {}
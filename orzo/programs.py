@@ -8,46 +8,156 @@ from moderngl_window.scene import MeshProgram
 from moderngl_window.geometry import sphere
 from PIL import Image
 
+from . import lighting, lod, render
+
 current_dir = os.path.dirname(__file__)
 
+# Shader variants -> source files, a compiled program is a (vertex, fragment) pair of these
+VERTEX_SHADERS = {
+    "base": "shaders/base_vertex.glsl",
+    "instance": "shaders/instance_vertex.glsl",
+    "batch": "shaders/batch_vertex.glsl"
+}
+FRAGMENT_SHADERS = {
+    "phong": "shaders/phong_fragment.glsl",
+    "select": "shaders/select_fragment.glsl"
+}
+
+
+# Mesh name -> hit value written by the select shader, 1 is a regular entity and 0 is no hit
+HIT_VALUES = {
+    "noo::widget_cone": 2,
+    "noo::widget_torus": 3,
+    "noo::widget_tab": 4
+}
+
+
+def vertex_variant(num_instances):
+    """Get the vertex shader variant for a mesh, -1 instances means no instancing"""
+    return "base" if num_instances == -1 else "instance"
+
+
+class ProgramRegistry(object):
+    """Shared programs and resources for a single context
+
+    Each shader variant is compiled the first time it is requested and then shared by every mesh that
+    uses it. The default texture, bounding sphere program, and culling programs are also created once
+    here, so mesh programs only need to hold cheap per-mesh state.
+
+    Attributes:
+        window (Window): window that owns the context
+        ctx (moderngl.Context): context programs are compiled in
+        programs (dict): (vertex variant, fragment variant) -> compiled program
+        uniforms (dict): (vertex variant, fragment variant) -> uniform name -> moderngl.Uniform
+    """
+
+    def __init__(self, wnd):
+        self.window = wnd
+        self.ctx = wnd.ctx
+        self.programs = {}
+        self.uniforms = {}
+        self._sources = {}
+        self._default_texture = None
+        self._bs_program = None
+        self._cull_program = None
+        self._proxy_program = None
+
+    def source(self, path):
+        """Get shader source, only reading each file from disk once"""
+        if path not in self._sources:
+            with open(os.path.join(current_dir, path), 'r') as f:
+                self._sources[path] = f.read()
+        return self._sources[path]
+
+    def get(self, vertex, fragment):
+        """Get the compiled program for a shader variant, compiling it if needed"""
+        key = (vertex, fragment)
+        program = self.programs.get(key)
+        if program is None:
+            program = self.ctx.program(
+                vertex_shader=self.source(VERTEX_SHADERS[vertex]),
+                fragment_shader=self.source(FRAGMENT_SHADERS[fragment])
+            )
+            # Frame state and lights are bound once a frame by the window
+            if "Frame" in program:
+                program["Frame"].binding = render.FRAME_BINDING
+            if "Lights" in program:
+                program["Lights"].binding = lighting.LIGHT_BINDING
+            for name, unit in lighting.LIGHT_SAMPLERS.items():
+                if name in program:
+                    program[name].value = unit
+            self.programs[key] = program
+
+            # Handles are looked up once here so drawing a mesh doesn't go through the name lookup
+            members = {name: program[name] for name in program}
+            self.uniforms[key] = {name: member for name, member in members.items()
+                                  if isinstance(member, moderngl.Uniform)}
+        return program
+
+    @property
+    def default_texture(self):
+        """Texture used by meshes without a material texture"""
+        if self._default_texture is None:
+            img = Image.open(os.path.join(current_dir, "resources/default.png"))
+            texture = self.ctx.texture(img.size, 4, img.tobytes())
+            texture.repeat_x, texture.repeat_y = False, False
+            self._default_texture = texture
+        return self._default_texture
+
+    @property
+    def bounding_sphere_program(self):
+        """Program for drawing bounding spheres"""
+        if self._bs_program is None:
+            self._bs_program = self.window.load_program(os.path.join(current_dir, "shaders/bounding_sphere.glsl"))
+        return self._bs_program
+
+    @property
+    def instance_cull_program(self):
+        """Transform feedback program that keeps the instances in view, see culling.InstanceCuller"""
+        if self._cull_program is None:
+            self._cull_program = self.ctx.program(
+                vertex_shader=self.source("shaders/instance_cull_vertex.glsl"),
+                geometry_shader=self.source("shaders/instance_cull_geometry.glsl"),
+                varyings=["out_position", "out_color", "out_rotation", "out_scale"]
+            )
+        return self._cull_program
+
+    @property
+    def occlusion_proxy_program(self):
+        """Program for the boxes drawn in occlusion queries, see culling.OcclusionCuller"""
+        if self._proxy_program is None:
+            self._proxy_program = self.ctx.program(
+                vertex_shader=self.source("shaders/occlusion_proxy_vertex.glsl"),
+                fragment_shader=self.source("shaders/occlusion_proxy_fragment.glsl")
+            )
+            self._proxy_program["Frame"].binding = render.FRAME_BINDING
+        return self._proxy_program
+
 
 class PhongProgram(MeshProgram):
     """Instance Rendering Program with Phong Shading
 
     Passes all necessary information to shaders and applies affects like highlighting and ghosting.
-    Draws bounding sphere if enabled. Also inputs the default lighting.
+    Draws bounding sphere if enabled. Lights, matrices from the camera, and shading parameters come from
+    uniform buffers the window binds each frame, so each mesh only sets its model matrix and material.
     """
-    current_camera_matrix = None
-    camera_position = None
 
     def __init__(self, wnd, num_instances, **kwargs):
         super().__init__(program=None)
         self.window = wnd
-        ctx = wnd.ctx
         self.num_instances = num_instances
 
-        # Bounding box shader if used
-        self.bs_program = wnd.load_program(os.path.join(current_dir, "shaders/bounding_sphere.glsl"))
+        # Compiled programs and default texture are shared through the window's registry
+        registry = wnd.program_registry
+        self.program = registry.get(vertex_variant(num_instances), "phong")
+        self.uniforms = registry.uniforms[(vertex_variant(num_instances), "phong")]
+        self.bs_program = registry.bounding_sphere_program
+        self.default_texture = registry.default_texture
 
-        # Vertex Shader
+        # Meshes without instances can be drawn together in batches, see render.Batch
         if num_instances == -1:
-            vertex_path = os.path.join(current_dir, "shaders/base_vertex.glsl")
-            vertex = open(vertex_path, 'r').read()
-        else:
-            vertex_path = os.path.join(current_dir, "shaders/instance_vertex.glsl")
-            vertex = open(vertex_path, 'r').read()
-
-        # Fragment Shader
-        fragment_path = os.path.join(current_dir, "shaders/phong_fragment.glsl")
-        fragment = open(fragment_path, 'r').read()
-
-        self.program = ctx.program(vertex_shader=vertex, fragment_shader=fragment)
-
-        # Set up default texture
-        img = Image.open(os.path.join(current_dir, "resources/default.png"))
-        texture = ctx.texture(img.size, 4, img.tobytes())
-        texture.repeat_x, texture.repeat_y = False, False
-        self.default_texture = texture
+            self.batch_program = registry.get("batch", "phong")
+            self.batch_uniforms = registry.uniforms[("batch", "phong")]
 
     def draw(
         self,
@@ -58,13 +168,9 @@ class PhongProgram(MeshProgram):
         time=0,
     ):
 
-        model_matrix = model_matrix.astype(np.float32, order='C')
-        self.program["m_proj"].write(projection_matrix)
-        self.program["m_model"].write(model_matrix)
-        self.program["m_cam"].write(camera_matrix)
-        self.program["shininess"].value = self.window.shininess
-        self.program["spec_strength"].value = self.window.spec_strength
-        self.program["ghosting"].value = mesh.ghosting
+        uniforms = self.uniforms
+        uniforms["m_model"].write(np.ascontiguousarray(model_matrix, np.float32))
+        uniforms["ghosting"].value = mesh.ghosting
 
         # Draw bounding box if enabled
         if self.window.draw_bs and mesh.has_bounding_sphere:
@@ -79,82 +185,71 @@ class PhongProgram(MeshProgram):
 
             # Make the VAO and render
             bs_vao = sphere(radius)
+            self.window.gl_state.use_program(self.bs_program)
             bs_vao.render(self.bs_program, mode=moderngl.LINES)
 
         # Add highlight effect if there is a selection, everything not selected gets a little dull
         selection = self.window.selected_entity
-        if selection is not None and selection.id != mesh.entity_id:
-            self.program["attention"].value = 0.5
-        else:
-            self.program["attention"].value = 1.0
-
-        # Only invert matrix / calculate camera position if camera is moved
-        if list(camera_matrix) != PhongProgram.current_camera_matrix:
-            camera_world = np.linalg.inv(camera_matrix)          
-            PhongProgram.current_camera_matrix = list(camera_matrix)
-            PhongProgram.camera_position = tuple(camera_world.m4[:3])
-            self.window.camera_position = [round(x, 2) for x in PhongProgram.camera_position]
-        self.program["camera_position"].value = PhongProgram.camera_position
-
-        # Feed Material in if present
+        self.apply_material(uniforms, mesh, 0.5 if selection is not None and selection.id != mesh.entity_id else 1.0)
+
+        self.window.gl_state.use_program(self.program)
+        draw_list, frame = self.window.draw_list, self.window.frame_state
+        levels = getattr(mesh, "lods", None) if draw_list.lod else None
+
+        # Big instanced meshes only draw the instances in view, bucketed by level of detail, see culling.InstanceCuller
+        culler = getattr(mesh, "instance_culler", None)
+        if culler is not None and draw_list.cull:
+            if levels:
+                starts = lod.thresholds(levels, frame.focal_pixels)
+                ranges = list(zip(np.r_[0.0, starts], np.r_[starts, np.inf]))
+            else:
+                ranges = [(0.0, np.inf)] + [(np.inf, np.inf)] * len(mesh.lods)
+            counts = culler.cull(model_matrix, frame.planes, frame.camera_position, ranges)
+            for vao, count in zip(mesh.culled_vaos, counts):
+                if count:
+                    vao.render(self.program, instances=count)
+            return
+
+        # Everything else draws the level for its distance from the camera, level VAOs have no instance buffer
+        vao = mesh.vao
+        if levels and self.num_instances == -1:
+            distance = lod.mesh_distance(mesh.local_sphere, model_matrix, frame.camera_position)
+            level = lod.select(levels, distance, frame.focal_pixels)
+            if level:
+                vao = levels[level - 1].vao
+        num_instances = 1 if self.num_instances == -1 else self.num_instances
+        vao.render(self.program, instances=num_instances)
+
+    def draw_batch(self, batch):
+        """Draw every mesh in a render.Batch with one instanced draw, the batch's buffer should be up to date"""
+        uniforms = self.batch_uniforms
+        uniforms["ghosting"].value = False
+        self.apply_material(uniforms, batch.mesh, 0.5 if self.window.selected_entity is not None else 1.0)
+        self.window.gl_state.use_program(self.batch_program)
+        batch.vao.render(self.batch_program, instances=batch.count)
+
+    def apply_material(self, uniforms, mesh, attention):
+        """Set the attention and material uniforms, state only changes when it differs from the last mesh"""
+        uniforms["attention"].value = attention
+        state = self.window.gl_state
         if mesh.material:
-            self.program["material_color"].value = tuple(mesh.material.color)
-            self.program["double_sided"].value = mesh.material.double_sided
+            uniforms["material_color"].value = tuple(mesh.material.color)
+            uniforms["double_sided"].value = mesh.material.double_sided
             if mesh.material.mat_texture:
-                mesh.material.mat_texture.texture.use()
+                state.texture(mesh.material.mat_texture.texture)
             else:
-                self.default_texture.use()
+                state.texture(self.default_texture)
         else:
-            self.program["material_color"].value = (1.0, 1.0, 1.0, 1.0)
-            self.program["double_sided"].value = False
-            self.default_texture.use()
-
-        # Set light values
-        lights = list(self.window.lights.values())
-        num_lights = len(lights)
-
-        # Default lighting
-        if self.window.default_lighting:
-            default_sun = {
-                "world_position": (0, 500, 1000),
-                "color": (1, 1, 1, 1),
-                "ambient": (.5, .5, .5),
-                "type": 2,
-                "info": (.9, -1, 0, 0),
-                "direction": (0, 0, 0)
-            }
-            second = {
-                "world_position": (0, 0, 4),
-                "color": (1, 1, 1, 1),
-                "ambient": (.1, .1, .1),
-                "type": 0,
-                "info": (1, -1, 0, 0),
-                "direction": (0, 0, 0)
-            }
-            lights.append(default_sun)
-            lights.append(second)
-            num_lights += 2
-
-        # Trim lights down if exceeding max amount for buffer in shader
-        # - smarter way to get closer ones could be implemented
-        if num_lights > 8:
-            num_lights = 8
-            lights = lights[:8]
-
-        self.program["num_lights"].value = num_lights
-        for i, light in zip(range(num_lights), lights):
-            for attr, val in light.items():
-                self.program[f"lights[{i}].{attr}"].value = val
+            uniforms["material_color"].value = (1.0, 1.0, 1.0, 1.0)
+            uniforms["double_sided"].value = False
+            state.texture(self.default_texture)
 
         # Hack to change culling for double_sided material
         if mesh.material.double_sided:
-            mesh.vao.ctx.disable(moderngl.CULL_FACE)
+            state.disable(moderngl.CULL_FACE)
         else:
-            mesh.vao.ctx.enable(moderngl.CULL_FACE)
+            state.enable(moderngl.CULL_FACE)
 
-        num_instances = 1 if self.num_instances == -1 else self.num_instances
-        mesh.vao.render(self.program, instances=num_instances)
-    
     def apply(self, mesh):
         return self
 
@@ -162,32 +257,20 @@ class PhongProgram(MeshProgram):
 class FrameSelectProgram(MeshProgram):
     """Render scene to frame buffer for selection
 
-    Really simple render but instead of 'color' there is a vec4 of the following format
+    Really simple render but instead of 'color' there is a uvec4 of the following format
     [entity_id_slot, entity_id_gen, instance_number, hit_value]
-    """
 
-    current_camera_matrix = None
-    camera_position = None
+    One of these is shared per vertex variant by the picking pass, so the number of instances to draw
+    comes from the mesh's own program instead of being stored here. Matrices from the camera come from
+    the picking pass's own frame state.
+    """
 
     def __init__(self, wnd, num_instances, **kwargs):
         super().__init__(program=None)
         self.window = wnd
-        ctx = wnd.ctx
         self.num_instances = num_instances
-
-        # Vertex Shader
-        if num_instances == -1:
-            vertex_path = os.path.join(current_dir, "shaders/base_vertex.glsl")
-            vertex = open(vertex_path, 'r').read()
-        else:
-            vertex_path = os.path.join(current_dir, "shaders/instance_vertex.glsl")
-            vertex = open(vertex_path, 'r').read()
-
-        # Fragment Shader
-        fragment_path = os.path.join(current_dir, "shaders/select_fragment.glsl")
-        fragment = open(fragment_path, 'r').read()
-
-        self.program = ctx.program(vertex_shader=vertex, fragment_shader=fragment)
+        self.program = wnd.program_registry.get(vertex_variant(num_instances), "select")
+        self.uniforms = wnd.program_registry.uniforms[(vertex_variant(num_instances), "select")]
 
     def draw(
             self,
@@ -198,37 +281,24 @@ class FrameSelectProgram(MeshProgram):
             time=0,
     ):
 
-        model_matrix = model_matrix.astype(np.float32, order='C')
-        self.program["m_proj"].write(projection_matrix)
-        self.program["m_model"].write(model_matrix)
-        self.program["m_cam"].write(camera_matrix)
-        self.program["id"].value = tuple(mesh.entity_id)
+        uniforms = self.uniforms
+        uniforms["m_model"].write(np.ascontiguousarray(model_matrix, np.float32))
+        uniforms["id"].value = tuple(mesh.entity_id)
 
         # Set flag for widget or actual entity - hit value is zero anywhere there is no mesh
-        if mesh.name == "noo::widget_cone":
-            self.program["hit_value"].value = 2
-        elif mesh.name == "noo::widget_torus":
-            self.program["hit_value"].value = 3
-        elif mesh.name == "noo::widget_tab":
-            self.program["hit_value"].value = 4
-        else:
-            self.program["hit_value"].value = 1
-
-        # Only invert matrix / calculate camera position if camera is moved
-        if list(camera_matrix) != FrameSelectProgram.current_camera_matrix:
-            camera_world = np.linalg.inv(camera_matrix)
-            FrameSelectProgram.current_camera_matrix = list(camera_matrix)
-            FrameSelectProgram.camera_position = tuple(camera_world.m4[:3])
-        self.program["camera_position"].value = FrameSelectProgram.camera_position
+        uniforms["hit_value"].value = HIT_VALUES.get(mesh.name, 1)
 
         # Hack to change culling for double_sided material
+        state = self.window.gl_state
         if hasattr(mesh.material, "double_sided") and mesh.material.double_sided:
-            mesh.vao.ctx.disable(moderngl.CULL_FACE)
+            state.disable(moderngl.CULL_FACE)
         else:
-            mesh.vao.ctx.enable(moderngl.CULL_FACE)
-        mesh.vao.ctx.enable(moderngl.DEPTH_TEST)
+            state.enable(moderngl.CULL_FACE)
+        state.enable(moderngl.DEPTH_TEST)
+        state.use_program(self.program)
 
-        num_instances = 1 if self.num_instances == -1 else self.num_instances
+        num_instances = mesh.mesh_program.num_instances if mesh.mesh_program else self.num_instances
+        num_instances = 1 if num_instances == -1 else num_instances
         mesh.vao.render(self.program, instances=num_instances)
 
     def apply(self, mesh):
@@ -0,0 +1,113 @@
+"""Module for Indexing the Scene's Nodes and Meshes
+
+moderngl_window keeps nodes, meshes, and children in plain lists, so every removal and name lookup
+is a linear scan. A server clearing a big scene removes every entity one at a time, which makes that
+quadratic. These containers keep the same interface backed by insertion ordered dicts instead.
+"""
+
+from itertools import islice
+
+
+class NodeList(object):
+    """Ordered collection with O(1) append, remove, and membership, iterates like a list
+
+    Items are keyed by identity, so each object can only be in the list once.
+    """
+
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+
+    def append(self, item):
+        self._items[item] = None
+
+    def remove(self, item):
+        try:
+            del self._items[item]
+        except KeyError:
+            raise ValueError(f"{item} not in list") from None
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def __getitem__(self, index):
+        """Positional access is linear, only meant for small lists like a node's few children"""
+        if isinstance(index, slice):
+            return list(self._items)[index]
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("list index out of range")
+        return next(islice(self._items, index, None))
+
+    def __repr__(self):
+        return f"NodeList({list(self._items)})"
+
+
+class SceneRegistry(object):
+    """Indexes for a scene's nodes so lookups and removals don't scan the whole scene
+
+    The window hands nodes and meshes to the mglw scene through these, so the scene iterates them
+    like it did its lists.
+
+    Attributes:
+        nodes (NodeList): every node in the scene, backs scene.nodes
+        meshes (NodeList): every mesh in the scene, backs scene.meshes
+        names (dict): node name -> NodeList of nodes with that name
+        entities (dict): entity id -> the entity's node
+    """
+
+    def __init__(self):
+        self.nodes = NodeList()
+        self.meshes = NodeList()
+        self.names = {}
+        self.entities = {}
+
+    def add(self, node, entity_id=None):
+        """Index a node and its mesh"""
+        self.nodes.append(node)
+        if node.mesh is not None:
+            self.meshes.append(node.mesh)
+        self.names.setdefault(node.name, NodeList()).append(node)
+        if entity_id is not None:
+            node.entity_id = entity_id  # Like meshes, so the node can be dropped from the index later
+            self.entities[entity_id] = node
+
+    def remove(self, node):
+        """Drop a node and its mesh from every index"""
+        self.nodes.remove(node)
+        if node.mesh is not None:
+            self.meshes.remove(node.mesh)
+
+        named = self.names.get(node.name)
+        if named is not None:
+            named.discard(node)
+            if not named:
+                del self.names[node.name]
+
+        entity_id = getattr(node, "entity_id", None)
+        if entity_id is not None and self.entities.get(entity_id) is node:
+            del self.entities[entity_id]
+
+    def find(self, name):
+        """Get the first node added with a name, None if there isn't one"""
+        named = self.names.get(name)
+        return next(iter(named)) if named else None
+
+    def entity_node(self, entity_id):
+        """Get the node for an entity, None if it isn't in the scene"""
+        return self.entities.get(entity_id)
@@ -0,0 +1,463 @@
+"""Module for Drawing the Scene from a Flattened Draw List
+
+Scene.draw walks the node tree in Python every frame, going through Node.draw and Mesh.draw for every
+node just to reach the mesh programs. The draw list does that walk once when the scene's structure
+changes and keeps a flat list of what to draw, so a frame is a single loop over prepared records.
+Uniforms that don't change from mesh to mesh are written once a frame to a uniform buffer instead,
+and GL state goes through a tracker that drops calls setting what is already set. Meshes that only
+differ by their transform are gathered into batches and drawn as instances of one mesh.
+"""
+
+from collections import Counter
+
+import numpy as np
+import moderngl
+
+from . import culling
+
+# Uniform block binding for the Frame block, lights use 0
+FRAME_BINDING = 1
+
+# Floats in the Frame block: two mat4s, the camera position, and the shading parameters
+FRAME_FLOATS = 40
+
+# Fewest meshes sharing a patch and material that get drawn as a batch
+BATCH_MIN_MESHES = 4
+
+# When more of a batch's meshes moved than this, its whole buffer is written at once
+BATCH_ROW_WRITES = 32
+
+
+class FrameState(object):
+    """Uniforms shared by every mesh in a frame, kept in a std140 uniform buffer
+
+    The layout matches the Frame block in the shaders: projection matrix, camera matrix, camera
+    position, then shininess and specular strength. The camera is only inverted when it moves, and
+    the buffer is only written when something changed.
+
+    Attributes:
+        buffer (moderngl.Buffer): uniform buffer bound to FRAME_BINDING
+        camera_position (np.ndarray): world position of the camera
+        planes (np.ndarray): world space frustum planes, see culling.frustum_planes
+        focal_pixels (float): vertical focal length in pixels of the framebuffer being drawn to, something
+            r across at distance d covers about r * focal_pixels / d pixels
+        writes (int): number of times the buffer has been written
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.buffer = ctx.buffer(reserve=FRAME_FLOATS * 4)
+        self.camera_position = np.zeros(3, np.float32)
+        self.planes = None
+        self.focal_pixels = 1.0
+        self.writes = 0
+        self._camera = None
+        self._data = None
+
+    def update(self, projection_matrix, camera_matrix, shininess=0.0, spec_strength=0.0):
+        """Write this frame's uniforms if they changed since the last frame"""
+        camera = np.asarray(camera_matrix, np.float32)
+        if self._camera is None or not np.array_equal(camera, self._camera):
+            self._camera = camera.copy()
+            self.camera_position = np.linalg.inv(camera)[3, :3]
+        self.focal_pixels = float(projection_matrix[1][1]) * self.ctx.fbo.viewport[3] / 2
+
+        data = np.zeros(FRAME_FLOATS, np.float32)
+        data[:16] = np.asarray(projection_matrix, np.float32).ravel()
+        data[16:32] = camera.ravel()
+        data[32:35] = self.camera_position
+        data[36:38] = shininess, spec_strength
+        if self._data is None or not np.array_equal(data, self._data):
+            self.buffer.write(data)
+            self.planes = culling.frustum_planes(projection_matrix, camera)
+            self._data = data
+            self.writes += 1
+
+    def use(self):
+        """Bind the buffer for the draws that follow"""
+        self.buffer.bind_to_uniform_block(FRAME_BINDING)
+
+
+class StateTracker(object):
+    """Layer over the context that skips enables, blend changes, and texture binds that change nothing
+
+    The tracker only knows about state set through it, so it forgets everything with reset whenever
+    other code may have touched the context, like the GUI renderer between frames. moderngl binds the
+    program itself for every render, so program switches are only counted, which is what matters when
+    ordering draws.
+
+    Attributes:
+        ctx (moderngl.Context): context calls are passed on to
+        issued (Counter): kind of call -> calls passed on to the context this frame
+        skipped (Counter): kind of call -> redundant calls dropped this frame
+        last_frame (tuple): issued and skipped counters from the previous frame
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.issued = Counter()
+        self.skipped = Counter()
+        self.last_frame = (Counter(), Counter())
+        self.reset()
+
+    def reset(self):
+        """Forget the known state so the next call of each kind goes through"""
+        self.flags = None
+        self.blend = None
+        self.textures = {}
+        self.program = None
+
+    def begin_frame(self):
+        """Start counting a new frame, state is reset since the GUI draws in between"""
+        self.last_frame = (self.issued, self.skipped)
+        self.issued, self.skipped = Counter(), Counter()
+        self.reset()
+
+    def count(self, kind, changed):
+        if changed:
+            self.issued[kind] += 1
+        else:
+            self.skipped[kind] += 1
+        return changed
+
+    def enable_only(self, flags):
+        """Enable exactly the given flags, like ctx.enable_only"""
+        if self.count("enable", flags != self.flags):
+            self.ctx.enable_only(flags)
+            self.flags = flags
+
+    def enable(self, flag):
+        if self.flags is None:
+            self.count("enable", True)
+            self.ctx.enable(flag)
+        elif self.count("enable", not self.flags & flag):
+            self.ctx.enable(flag)
+            self.flags |= flag
+
+    def disable(self, flag):
+        if self.flags is None:
+            self.count("enable", True)
+            self.ctx.disable(flag)
+        elif self.count("enable", self.flags & flag):
+            self.ctx.disable(flag)
+            self.flags &= ~flag
+
+    def blend_func(self, *func):
+        if self.count("blend", func != self.blend):
+            self.ctx.blend_func = func
+            self.blend = func
+
+    def texture(self, texture, location=0):
+        """Bind a texture to a unit unless it's already there"""
+        if self.count("texture", self.textures.get(location) != texture.glo):
+            texture.use(location=location)
+            self.textures[location] = texture.glo
+
+    def use_program(self, program):
+        """Note the program the next draw uses, see the class docstring"""
+        if self.count("program", program.glo != self.program):
+            self.program = program.glo
+
+
+def state_key(record):
+    """Sort key that puts draws sharing a program, texture, and material next to each other"""
+    material = record.mesh.material
+    texture = getattr(material, "mat_texture", None)
+    return (
+        record.program.program.glo,
+        texture.texture.glo if texture is not None else 0,
+        getattr(material, "double_sided", False),
+        id(material),
+    )
+
+
+class DrawRecord(object):
+    """One mesh to draw each frame
+
+    Attributes:
+        node (TransformNode): node the mesh hangs off, its global matrix is the model matrix
+        mesh (mglw.scene.Mesh): mesh to draw
+        program (MeshProgram): the mesh's program, does the actual drawing
+        slot (int): the node's slot in the window's transform store
+    """
+    __slots__ = ("node", "mesh", "program", "slot")
+
+    def __init__(self, node, mesh):
+        self.node = node
+        self.mesh = mesh
+        self.program = mesh.mesh_program
+        self.slot = node.slot
+
+
+class Batch(object):
+    """Meshes sharing a patch and material, drawn together as instances of one mesh
+
+    Each frame the world matrices of the members in view are packed into an instance buffer. When the
+    same members are in view as last frame, only the rows for members that moved are written.
+
+    Attributes:
+        mesh (mglw.scene.Mesh): first member's mesh, its patch and material are used for the whole batch
+        program (PhongProgram): first member's program, draws the batch with its batch variant
+        indices (np.ndarray): record index of each member
+        buffer (moderngl.Buffer): world matrices of the members drawn last frame
+        vao (VAO): the patch's buffers with the matrices as per instance attributes
+        members (np.ndarray): record indices of the members in the buffer, in order
+        count (int): number of members in the buffer
+        rows_written (int): number of matrices written to the buffer so far
+    """
+
+    def __init__(self, ctx, records, indices):
+        first = records[indices[0]]
+        self.mesh = first.mesh
+        self.program = first.program
+        self.indices = indices
+        self.buffer = ctx.buffer(reserve=len(indices) * culling.INSTANCE_BYTES)
+        self.vao = self.mesh.resources.instanced_vao()
+        self.vao.buffer(self.buffer, "16f/i", "instance_model")
+        self.members = np.zeros(0, np.int64)
+        self.count = 0
+        self.rows_written = 0
+        self._matrices = None
+
+    def update(self, members, matrices):
+        """Put the world matrices of the members to draw this frame in the buffer"""
+        matrices = np.ascontiguousarray(matrices, np.float32)
+        if len(members) != self.count or not np.array_equal(members, self.members):
+            self.buffer.write(matrices)
+            self.rows_written += len(members)
+        else:
+            moved = np.flatnonzero((matrices != self._matrices).reshape(len(matrices), 16).any(axis=1))
+            if len(moved) > BATCH_ROW_WRITES:
+                self.buffer.write(matrices)
+                self.rows_written += len(members)
+            else:
+                for row in moved:
+                    self.buffer.write(matrices[row], offset=row * culling.INSTANCE_BYTES)
+                self.rows_written += len(moved)
+        self.members, self.count, self._matrices = members, len(members), matrices
+
+
+def batch_key(record):
+    """Key shared by meshes that can be drawn as one batch, None if the mesh can't be batched
+
+    Only meshes without instances or levels of detail are batched, and they have to use the same
+    patch, which non instanced meshes share the VAO of, and the same material.
+    """
+    mesh = record.mesh
+    if getattr(mesh, "resources", None) is None or getattr(mesh, "lods", None):
+        return None
+    if getattr(record.program, "num_instances", None) != -1:
+        return None
+    return id(mesh.vao), id(mesh.material)
+
+
+class DrawList(object):
+    """Flattened scene rebuilt whenever nodes are added or removed
+
+    Records are sorted by program, texture, and material so state changes as little as possible
+    between draws, turning sorting off only groups them by program and keeps the scene's order.
+    Ghosted meshes are translucent, so they're held back each frame and drawn after everything else,
+    farthest first. Meshes outside the view are culled with their bounding spheres, and with occlusion
+    turned on so are meshes that were hidden behind others last frame, see culling.py.
+    Model matrices are gathered from the transform store in one go each frame instead of node by node.
+
+    Meshes that share a patch and material are drawn in batches, one instanced draw each. Ghosted
+    meshes and the selected entity's meshes stand out from the rest, so they're drawn on their own.
+    Picking still draws mesh by mesh, so picks resolve to the original entity.
+
+    Attributes:
+        window (Window): window whose scene is drawn
+        records (list): DrawRecords in draw order
+        slots (np.ndarray): transform store slot for each record
+        centers (np.ndarray): local bounding sphere center for each record
+        radii (np.ndarray): local bounding sphere radius for each record
+        sort (bool): whether to sort by state or only by program
+        cull (bool): whether to skip meshes outside the view
+        occlusion (bool): whether to skip meshes hidden behind others
+        lod (bool): whether big meshes are drawn with less detail farther away, see lod.py
+        batching (bool): whether meshes sharing a patch and material are drawn as batches
+        batches (list): Batches of records, rebuilt with the list
+        batch_of (np.ndarray): index into batches for each record, -1 if it isn't in one
+        dirty (bool): whether the scene changed since the list was built
+        builds (int): number of times the list has been rebuilt
+        translucent (int): number of ghosted meshes drawn last frame
+        drawn (int): number of meshes drawn last frame
+        culled (int): number of meshes culled last frame
+        occluded (int): number of draws avoided by occlusion queries last frame
+        tested (int): number of nodes tested against the view last frame
+        batched (int): number of meshes drawn in batches last frame
+        batch_draws (int): number of batched draws last frame
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.records = []
+        self.slots = np.zeros(0, np.int64)
+        self.centers = np.zeros((0, 3))
+        self.radii = np.zeros(0)
+        self.sort = True
+        self.cull = True
+        self.occlusion = False
+        self.lod = True
+        self.batching = True
+        self.batches = []
+        self.batch_of = np.zeros(0, np.int64)
+        self.dirty = True
+        self.builds = 0
+        self.translucent = 0
+        self.drawn = 0
+        self.culled = 0
+        self.occluded = 0
+        self.tested = 0
+        self.batched = 0
+        self.batch_draws = 0
+        self._bounds = None
+        self._bounds_key = None
+        self._occlusion_culler = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def invalidate(self):
+        """Rebuild before the next draw"""
+        self.dirty = True
+
+    def build(self):
+        """Walk the scene once and record every mesh with a program, then sort them"""
+        self.dirty = False  # Cleared first in case the scene changes while building
+        records = []
+        stack = list(reversed(self.window.scene.root_nodes))
+        while stack:
+            node = stack.pop()
+            mesh = node.mesh
+            if mesh is not None and mesh.mesh_program is not None:
+                records.append(DrawRecord(node, mesh))
+            stack.extend(reversed(list(node.children)))
+
+        records.sort(key=state_key if self.sort else lambda record: record.program.program.glo)
+        self.records = records
+        self.slots = np.fromiter((record.slot for record in records), np.int64, len(records))
+        unbounded = ((0.0, 0.0, 0.0), culling.UNBOUNDED)
+        spheres = [getattr(record.mesh, "local_sphere", None) or unbounded for record in records]
+        self.centers = np.array([center for center, _ in spheres], np.float32).reshape(-1, 3)
+        self.radii = np.array([radius for _, radius in spheres], np.float32)
+        self.build_batches()
+        self.builds += 1
+
+    def build_batches(self):
+        """Group records that can be drawn together, see Batch"""
+        groups = {}
+        if self.batching:
+            for index, record in enumerate(self.records):
+                key = batch_key(record)
+                if key is not None:
+                    groups.setdefault(key, []).append(index)
+        self.batches = [Batch(self.window.ctx, self.records, np.array(indices))
+                        for indices in groups.values() if len(indices) >= BATCH_MIN_MESHES]
+        self.batch_of = np.full(len(self.records), -1, np.int64)
+        for number, batch in enumerate(self.batches):
+            self.batch_of[batch.indices] = number
+
+    def visible(self, projection_matrix, camera_matrix):
+        """Indices of the records in view, all of them when culling is off
+
+        Returns:
+            tuple: indices and the number of nodes tested
+        """
+        if self.dirty:
+            self.build()
+        if not self.cull or not self.records:
+            return np.arange(len(self.records)), 0
+
+        planes = culling.frustum_planes(projection_matrix, camera_matrix)
+        store = self.window.transform_store
+        in_view, tested = culling.cull(store.parents, self.slots, self.bounds(), planes)
+        return np.flatnonzero(in_view), tested
+
+    def bounds(self):
+        """World space bounds of the records, only rebuilt when something moved, not when just the camera did"""
+        store = self.window.transform_store
+        key = (store.version, self.builds)
+        if key != self._bounds_key:
+            self._bounds = culling.Bounds(store, self.slots, self.centers, self.radii)
+            self._bounds_key = key
+        return self._bounds
+
+    def occlusion_culler(self):
+        if self._occlusion_culler is None:
+            window = self.window
+            self._occlusion_culler = culling.OcclusionCuller(window.ctx, window.program_registry.occlusion_proxy_program)
+        return self._occlusion_culler
+
+    def draw(self, projection_matrix, camera_matrix, time=0):
+        """Draw every record in view, global matrices should already be up to date"""
+        indices, self.tested = self.visible(projection_matrix, camera_matrix)
+        self.culled = len(self.records) - len(indices)
+
+        # Skip what was hidden last frame, but keep testing everything in view
+        self.occluded = 0
+        occlusion = self.occlusion and len(indices) > 0
+        if occlusion:
+            in_view = indices
+            key = (self.window.transform_store.version, self.builds)
+            hidden = self.occlusion_culler().hidden_mask(len(self.records), key)
+            indices = in_view[~hidden[in_view]]
+            self.occluded = len(in_view) - len(indices)
+        self.drawn = len(indices)
+
+        # Bounding spheres are drawn mesh by mesh, so batching is off while they're shown
+        batching = bool(self.batches) and not self.window.draw_bs
+        if batching:
+            selection = self.window.selected_entity
+            selected = selection.id if selection is not None else None
+            members = [[] for _ in self.batches]
+            batch_of = self.batch_of[indices].tolist()
+
+        models = self.window.transform_store.world[self.slots[indices]]
+        translucent = []
+        for position, index in enumerate(indices):
+            record = self.records[index]
+            if record.mesh.ghosting:
+                translucent.append(position)
+                continue
+            if batching and batch_of[position] >= 0 and record.mesh.entity_id != selected:
+                members[batch_of[position]].append(position)
+                continue
+            record.program.draw(
+                record.mesh,
+                projection_matrix=projection_matrix,
+                model_matrix=models[position],
+                camera_matrix=camera_matrix,
+                time=time,
+            )
+
+        self.batched = self.batch_draws = 0
+        if batching:
+            for batch, positions in zip(self.batches, members):
+                if positions:
+                    batch.update(indices[positions], models[positions])
+                    batch.program.draw_batch(batch)
+                    self.batched += len(positions)
+                    self.batch_draws += 1
+
+        # Test against the depth of the opaque meshes, translucent ones don't hide anything
+        if occlusion:
+            bounds = self.bounds()
+            frame = self.window.frame_state
+            self.window.gl_state.disable(moderngl.CULL_FACE)  # Both sides of the boxes count
+            self.occlusion_culler().query(in_view, bounds.centers, bounds.radii, frame.planes,
+                                          frame.camera_position)
+
+        # Back to front by the view space depth of each node's origin, more negative z is farther away
+        self.translucent = len(translucent)
+        if translucent:
+            depths = models[translucent, 3] @ np.asarray(camera_matrix, np.float32)[:, 2]
+            for position in np.asarray(translucent)[np.argsort(depths, kind="stable")]:
+                record = self.records[indices[position]]
+                record.program.draw(
+                    record.mesh,
+                    projection_matrix=projection_matrix,
+                    model_matrix=models[position],
+                    camera_matrix=camera_matrix,
+                    time=time,
+                )
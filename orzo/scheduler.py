@@ -0,0 +1,162 @@
+"""Module for Spreading Client Callbacks Across Frames
+
+The client thread queues a callback for every message it gets from the server, and these have to run
+on the render thread. Draining them all at once turns a burst of messages into one very long frame,
+so the scheduler runs as many as fit in a time budget each frame and carries the rest over.
+"""
+
+import logging
+from collections import deque
+from itertools import count
+from time import perf_counter
+
+# Callback name -> priority, lower runs first. Structure comes first so later work has nodes to attach to,
+# then meshes, then lights, and textures last since meshes can be drawn without them
+CALLBACK_PRIORITIES = {
+    "set_up_node": 0,
+    "update_matrices": 0,
+    "remove_from_render": 0,
+    "render_entity": 1,
+    "attach_lights": 2,
+    "update_lights": 2,
+    "remove_lights": 2,
+    "set_up_sampler": 3,
+    "set_up_texture": 3,
+}
+DEFAULT_PRIORITY = 1
+
+# Callbacks that refresh from the delegate's current state, so a new one is redundant while an equivalent
+# one is still waiting. Global ones do the same work no matter which delegate queued them
+COALESCED_CALLBACKS = {
+    "update_matrices": "global",
+    "update_lights": "delegate",
+    "render_entity": "delegate",
+}
+
+# Seconds per frame spent on callbacks
+FRAME_BUDGET = 0.008
+
+
+class ScheduledCallback(object):
+    """Callback waiting to run along with when it was queued"""
+
+    def __init__(self, callback, args, sequence, queued_time):
+        self.callback = callback
+        self.args = args
+        self.sequence = sequence
+        self.queued_time = queued_time
+        self.owner = id(getattr(callback, "__self__", callback))
+        name = getattr(callback, "__name__", "")
+        self.priority = CALLBACK_PRIORITIES.get(name, DEFAULT_PRIORITY)
+        self.done = False
+
+        # Key for finding an equivalent waiting callback
+        scope = COALESCED_CALLBACKS.get(name) if not args else None
+        if scope == "global":
+            self.key = (name,)
+        elif scope == "delegate":
+            self.key = (self.owner, name)
+        else:
+            self.key = None
+
+
+class CallbackScheduler(object):
+    """Runs queued client callbacks by priority within a per frame time budget
+
+    Priorities only reorder work between delegates. Callbacks for the same delegate always run in the
+    order they were queued, so a removal can't jump ahead of the render it's undoing. At least one
+    callback runs every frame so a budget that's too small still makes progress.
+
+    Redundant callbacks are coalesced as they come in. A full tree matrix update only runs once no
+    matter how many entities moved, and a delegate's refresh or rebuild is dropped if the same one is
+    already the last thing it has waiting, since that one will see the latest state when it runs.
+
+    Attributes:
+        budget (float): seconds per frame to spend on callbacks
+        queues (dict): priority -> deque of waiting callbacks
+        owners (dict): delegate id -> deque of its waiting callbacks, oldest first
+        coalesced (dict): coalescing key -> waiting callback
+        pending (int): number of callbacks waiting
+        dropped (int): total callbacks coalesced away
+        processed (int): callbacks run last frame
+        frame_time (float): seconds spent on callbacks last frame
+        latency (float): seconds the oldest callback run last frame spent waiting
+    """
+
+    def __init__(self, budget=FRAME_BUDGET):
+        self.budget = budget
+        self.queues = {}
+        self.owners = {}
+        self.coalesced = {}
+        self.pending = 0
+        self.dropped = 0
+        self.processed = 0
+        self.frame_time = 0.0
+        self.latency = 0.0
+        self._sequence = count()
+
+    def add(self, callback, args=()):
+        """Schedule a callback, it will be called with the window and args"""
+        scheduled = ScheduledCallback(callback, args, next(self._sequence), perf_counter())
+        if self.redundant(scheduled):
+            self.dropped += 1
+            return
+        if scheduled.key is not None:
+            self.coalesced[scheduled.key] = scheduled
+        self.queues.setdefault(scheduled.priority, deque()).append(scheduled)
+        self.owners.setdefault(scheduled.owner, deque()).append(scheduled)
+        self.pending += 1
+
+    def redundant(self, scheduled):
+        """Check whether an equivalent callback is waiting that will cover this one"""
+        waiting = self.coalesced.get(scheduled.key) if scheduled.key is not None else None
+        if waiting is None:
+            return False
+        if len(scheduled.key) == 1:
+            return True
+
+        # Only if nothing else for the delegate is queued after it, otherwise order could change
+        return self.owners[waiting.owner][-1] is waiting
+
+    def pull(self, callback_queue):
+        """Move everything the client has queued so far into the scheduler"""
+        while not callback_queue.empty():
+            callback, args = callback_queue.get()
+            self.add(callback, args)
+
+    def next(self):
+        """Get the next callback to run, the oldest one for the highest priority delegate"""
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue and queue[0].done:
+                queue.popleft()
+            if queue:
+                return self.owners[queue[0].owner][0]
+        return None
+
+    def take(self, scheduled):
+        """Mark a callback as run and drop it from its owner's line"""
+        scheduled.done = True
+        if scheduled.key is not None and self.coalesced.get(scheduled.key) is scheduled:
+            del self.coalesced[scheduled.key]
+        owner_queue = self.owners[scheduled.owner]
+        owner_queue.popleft()
+        if not owner_queue:
+            del self.owners[scheduled.owner]
+        self.pending -= 1
+
+    def run(self, window):
+        """Run callbacks until the budget for this frame is used up"""
+        start = perf_counter()
+        self.processed = 0
+        self.latency = 0.0
+        while self.pending:
+            scheduled = self.next()
+            self.take(scheduled)
+            self.latency = max(self.latency, start - scheduled.queued_time)
+            logging.debug("Callback in render: %s w/ args: %s", scheduled.callback, scheduled.args)
+            scheduled.callback(window, *scheduled.args)
+            self.processed += 1
+            if perf_counter() - start > self.budget:
+                break
+        self.frame_time = perf_counter() - start
@@ -5,10 +5,14 @@ in vec3 in_normal;
 in vec2 in_texture;
 in vec4 in_color;
 
-uniform mat4 m_proj;
+// Same for every mesh in a frame, see render.FrameState
+layout(std140) uniform Frame {
+    mat4 m_proj;
+    mat4 m_cam;
+    vec4 camera_position;  // xyz, w unused
+    vec4 shading;          // shininess, spec_strength
+};
 uniform mat4 m_model;
-uniform mat4 m_cam;
-uniform vec3 camera_position;
 
 out vec4 color;
 out vec3 normal;
@@ -26,7 +30,7 @@ void main() {
     normal = normalize(normal_matrix * in_normal);
     color = in_color;
     world_position = (m_model * local_position).xyz;
-    view_vector = camera_position - world_position;
+    view_vector = camera_position.xyz - world_position;
 
     // Used to normalize coordinates -> (0, 1) but has since been removed
     texcoord = in_texture;
@@ -0,0 +1,37 @@
+#version 330
+
+in mat4 instance_model;  // world matrix of each mesh in the batch, see render.Batch
+in vec3 in_position;
+in vec3 in_normal;
+in vec2 in_texture;
+in vec4 in_color;
+
+// Same for every mesh in a frame, see render.FrameState
+layout(std140) uniform Frame {
+    mat4 m_proj;
+    mat4 m_cam;
+    vec4 camera_position;  // xyz, w unused
+    vec4 shading;          // shininess, spec_strength
+};
+
+out vec4 color;
+out vec3 normal;
+out vec3 world_position;
+out vec2 texcoord;
+out vec3 view_vector;
+out float instance_id;
+
+void main() {
+
+    vec4 local_position = vec4(in_position, 1.0);
+    gl_Position = m_proj * m_cam * instance_model * local_position;
+
+    mat3 normal_matrix = mat3(instance_model);
+    normal = normalize(normal_matrix * in_normal);
+    color = in_color;
+    world_position = (instance_model * local_position).xyz;
+    view_vector = camera_position.xyz - world_position;
+    texcoord = in_texture;
+
+    instance_id = 0.0;
+}
@@ -0,0 +1,25 @@
+#version 330
+
+// Only emits instances that passed the test, so the captured buffer is compacted
+layout(points) in;
+layout(points, max_vertices = 1) out;
+
+in mat4 instance[];
+in float visible[];
+
+// Captured in this order, the same layout as the '16f/i' instance buffer
+out vec4 out_position;
+out vec4 out_color;
+out vec4 out_rotation;
+out vec4 out_scale;
+
+void main() {
+    if (visible[0] > 0.5) {
+        out_position = instance[0][0];
+        out_color = instance[0][1];
+        out_rotation = instance[0][2];
+        out_scale = instance[0][3];
+        EmitVertex();
+        EndPrimitive();
+    }
+}
@@ -0,0 +1,42 @@
+#version 330
+
+// Frustum test for one instance, see culling.InstanceCuller
+in mat4 instance_matrix;
+
+uniform mat4 m_model;
+uniform vec4 planes[6];        // world space frustum planes, inside is dot(xyz, p) + w >= 0
+uniform vec4 local_sphere;     // center and radius around the mesh's own vertices
+uniform float model_scale;     // largest scale in m_model
+uniform vec3 camera_position;
+uniform vec2 distance_range;   // only instances this far from the camera are kept, see lod.py
+
+out mat4 instance;
+out float visible;
+
+
+vec3 quat_transform(vec4 q, vec3 v){
+    return v + 2.0*cross(cross(v, q.xyz ) + q.w*v, q.xyz);
+}
+
+void main() {
+
+    // Same transform as instance_vertex.glsl applied to the sphere's center
+    vec3 scale = vec3(instance_matrix[3]);
+    vec3 center = quat_transform(instance_matrix[2], local_sphere.xyz * scale) + vec3(instance_matrix[0]);
+    vec3 world_center = (m_model * vec4(center, 1.0)).xyz;
+    float size = max(max(max(abs(scale.x), abs(scale.y)), abs(scale.z)) * model_scale, 1e-20);
+    float radius = local_sphere.w * size;
+
+    visible = 1.0;
+    for (int i = 0; i < 6; i++) {
+        if (dot(planes[i].xyz, world_center) + planes[i].w < -radius)
+            visible = 0.0;
+    }
+
+    // To the nearest point of the sphere in the mesh's own units, like lod.mesh_distance
+    float distance = max(length(world_center - camera_position) / size - local_sphere.w, 0.0);
+    if (distance < distance_range.x || distance >= distance_range.y)
+        visible = 0.0;
+
+    instance = instance_matrix;
+}
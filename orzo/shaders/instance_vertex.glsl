@@ -6,10 +6,14 @@ in vec3 in_normal;
 in vec2 in_texture;
 in vec4 in_color;
 
-uniform mat4 m_proj;
+// Same for every mesh in a frame, see render.FrameState
+layout(std140) uniform Frame {
+    mat4 m_proj;
+    mat4 m_cam;
+    vec4 camera_position;  // xyz, w unused
+    vec4 shading;          // shininess, spec_strength
+};
 uniform mat4 m_model;
-uniform mat4 m_cam;
-uniform vec3 camera_position;
 
 out vec4 color;
 out vec3 normal;
@@ -40,7 +44,7 @@ void main() {
     color = in_color * instance_matrix[1];
     world_position = (m_model * local_position).xyz;
     texcoord = in_texture;
-    view_vector = camera_position - world_position;
+    view_vector = camera_position.xyz - world_position;
     instance_id = float(gl_InstanceID);
 
 }
\ No newline at end of file
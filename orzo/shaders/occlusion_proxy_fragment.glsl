@@ -0,0 +1,8 @@
+#version 330
+
+// Nothing is written, the query only counts samples that pass the depth test
+out vec4 fragColor;
+
+void main() {
+    fragColor = vec4(0.0);
+}
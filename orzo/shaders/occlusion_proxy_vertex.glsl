@@ -0,0 +1,17 @@
+#version 330
+
+// Box around a mesh's bounding sphere, drawn inside an occlusion query, see culling.OcclusionCuller
+in vec3 in_position;
+
+layout(std140) uniform Frame {
+    mat4 m_proj;
+    mat4 m_cam;
+    vec4 camera_position;
+    vec4 shading;
+};
+
+uniform vec4 sphere;  // world space center and radius, the box's corners are at +-1
+
+void main() {
+    gl_Position = m_proj * m_cam * vec4(sphere.xyz + in_position * sphere.w, 1.0);
+}
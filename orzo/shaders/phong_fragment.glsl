@@ -2,31 +2,68 @@
 
 struct LightInfo {
     vec3 world_position;
+    int type;
     vec4 color;
     vec3 ambient;
-    int type;
     vec4 info;
     vec3 direction;
 };
 
+// Same for every mesh in a frame, see render.FrameState
+layout(std140) uniform Frame {
+    mat4 m_proj;
+    mat4 m_cam;
+    vec4 camera_position;  // xyz, w unused
+    vec4 shading;          // shininess, spec_strength
+};
+
+// Clustered lighting, see lighting.py
+layout(std140) uniform Lights {
+    ivec4 cluster_grid;  // tiles across, tiles down, depth slices, number of lights
+    vec4 cluster_depth;  // near, far, slices / log(far / near)
+    vec4 viewport;       // framebuffer size in pixels
+    vec4 ambient_light;  // every light's ambient * intensity summed, then the summed intensity
+};
+uniform sampler2D light_data;       // five texels per light
+uniform usampler3D light_clusters;  // offset and count into light_indices for each cluster
+uniform usampler2D light_indices;
+
 in vec3 world_position;
 in vec3 normal;
 in vec4 color;
 in vec2 texcoord;
 in vec3 view_vector;
 
-uniform int num_lights;
-uniform LightInfo lights[8];
 uniform vec4 material_color;
 uniform sampler2D base_texture;
 uniform bool double_sided;
-uniform float shininess;
-uniform float spec_strength;
 uniform float attention;
 uniform bool ghosting;
 
 out vec4 f_color;
 
+LightInfo fetch_light(int index) {
+    vec4 position_type = texelFetch(light_data, ivec2(0, index), 0);
+    LightInfo light;
+    light.world_position = position_type.xyz;
+    light.type = int(position_type.w);
+    light.color = texelFetch(light_data, ivec2(1, index), 0);
+    light.ambient = texelFetch(light_data, ivec2(2, index), 0).xyz;
+    light.info = texelFetch(light_data, ivec2(3, index), 0);
+    light.direction = texelFetch(light_data, ivec2(4, index), 0).xyz;
+    return light;
+}
+
+ivec3 find_cluster() {
+    vec2 tile = gl_FragCoord.xy / viewport.xy * vec2(cluster_grid.xy);
+    float near = cluster_depth.x;
+    float far = cluster_depth.y;
+    float ndc_depth = gl_FragCoord.z * 2.0 - 1.0;
+    float depth = 2.0 * near * far / (far + near - ndc_depth * (far - near));
+    int depth_slice = int(floor(log(depth / near) * cluster_depth.z));
+    return clamp(ivec3(ivec2(tile), depth_slice), ivec3(0), cluster_grid.xyz - 1);
+}
+
 void main() {
 
     f_color = vec4(0.0, 0.0, 0.0, 1.0);
@@ -39,19 +76,31 @@ void main() {
     if (double_sided && dot(view_vector, normal) < 0)
         N = -N;
 
-    int i = 0;
-    while (i < num_lights){
-        
-        LightInfo light = lights[i];
+    // Get diffuse color - tex_color is the issue -> black instead of white
+    vec4 diffuseColor = material_color * color * tex_color;
+
+    // Ambient doesn't fall off, so it's summed over every light ahead of time
+    f_color += diffuseColor * ambient_light * attention;
+
+    uvec2 cluster = texelFetch(light_clusters, find_cluster(), 0).rg;
+    uint index_width = uint(textureSize(light_indices, 0).x);
+    for (uint i = cluster.x; i < cluster.x + cluster.y; i++) {
+
+        uint index = texelFetch(light_indices, ivec2(int(i % index_width), int(i / index_width)), 0).r;
+        LightInfo light = fetch_light(int(index));
         float intensity = light.info[0];
         float range = light.info[1];
 
         vec3 lightVector = light.world_position - world_position;
         float lightDistance = length(lightVector);
         vec3 L = normalize(lightVector);
-        
+
+        // Lights with a range don't reach past it
+        if (light.type != 2 && range > 0.0 && lightDistance > range)
+            continue;
+
         float falloff = 0.0;
-        
+
         // Point Light
         if (light.type == 0)
             falloff = 1 / (1 + lightDistance * lightDistance);
@@ -72,27 +121,17 @@ void main() {
         // Directional Light
         else
             falloff = 1;
-        
+
         // Computer diffuse
         vec4 diffuse = light.color * max(0.0, dot(L, N)) * falloff; // using lambertian attenuation
 
         // Compute Specular
         vec3 reflection = -reflect(L, N);
-        float specularPower = pow(max(0.0, dot(V, reflection)), shininess);
-        float specular = spec_strength * specularPower * falloff;
-
-        // Get Ambient
-        vec3 ambient = light.ambient;
-        
-        // Get diffuse color - tex_color is the issue -> black instead of white
-        vec4 diffuseColor = material_color * color * tex_color;
-
-        // Add contribution to final color
-        //diffuseColor = material_color * tex_color;
-        //f_color += diffuseColor;
-        //f_color += ((diffuse + vec4(ambient, 1.0)) + specular) * intensity;
-        f_color += (diffuseColor * (diffuse + vec4(ambient, 1.0)) + specular) * intensity * attention;
-        i += 1;
+        float specularPower = pow(max(0.0, dot(V, reflection)), shading.x);
+        float specular = shading.y * specularPower * falloff;
+
+        // Add contribution to final color, ambient was added above
+        f_color += (diffuseColor * diffuse + specular) * intensity * attention;
     }
 
     // Add ghosting effect
@@ -1,7 +1,7 @@
 #version 330
 // Used for GPU accelerated selection
 // The 'color' or the frame stores the entity id, instance, and a hit value
-// The hit value indicates -1 for widget hit, 0 for no hit, and 1 for entity hit
+// The hit value indicates 0 for no hit, 1 for entity hit, and 2-4 for the widget types
 
 in vec3 world_position;
 in vec3 normal;
@@ -13,11 +13,11 @@ in float instance_id;
 uniform vec2 id;
 uniform int hit_value;
 
-out vec4 f_color;
+out uvec4 f_color;
 
 void main() {
 
-    int instance = int(instance_id);
-    f_color = ivec4(id, instance, hit_value);
+    uint instance = uint(instance_id);
+    f_color = uvec4(uint(id.x), uint(id.y), instance, uint(hit_value));
 
-}
\ No newline at end of file
+}
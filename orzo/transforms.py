@@ -0,0 +1,285 @@
+"""Module for the Scene's Transform Hierarchy
+
+Matrices for every node live in a TransformStore, a set of contiguous arrays indexed by the node's
+slot. Global matrices are computed a level of the tree at a time with one batched multiply per level,
+so a frame's update costs a handful of NumPy calls no matter how many entities are in the scene.
+"""
+
+import threading
+import weakref
+
+import numpy as np
+import moderngl_window as mglw
+
+from . import registry
+
+IDENTITY = np.identity(4, np.float32)
+
+# Starting number of slots, the store doubles whenever it runs out
+INITIAL_CAPACITY = 1024
+
+
+class TransformStore(object):
+    """Structure of arrays for the local and global matrices of every node in a scene
+
+    Slot 0 is an identity that root nodes and detached nodes hang off, so every slot has a parent.
+    Nodes are sorted into levels by depth whenever the structure changes, and each update walks the
+    levels top down, recomputing the slots that are dirty or have a parent that was just recomputed.
+    Slots that aren't dirty are left alone, which is how drag previews that write a global matrix
+    directly stick around.
+
+    Attributes:
+        local (np.ndarray): (capacity, 4, 4) float32 local matrices, identity for nodes without one
+        world (np.ndarray): (capacity, 4, 4) float32 global matrices
+        parents (np.ndarray): slot of each slot's parent
+        depths (np.ndarray): depth below slot 0, starting at 0 for roots
+        has_matrix (np.ndarray): whether the node has its own local matrix
+        active (np.ndarray): whether the slot is in use
+        dirty (np.ndarray): slots whose global matrix and everything below need recomputing
+        any_dirty (bool): whether any slot is dirty
+        levels (list): slots at each depth, rebuilt lazily after the structure changes
+        released (list): slots of nodes that were garbage collected, reclaimed on the next allocate or update
+        version (int): bumped whenever global matrices or the structure change, for caches built from them
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        capacity = max(capacity, 2)
+        self.local = np.tile(IDENTITY, (capacity, 1, 1))
+        self.world = np.tile(IDENTITY, (capacity, 1, 1))
+        self.parents = np.zeros(capacity, np.int64)
+        self.depths = np.zeros(capacity, np.int64)
+        self.has_matrix = np.zeros(capacity, bool)
+        self.active = np.zeros(capacity, bool)
+        self.dirty = np.zeros(capacity, bool)
+        self.any_dirty = False
+        self.levels = []
+        self.size = 1
+        self.free_slots = []
+        self.released = []
+        self.version = 0
+
+        # Client thread writes matrices while the render thread updates and grows the arrays
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.active))
+
+    def allocate(self, matrix=None):
+        """Get a slot for a new root level node"""
+        with self.lock:
+            self.reclaim()
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.size == len(self.active):
+                    self.grow()
+                slot = self.size
+                self.size += 1
+            self.active[slot] = True
+            self.parents[slot] = 0
+            self.depths[slot] = 0
+            self.levels = None
+        self.set_local(slot, matrix)
+        return slot
+
+    def free(self, slot):
+        """Give back a node's slot once the node is gone
+
+        This runs from garbage collection, which can happen on any thread and even while the lock is
+        held, so the slot is only queued here.
+        """
+        self.released.append(slot)
+
+    def reclaim(self):
+        """Mark released slots as free, called with the lock held"""
+        while self.released:
+            slot = self.released.pop()
+            self.active[slot] = False
+            self.dirty[slot] = False
+            self.parents[slot] = 0
+            self.free_slots.append(slot)
+            self.levels = None
+            self.version += 1
+
+    def grow(self):
+        """Double the capacity of every array, called with the lock held"""
+        capacity = len(self.active)
+        self.local = np.concatenate([self.local, np.tile(IDENTITY, (capacity, 1, 1))])
+        self.world = np.concatenate([self.world, np.tile(IDENTITY, (capacity, 1, 1))])
+        for name in ("parents", "depths", "has_matrix", "active", "dirty"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+
+    def set_local(self, slot, matrix):
+        """Set a slot's local matrix and mark it dirty, None means the node just passes its parent's through"""
+        with self.lock:
+            if matrix is None:
+                self.local[slot] = IDENTITY
+                self.has_matrix[slot] = False
+            else:
+                self.local[slot] = matrix
+                self.has_matrix[slot] = True
+            self.dirty[slot] = True
+            self.any_dirty = True
+
+    def mark_dirty(self, slot):
+        with self.lock:
+            self.dirty[slot] = True
+            self.any_dirty = True
+
+    def set_parent(self, slot, parent, depth):
+        """Move a slot under a new parent, 0 detaches it"""
+        with self.lock:
+            self.parents[slot] = parent
+            self.depths[slot] = depth
+            self.dirty[slot] = True
+            self.any_dirty = True
+            self.levels = None
+            self.version += 1
+
+    def build_levels(self):
+        """Group active slots by depth so each level only depends on the ones above it
+
+        Within a level slots are sorted by parent, so siblings are next to each other.
+        """
+        slots = np.flatnonzero(self.active[:self.size])
+        depths = self.depths[slots]
+        order = np.lexsort((self.parents[slots], depths))
+        slots, depths = slots[order], depths[order]
+        splits = np.flatnonzero(np.diff(depths)) + 1
+        self.levels = np.split(slots, splits) if len(slots) else []
+
+    def update(self):
+        """Recompute global matrices for every dirty subtree
+
+        Returns:
+            bool: whether anything was recomputed
+        """
+        if not self.any_dirty:
+            return False
+
+        with self.lock:
+            self.reclaim()
+            if self.levels is None:
+                self.build_levels()
+            # Swapped out before the work so changes from the client thread aren't lost
+            flags = self.dirty
+            self.dirty = np.zeros_like(flags)
+            self.any_dirty = False
+
+        local, world, parents = self.local, self.world, self.parents
+        for level in self.levels:
+            level_parents = parents[level]
+            stale = flags[level] | flags[level_parents]
+            if not stale.any():
+                continue
+            slots = level[stale]
+            world[slots] = np.matmul(local[slots], world[level_parents[stale]])
+            flags[slots] = True
+        self.version += 1
+        return True
+
+    def refresh(self, slot):
+        """Bring one slot up to date by recomputing from its highest dirty ancestor down
+
+        Dirty flags are left set so the next update still covers the rest of each subtree.
+        """
+        chain = []
+        while slot != 0:
+            chain.append(slot)
+            slot = self.parents[slot]
+
+        top = None
+        for position, ancestor in enumerate(chain):
+            if self.dirty[ancestor]:
+                top = position
+        if top is None:
+            return
+
+        for ancestor in reversed(chain[:top + 1]):
+            self.world[ancestor] = self.local[ancestor] @ self.world[self.parents[ancestor]]
+
+
+class TransformNode(mglw.scene.Node):
+    """Scene node whose matrices are rows in a TransformStore
+
+    Setting the local matrix or attaching the node marks it dirty, and the store recomputes dirty
+    subtrees in its next update. Reading matrix_global on a stale node brings it up to date on the
+    spot, so code that needs a world transform right after adding a node still gets the right answer.
+    Assigning matrix_global directly is left alone, which is how drag previews work.
+
+    Attributes:
+        store (TransformStore): store holding this node's matrices
+        slot (int): index of this node in the store's arrays
+        parent (TransformNode): node this is attached to, None for roots and detached nodes
+    """
+
+    def __init__(self, store, name=None, camera=None, mesh=None, matrix=None):
+        self.store = store
+        self.slot = store.allocate()
+        self.parent = None
+        weakref.finalize(self, store.free, self.slot)
+        super().__init__(name, camera, mesh, matrix)
+        self._children = registry.NodeList()  # Removing one of many children shouldn't scan them all
+
+    # Node reads and writes these directly, so they're backed by the store too
+    @property
+    def _matrix(self):
+        return self.store.local[self.slot] if self.store.has_matrix[self.slot] else None
+
+    @_matrix.setter
+    def _matrix(self, value):
+        self.store.set_local(self.slot, value)
+
+    @property
+    def _matrix_global(self):
+        return self.store.world[self.slot]
+
+    @_matrix_global.setter
+    def _matrix_global(self, value):
+        if value is not None:
+            self.store.world[self.slot] = value
+            self.store.version += 1
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.store.dirty[self.slot])
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Local matrix, setting it marks the node dirty"""
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, value):
+        self._matrix = value
+
+    @property
+    def matrix_global(self) -> np.ndarray:
+        """Copy of the global matrix, recomputed first if anything above it changed"""
+        self.store.refresh(self.slot)
+        return self.store.world[self.slot].copy()
+
+    @matrix_global.setter
+    def matrix_global(self, value):
+        self._matrix_global = value
+
+    def add_child(self, node):
+        super().add_child(node)
+        node.parent = self
+        node.set_depth(self.store.depths[self.slot] + 1, self.slot)
+
+    def remove_child(self, node):
+        self._children.remove(node)
+        node.parent = None
+        self.store.set_parent(node.slot, 0, 0)  # Descendants are still deeper, so their depths can stay
+
+    def set_depth(self, depth, parent_slot):
+        """Reattach this node's slot and shift the depths of its subtree to match"""
+        self.store.set_parent(self.slot, parent_slot, depth)
+        for child in self._children:
+            child.set_depth(depth + 1, self.slot)
+
+    def mark_dirty(self):
+        """Flag this subtree for recomputing"""
+        self.store.mark_dirty(self.slot)
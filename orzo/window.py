@@ -12,7 +12,7 @@ from imgui.integrations.pyglet import create_renderer
 from moderngl_window.integrations.imgui import ModernglWindowRenderer
 import penne
 
-from orzo import programs
+from orzo import programs, picking, cache, pipeline, scheduler, transforms, registry, render, lighting
 from orzo.delegates import delegate_map
 
 
@@ -92,29 +92,52 @@ class Window(mglw.WindowConfig):
         self.camera.zoom = 2.5
         self.camera_position = [0.0, 0.0, 0.0]
 
-        # Set up Framebuffer - used for selection
-        self.framebuffer = self.ctx.simple_framebuffer((self.wnd.width, self.wnd.height), dtype='u4')
+        # Compiled shader programs shared by all meshes
+        self.program_registry = programs.ProgramRegistry(self)
+        self.geometry_cache = cache.GeometryCache()
+        self.decode_pipeline = pipeline.DecodePipeline(self)
+        self.callback_scheduler = scheduler.CallbackScheduler()
+
+        # Set up picking pass - draws into its own framebuffer for selection
+        self.picking = picking.PickingPass(self)
+
+        # CPU alternative that casts rays against BVHs, doesn't need a framebuffer
+        self.ray_picker = picking.RayPicker(self)
+        self.cpu_picking = False
 
         # Window Options
         self.wnd.mouse_exclusivity = True
         self.camera_enabled = True
 
         # Store Light Info
-        self.lights = {}  # light_id: light_info
+        self.lights = lighting.LightTable(self.ctx)  # light_id: light_info, packed and clustered for the shader
         self.default_lighting = True
 
         # Create scene and set up basic nodes
         self.scene = mglw.scene.Scene("Noodles Scene")
-        self.root = mglw.scene.Node("Root")
+        self.registry = registry.SceneRegistry()
+        self.scene.nodes = self.registry.nodes
+        self.scene.meshes = self.registry.meshes
+        self.transform_store = transforms.TransformStore()
+        self.root = transforms.TransformNode(self.transform_store, "Root")
         self.root.matrix = np.identity(4, np.float32)
         self.root.matrix_global = np.identity(4, np.float32)
         self.scene.root_nodes.append(self.root)
+        self.draw_list = render.DrawList(self)
+        self.frame_state = render.FrameState(self.ctx)  # Camera matrices and shading, written once a frame
+        self.gl_state = render.StateTracker(self.ctx)  # Skips redundant state changes between draws
         self.scene.cameras.append(self.camera)
 
         # Store shader settings
         self.shininess = DEFAULT_SHININESS
         self.spec_strength = DEFAULT_SPEC_STRENGTH
 
+        # Options for generating missing attributes when geometry is loaded
+        self.angle_weighted_normals = False
+        self.generate_tangents = False
+        self.interleaved_attributes = True  # One vertex buffer per patch instead of one per attribute
+        self.generate_lods = True  # Simplified levels of detail for big triangle patches
+
         # Tried using imgui pyglet integration before, but switched to moderngl_window's integration
         # Could be worth taking another look at if event input problems are persistent
         # self.gui = create_renderer(self.wnd._window)
@@ -138,6 +161,11 @@ class Window(mglw.WindowConfig):
         # Flag for rendering bounding spheres on mesh, can be toggled in GUI
         self.draw_bs = False
 
+        # Continuous picking under the cursor, resolved asynchronously a frame later
+        self.hover_picking = False
+        self.hover_position = None
+        self.hovered_entity = None
+
         # Set up skybox
         self.skybox_on = True
         self.skybox = mglw.geometry.sphere(radius=SKYBOX_RADIUS)
@@ -145,47 +173,43 @@ class Window(mglw.WindowConfig):
         self.skybox_texture = self.load_texture_2d("skybox.png", flip_y=False)
 
     def update_matrices(self):
-        """Update global matrices for all nodes in the scene"""
-        self.root.calc_model_mat(np.identity(4))
+        """Bring global matrices up to date, only subtrees that changed are recomputed"""
+        if self.transform_store.update():
+            self.ray_picker.invalidate()
 
-    def add_node(self, node, parent=None):
+    def add_node(self, node, parent=None, entity_id=None):
         """Add a node to the scene
 
-        Adds to root by default, otherwise adds to parent node
+        Adds to root by default, otherwise adds to parent node. Entity nodes can be looked up by entity_id
         """
-        self.scene.nodes.append(node)
-
-        # Keep track of mesh
-        if node.mesh is not None:
-            self.scene.meshes.append(node.mesh)
+        # Keep track of node and mesh
+        self.registry.add(node, entity_id)
 
-        # Attach to parent node
+        # Attach to parent node, global matrices are updated once a frame or when they're read
         if parent is None:
             self.root.add_child(node)
         else:
             parent.add_child(node)
-
-        # update global matrices
-        self.update_matrices()
+        self.ray_picker.invalidate()
+        self.draw_list.invalidate()
 
     def remove_node(self, node, parent=None):
         """Remove a node from the scene"""
-        self.scene.nodes.remove(node)
-
-        # Keep track of mesh
-        if node.mesh is not None:
-            self.scene.meshes.remove(node.mesh)
+        self.registry.remove(node)
 
         # Take care of parent connection
         if parent is None:
-            self.root.children.remove(node)
+            self.root.remove_child(node)
         else:
-            parent.children.remove(node)
+            parent.remove_child(node)
 
         # Recurse on children
-        for child in node.children:
+        for child in list(node.children):
             self.remove_node(child, parent=node)
 
+        self.ray_picker.invalidate()
+        self.draw_list.invalidate()
+
     def get_ray_from_click(self, x, y, world=True):
 
         # Get matrices
@@ -285,6 +309,15 @@ class Window(mglw.WindowConfig):
         # Move camera if enabled
         if self.camera_enabled:
             self.camera.rot_state(-dx, -dy)
+        else:
+            self.hover_position = (x, y)
+
+    def set_hovered(self, slot, gen, instance, hit):
+        """Callback for asynchronous hover picks"""
+        if hit == 0 or self.client is None:
+            self.hovered_entity = None
+        else:
+            self.hovered_entity = self.client.state.get(penne.EntityID(slot=slot, gen=gen))
 
     def mouse_press_event(self, x: int, y: int, button: int):
 
@@ -299,13 +332,13 @@ class Window(mglw.WindowConfig):
         if imgui.is_window_hovered(imgui.HOVERED_ANY_WINDOW):
             return
 
-        # Get info from framebuffer and click coordinates, cast to ints
-        pixel_data = self.render_scene_to_framebuffer(x, y)
-        slot, gen, instance, hit = pixel_data[:4], pixel_data[4:8], pixel_data[8:12], pixel_data[12:]
-        slot = int(np.frombuffer(slot, dtype=np.single))  # Why are these floats? I'm not sure but it works
-        gen = int(np.frombuffer(gen, dtype=np.single))
-        instance = int(np.frombuffer(instance, dtype=np.single))
-        hit = int(np.frombuffer(hit, dtype=np.single))
+        # Get info from framebuffer at click coordinates, or cast a ray on the CPU
+        if self.cpu_picking:
+            picker = self.ray_picker
+            slot, gen, instance, hit = self.ray_picker.pick(x, y)
+        else:
+            picker = self.picking
+            slot, gen, instance, hit = self.render_scene_to_framebuffer(x, y)
 
         # No hit -> No selection
         if hit == 0:
@@ -315,7 +348,7 @@ class Window(mglw.WindowConfig):
             self.selected_entity = None
             self.selected_instance = None
             end_time = time()
-            print(f"Time to click nothing: {end_time - start_time}")
+            print(f"Time to click nothing: {end_time - start_time} (picking pass: {picker.last_time})")
             return
 
         # Get widget type from hit
@@ -340,7 +373,7 @@ class Window(mglw.WindowConfig):
             self.add_widgets()
 
         end_time = time()
-        print(f"Time to select: {end_time - start_time}")
+        print(f"Time to select: {end_time - start_time} (picking pass: {picker.last_time})")
         print(f"Active Widget: {self.active_widget}")
 
     def mouse_drag_event(self, x: int, y: int, dx: int, dy: int):
@@ -444,7 +477,7 @@ class Window(mglw.WindowConfig):
             # Server doesn't support these injected methods
             except AttributeError as e:
                 logging.warning(f"Dragging {self.selected_entity} failed: {e}")
-                self.selected_entity.node.matrix = self.selected_entity.node.children[0].matrix
+                self.selected_entity.node.matrix = self.selected_entity.np_transform
                 self.selected_entity.node.matrix_global = old
 
             # Turn off ghosting effect
@@ -454,11 +487,13 @@ class Window(mglw.WindowConfig):
         print(f"Time to release: {end_time - start_time}")
 
     def close(self):
+        self.decode_pipeline.shutdown()
         if self.client_needs_shutdown:
             self.client.shutdown()
 
     def resize(self, width: int, height: int):
         self.gui.resize(width, height)
+        self.picking.resize(width, height)
         self.camera.projection.update(aspect_ratio=self.wnd.aspect_ratio)
 
     def unicode_char_entered(self, char):
@@ -478,6 +513,10 @@ class Window(mglw.WindowConfig):
         widget_mesh.has_bounding_sphere = False
         vao = widget_mesh.vao
 
+        # Triangles for CPU picking, obj meshes aren't indexed so every three vertices make a triangle
+        positions = picking.vao_positions(vao)
+        widget_mesh.bvh = picking.TriangleBVH(positions, np.arange(len(positions)).reshape((-1, 3)))
+
         # Add default colors
         default_colors = [1.0, 1.0, 1.0, 1.0] * vao.vertex_count
         buffer_data = np.array(default_colors, np.int8)
@@ -496,9 +535,11 @@ class Window(mglw.WindowConfig):
                              np.float32)
         instances[:, 3, :3] *= .5 * radius  # Scale widget by radius
         vao.buffer(instances, '16f/i', 'instance_matrix')
+        widget_mesh.instances = instances
 
         # Create the node
-        widget_node = mglw.scene.Node(f"{name} widget", mesh=widget_mesh, matrix=np.identity(4))
+        widget_node = transforms.TransformNode(self.transform_store, f"{name} widget", mesh=widget_mesh,
+                                               matrix=np.identity(4))
         return widget_node
 
     def add_widgets(self):
@@ -519,7 +560,7 @@ class Window(mglw.WindowConfig):
         else:
             mat = np.identity(4, np.float32)
         mat[3, :3] = center
-        widget_node = mglw.scene.Node("Widgets", matrix=mat)
+        widget_node = transforms.TransformNode(self.transform_store, "Widgets", matrix=mat)
         self.add_node(widget_node)
 
         # Create mesh nodes
@@ -568,17 +609,17 @@ class Window(mglw.WindowConfig):
         if self.widgets_align_local:
             new_mat = entity.compose_transform(scale=np.array([1.0, 1.0, 1.0]))  # Get global without scaling
             new_mat[3, :3] = new_center
-            self.scene.find_node("Widgets").matrix = new_mat
+            self.registry.find("Widgets").matrix = new_mat
         else:
             new_mat = np.identity(4)
             new_mat[3, :3] = new_center
-            self.scene.find_node("Widgets").matrix = new_mat
+            self.registry.find("Widgets").matrix = new_mat
         self.update_matrices()
 
     def remove_widgets(self):
 
         # Remove widgets from scene
-        widget_node = self.scene.find_node("Widgets")
+        widget_node = self.registry.find("Widgets")
         self.remove_node(widget_node)
 
     def handle_widget_movement(self, dx, dy, dz):
@@ -617,7 +658,7 @@ class Window(mglw.WindowConfig):
         entity = self.selected_entity
         direction = self.selected_instance
         center, radius = entity.node.mesh.bounding_sphere
-        widgets = self.scene.find_node("Widgets")
+        widgets = self.registry.find("Widgets")
 
         # Get the rotation quaternion
         widget_vec = widgets.children[direction].matrix_global[direction, :3]
@@ -649,7 +690,7 @@ class Window(mglw.WindowConfig):
         deltas = np.array([dx, dy, dz])
         origin = entity.node.matrix[3, :3]
         # origin = current_mat_global[3, :3]
-        widgets = self.scene.find_node("Widgets")
+        widgets = self.registry.find("Widgets")
 
         # Scale in direction of widget
         widget_vec = widgets.children[direction].matrix_global[direction, :3]
@@ -695,51 +736,40 @@ class Window(mglw.WindowConfig):
         entity.node.matrix_global = entity.compose_transform()
 
     def render_scene_to_framebuffer(self, x, y):
-
-        # Swap mesh programs to the frame select program
-        old_programs = {}
-        for mesh in self.scene.meshes:
-            old_programs[(mesh.entity_id, mesh.name)] = mesh.mesh_program  # Save the old program
-            mesh.mesh_program = programs.FrameSelectProgram(self, mesh.mesh_program.num_instances)
-
-        self.framebuffer.use()
-        self.framebuffer.clear()
-        self.scene.draw(
-            projection_matrix=self.camera.projection.matrix,
-            camera_matrix=self.camera.matrix
-        )
-
-        # Swap back to the old programs
-        for mesh in self.scene.meshes:
-            mesh.mesh_program = old_programs[(mesh.entity_id, mesh.name)]
-
-        # Bind the default framebuffer to switch back
-        self.ctx.screen.use()
-
-        return self.framebuffer.read(components=4, viewport=(x, self.wnd.height-y, 1, 1), dtype='u4')
+        """Draw the scene into the picking framebuffer and get the selection info at (x, y)"""
+        return self.picking.pick(x, y)
 
     def render(self, time: float, frametime: float):
         """Renders a frame to on the window
         
-        Most work done in the draw function which draws each node in the scene.
-        When drawing each node, the mesh is drawn, using the mesh program.
-        At each frame, the callback_queue is checked so the client can update the render
-        Note: each callback has the window as the first arg
+        Most work done in the draw list, which draws each mesh in the scene with its mesh program.
+        The list is only rebuilt when nodes are added or removed.
+        At each frame, callbacks from the client's callback_queue are run within a time budget so
+        the client can update the render. Note: each callback has the window as the first arg
         """
-        self.ctx.enable_only(moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
+        self.gl_state.begin_frame()
+        self.gl_state.enable_only(moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
+        self.gl_state.blend_func(moderngl.SRC_ALPHA, moderngl.ONE_MINUS_SRC_ALPHA)
 
         # Render skybox
         if self.skybox_on:
             self.ctx.front_face = 'cw'
-            self.skybox_texture.use()
+            self.gl_state.texture(self.skybox_texture)
+            self.gl_state.use_program(self.skybox_program)
             self.skybox_program['m_proj'].write(self.camera.projection.matrix)
             self.skybox_program['m_cam'].write(self.camera.matrix)
             self.skybox.render(self.skybox_program)
             self.ctx.front_face = 'ccw'
 
-        self.scene.draw(
-            projection_matrix=self.camera.projection.matrix,
-            camera_matrix=self.camera.matrix,
+        self.update_matrices()
+        projection, camera = self.camera.projection.matrix, self.camera.matrix
+        self.frame_state.update(projection, camera, self.shininess, self.spec_strength)
+        self.camera_position = [round(float(x), 2) for x in self.frame_state.camera_position]
+        self.frame_state.use()
+        self.lights.use(self)
+        self.draw_list.draw(
+            projection_matrix=projection,
+            camera_matrix=camera,
             time=time,
         )
 
@@ -750,16 +780,21 @@ class Window(mglw.WindowConfig):
             self.gui.render(imgui.get_draw_data())
             return
 
+        # Pick under the cursor without stalling, results come back in the next frame's update
+        if self.hover_picking and self.hover_position is not None and not self.camera_enabled:
+            self.picking.request(*self.hover_position, self.set_hovered)
+        self.picking.update()
+
+        # Upload geometry that finished decoding in the background
+        self.decode_pipeline.update()
+
         # Render GUI elements
         self.update_gui()
         imgui.render()
         self.gui.render(imgui.get_draw_data())
 
-        while not self.client.callback_queue.empty():
-            callback_info = self.client.callback_queue.get()
-            callback, args = callback_info
-            logging.info(f"Callback in render: {callback.__name__} \n\tw/ args: {args}")
-            callback(self, *args)
+        self.callback_scheduler.pull(self.client.callback_queue)
+        self.callback_scheduler.run(self)
 
         # Clean up any dead objects
         self.ctx.gc()
@@ -787,6 +822,27 @@ class Window(mglw.WindowConfig):
         imgui.text(f"Click and drag an entity to move it")
         imgui.text(f"Hold 'r' while dragging to rotate an entity")
         _, self.draw_bs = imgui.checkbox("Show Bounding Spheres", self.draw_bs)
+        if self.hover_picking:
+            imgui.text(f"Hovered: {self.hovered_entity.name if self.hovered_entity else None}")
+        if self.decode_pipeline.pending:
+            imgui.text(f"Decoding {len(self.decode_pipeline.pending)} geometries...")
+        callbacks = self.callback_scheduler
+        if callbacks.pending or callbacks.processed:
+            imgui.text(f"Callbacks: {callbacks.pending} queued, {callbacks.processed} run in "
+                       f"{callbacks.frame_time * 1000:.1f} ms, waited {callbacks.latency * 1000:.0f} ms, "
+                       f"{callbacks.dropped} coalesced")
+        if len(self.lights):
+            imgui.text(f"Lights: {len(self.lights)}, {self.lights.binned} binned into clusters")
+        issued, skipped = self.gl_state.last_frame
+        imgui.text(f"State changes: {sum(issued.values())} issued, {sum(skipped.values())} skipped")
+        draw_list = self.draw_list
+        imgui.text(f"Meshes: {draw_list.drawn} drawn, {draw_list.culled} culled, {draw_list.tested} nodes tested")
+        if draw_list.occlusion:
+            imgui.text(f"Occlusion: {draw_list.occluded} draws avoided")
+        if draw_list.batch_draws:
+            imgui.text(f"Batches: {draw_list.batched} meshes in {draw_list.batch_draws} draws")
+        if draw_list.translucent:
+            imgui.text(f"Translucent draws: {draw_list.translucent}, sorted back to front")
         imgui.end()
 
     def render_document(self):
@@ -841,6 +897,30 @@ class Window(mglw.WindowConfig):
                 # Skybox
                 clicked, self.skybox_on = imgui.checkbox("Use Skybox", self.skybox_on)
 
+                # Picking
+                clicked, self.hover_picking = imgui.checkbox("Hover Picking", self.hover_picking)
+                clicked, self.picking.scissored = imgui.checkbox("Scissored Picking", self.picking.scissored)
+                clicked, self.cpu_picking = imgui.checkbox("CPU Ray Picking", self.cpu_picking)
+
+                # Drawing
+                clicked, self.draw_list.sort = imgui.checkbox("Sort Draws by State", self.draw_list.sort)
+                if clicked:
+                    self.draw_list.invalidate()
+                clicked, self.draw_list.cull = imgui.checkbox("Frustum Culling", self.draw_list.cull)
+                clicked, self.draw_list.occlusion = imgui.checkbox("Occlusion Culling", self.draw_list.occlusion)
+                clicked, self.draw_list.lod = imgui.checkbox("Levels of Detail", self.draw_list.lod)
+                clicked, self.draw_list.batching = imgui.checkbox("Batch Shared Meshes", self.draw_list.batching)
+                if clicked:
+                    self.draw_list.invalidate()
+
+                # Loading
+                clicked, self.decode_pipeline.background = imgui.checkbox("Background Decoding",
+                                                                           self.decode_pipeline.background)
+                changed, budget = imgui.slider_float("Callback Budget (ms)", self.callback_scheduler.budget * 1000,
+                                                     1.0, 100.0, format="%.0f")
+                if changed:
+                    self.callback_scheduler.budget = budget / 1000
+
                 # Camera Settings
                 imgui.menu_item("Camera Settings", None, False, True)
                 changed, speed = imgui.slider_float("Speed", self.camera.velocity, 0.0, 10.0, format="%.0f")
@@ -0,0 +1,445 @@
+# Script to benchmark Orzo's geometry processing, run with `python -m tests.benchmarks [name]`
+
+import argparse
+from functools import partial
+from time import perf_counter
+from types import SimpleNamespace
+
+import numpy as np
+import moderngl
+import moderngl_window as mglw
+from pyrr import Matrix44
+
+from orzo import culling, geometry, lighting, programs, registry, render, transforms
+
+
+def grid_mesh(size):
+    """Wavy grid with 2 * size^2 triangles"""
+    xs, ys = np.meshgrid(np.linspace(-1, 1, size + 1), np.linspace(-1, 1, size + 1))
+    vertices = np.stack([xs.ravel(), ys.ravel(), 0.1 * np.sin(5 * xs.ravel())], axis=1).astype(np.float32)
+    corner = (np.arange(size)[:, None] * (size + 1) + np.arange(size)[None, :]).ravel()
+    triangles = np.concatenate([
+        np.stack([corner, corner + 1, corner + size + 1], axis=1),
+        np.stack([corner + 1, corner + size + 2, corner + size + 1], axis=1)
+    ])
+    return vertices, triangles
+
+
+def loop_normals(vertices, indices):
+    """The original per triangle loop from GeometryDelegate.calculate_normals, kept for comparison"""
+    normals = np.zeros(vertices.shape, dtype=np.single)
+    for triangle in indices:
+        v0 = vertices[triangle[0]]
+        v1 = vertices[triangle[1]]
+        v2 = vertices[triangle[2]]
+        normal = np.cross(v2 - v1, v0 - v1)
+        normals[triangle[0]] += normal
+        normals[triangle[1]] += normal
+        normals[triangle[2]] += normal
+    return normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+
+
+def join_extract(raw_bytes, offset, length, stride, size):
+    """The original memoryview slice and join from GeometryDelegate.extract_bytes, kept for comparison"""
+    starts = range(offset, offset + length, stride)
+    return b''.join([memoryview(raw_bytes)[start:start + size] for start in starts])
+
+
+def timed(func, *args, **kwargs):
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+def benchmark_normals(loop_size=100, batched_size=1000):
+    """Triangles per second for normal generation, the loop is run on a smaller mesh since it's so slow"""
+
+    vertices, triangles = grid_mesh(loop_size)
+    expected, loop_time = timed(loop_normals, vertices, triangles)
+    result, _ = timed(geometry.calculate_normals, vertices, triangles)
+    assert np.allclose(expected, result, atol=1e-5)
+    print(f"Loop:           {len(triangles) / loop_time:14,.0f} triangles/s ({len(triangles):,} triangles)")
+
+    vertices, triangles = grid_mesh(batched_size)
+    _, batched_time = timed(geometry.calculate_normals, vertices, triangles)
+    print(f"Batched:        {len(triangles) / batched_time:14,.0f} triangles/s ({len(triangles):,} triangles)")
+
+    _, angle_time = timed(geometry.calculate_normals, vertices, triangles, angle_weighted=True)
+    print(f"Angle weighted: {len(triangles) / angle_time:14,.0f} triangles/s ({len(triangles):,} triangles)")
+
+    normals = geometry.calculate_normals(vertices, triangles)
+    texcoords = vertices[:, :2] * 0.5 + 0.5
+    _, tangent_time = timed(geometry.calculate_tangents, vertices, normals, texcoords, triangles)
+    print(f"Tangents:       {len(triangles) / tangent_time:14,.0f} triangles/s ({len(triangles):,} triangles)")
+
+
+def benchmark_extract(num_vertices=2_000_000):
+    """Vertices per second pulling positions out of an interleaved position / normal buffer"""
+
+    data = np.random.default_rng(0).random((num_vertices, 6), np.float32).tobytes()
+
+    joined, join_time = timed(join_extract, data, 0, len(data), 24, 12)
+    print(f"Join:           {num_vertices / join_time:14,.0f} vertices/s ({len(data) / 1e6:,.0f} MB)")
+
+    def strided():
+        return geometry.packed(geometry.strided_view(data, 0, num_vertices, 24, np.float32, 3))
+
+    result, view_time = timed(strided)
+    assert result.tobytes() == joined
+    print(f"Strided view:   {num_vertices / view_time:14,.0f} vertices/s ({len(data) / 1e6:,.0f} MB)")
+
+    packed = np.asarray(result).tobytes()
+    _, packed_time = timed(lambda: geometry.packed(geometry.strided_view(packed, 0, num_vertices, 0, np.float32, 3)))
+    print(f"Packed view:    {num_vertices / packed_time:14,.0f} vertices/s (no copy)")
+
+
+def standalone_context():
+    try:
+        return moderngl.create_standalone_context()
+    except Exception:
+        return moderngl.create_standalone_context(backend='egl')  # Headless linux
+
+
+def benchmark_vertex_layout(size=300, draws=20):
+    """Draw throughput and GPU memory for per attribute buffers vs a single interleaved buffer"""
+
+    ctx = standalone_context()
+    program = programs.ProgramRegistry(SimpleNamespace(ctx=ctx)).get("base", "phong")
+    framebuffer = ctx.simple_framebuffer((512, 512))
+    framebuffer.use()
+
+    vertices, triangles = grid_mesh(size)
+    attributes = [
+        (vertices, "3f", "in_position"),
+        (geometry.calculate_normals(vertices, triangles), "3f", "in_normal"),
+        ((vertices[:, :2] * 0.5 + 0.5).astype(np.float32), "2f", "in_texture"),
+        (np.full((len(vertices), 4), 255, np.uint8), "4f1", "in_color"),
+    ]
+    index_buffer = ctx.buffer(triangles.astype(np.uint32))
+
+    separate = [ctx.buffer(np.ascontiguousarray(data)) for data, _, _ in attributes]
+    interleaved = ctx.buffer(geometry.interleave([data for data, _, _ in attributes]))
+    layouts = {
+        "Per attribute": (separate, [(buffer, fmt, name) for buffer, (_, fmt, name) in zip(separate, attributes)]),
+        "Interleaved": ([interleaved], [(interleaved, " ".join(a[1] for a in attributes), *[a[2] for a in attributes])]),
+    }
+
+    for name, (buffers, content) in layouts.items():
+        vao = ctx.vertex_array(program, content, index_buffer, 4)
+        vao.render()
+        ctx.finish()
+        start = perf_counter()
+        for _ in range(draws):
+            vao.render()
+        ctx.finish()
+        elapsed = perf_counter() - start
+        memory = sum(buffer.size for buffer in buffers)
+        print(f"{name + ':':15} {draws * len(triangles) / elapsed:14,.0f} triangles/s, "
+              f"{len(buffers)} buffers, {memory / 1e6:.2f} MB")
+
+
+def load_scene(node_class, num_entities, per_frame, incremental):
+    """Build the node tree the way entities are added, an entity node with a patch node under it
+
+    The legacy path recomputes the whole tree after every insertion like Window.add_node used to, the
+    incremental path reads the new entity's world transform like render_patch does and updates once a frame.
+    """
+    rng = np.random.default_rng(0)
+    if incremental:
+        store = transforms.TransformStore()
+        node_class = partial(node_class, store)
+    root = node_class("Root", matrix=np.identity(4, np.float32))
+    nodes = []
+    for i in range(num_entities):
+        matrix = np.identity(4, np.float32)
+        matrix[3, :3] = rng.random(3)
+        entity, patch = node_class(f"{i}", matrix=matrix), node_class(f"{i} patch", matrix=np.identity(4))
+        parent = nodes[rng.integers(len(nodes))][0] if nodes and i % 4 == 0 else root  # Some nesting
+        parent.add_child(entity)
+        entity.add_child(patch)
+        nodes.append((entity, patch))
+
+        if incremental:
+            _ = entity.matrix_global
+            if i % per_frame == 0:
+                store.update()
+        else:
+            root.calc_model_mat(np.identity(4))
+            root.calc_model_mat(np.identity(4))
+    if incremental:
+        store.update()
+    return nodes
+
+
+def benchmark_scene_load(num_entities=10_000, legacy_entities=1_000, per_frame=100):
+    """Time to add entities to the transform hierarchy, legacy is run on fewer since it's quadratic"""
+
+    _, legacy_time = timed(load_scene, mglw.scene.Node, legacy_entities, per_frame, False)
+    print(f"Full tree update: {legacy_time:8.2f} s for {legacy_entities:,} entities")
+
+    legacy_nodes = load_scene(mglw.scene.Node, legacy_entities, per_frame, False)
+    dirty_nodes = load_scene(transforms.TransformNode, legacy_entities, per_frame, True)
+    for (legacy, _), (dirty, _) in zip(legacy_nodes, dirty_nodes):
+        assert np.allclose(legacy.matrix_global, dirty.matrix_global, atol=1e-6)
+
+    _, dirty_time = timed(load_scene, transforms.TransformNode, num_entities, per_frame, True)
+    print(f"Dirty flags:      {dirty_time:8.2f} s for {num_entities:,} entities")
+
+
+def benchmark_transform_update(num_entities=100_000, moving=1_000):
+    """Per frame cost of the batched store update vs walking the node tree, for the whole scene and a few movers"""
+
+    nodes = load_scene(transforms.TransformNode, num_entities, num_entities, True)
+    store = nodes[0][0].store
+    root = nodes[0][0].parent
+
+    legacy_root = mglw.scene.Node("Root", matrix=np.identity(4, np.float32))
+    for entity, _ in nodes:
+        legacy_entity = mglw.scene.Node(matrix=entity.matrix)
+        legacy_entity.add_child(mglw.scene.Node(matrix=np.identity(4, np.float32)))
+        legacy_root.add_child(legacy_entity)
+
+    _, tree_time = timed(legacy_root.calc_model_mat, np.identity(4))
+    print(f"Node tree walk: {tree_time * 1e3:8.2f} ms for {2 * num_entities:,} nodes")
+
+    root.mark_dirty()
+    _, full_time = timed(store.update)
+    print(f"Store, all:     {full_time * 1e3:8.2f} ms for {2 * num_entities:,} nodes")
+
+    rng = np.random.default_rng(1)
+    movers = [nodes[i][0] for i in rng.choice(num_entities, moving, replace=False)]
+
+    def move():
+        for entity in movers:
+            entity.matrix = entity.matrix
+        store.update()
+
+    _, move_time = timed(move)
+    print(f"Store, moving:  {move_time * 1e3:8.2f} ms for {moving:,} entities")
+
+
+def clear_scene(indexed, num_entities):
+    """Add entities with a patch node each then remove them all in random order, like a server clearing its scene
+
+    Mirrors Window.add_node and remove_node, the legacy path uses the mglw scene's lists like they used to.
+    """
+    store = transforms.TransformStore()
+    scene = registry.SceneRegistry() if indexed else SimpleNamespace(nodes=[], meshes=[])
+    root = transforms.TransformNode(store, "Root", matrix=np.identity(4))
+    if not indexed:
+        root._children = []
+
+    def add(node, parent):
+        if indexed:
+            scene.add(node)
+        else:
+            scene.nodes.append(node)
+            scene.meshes.append(node.mesh)
+        parent.add_child(node)
+
+    def remove(node, parent):
+        if indexed:
+            scene.remove(node)
+        else:
+            scene.nodes.remove(node)
+            scene.meshes.remove(node.mesh)
+        parent.remove_child(node)
+        for child in list(node.children):
+            remove(child, node)
+
+    entities = []
+    for i in range(num_entities):
+        entity = transforms.TransformNode(store, f"{i}", mesh=object(), matrix=np.identity(4))
+        patch = transforms.TransformNode(store, f"{i} patch", mesh=object(), matrix=np.identity(4))
+        if not indexed:
+            entity._children = []
+        add(entity, root)
+        add(patch, entity)
+        entities.append(entity)
+
+    order = np.random.default_rng(0).permutation(num_entities)
+    start = perf_counter()
+    for i in order:
+        remove(entities[i], root)
+    return perf_counter() - start
+
+
+def benchmark_mass_delete(num_entities=50_000, legacy_entities=10_000):
+    """Time to remove every entity from a scene, legacy is run on fewer since it's quadratic"""
+
+    legacy_time = clear_scene(False, legacy_entities)
+    print(f"Lists:   {legacy_time * 1e3:10.1f} ms for {legacy_entities:,} entities")
+    indexed_time = clear_scene(True, num_entities)
+    print(f"Indexed: {indexed_time * 1e3:10.1f} ms for {num_entities:,} entities")
+
+
+def benchmark_light_binning(counts=(1_024, 10_000), grid=lighting.CLUSTER_GRID):
+    """Time to bin lights into clusters, done whenever the camera or lights change"""
+
+    projection = np.array(Matrix44.perspective_projection(75.0, 16 / 9, 0.1, 1000.0, dtype="f4"))
+    rng = np.random.default_rng(0)
+    for count in counts:
+        centers = rng.uniform([-20, -10, -40], [20, 10, 0], (count, 3))
+        radii = rng.uniform(0.5, 3, count)
+        (table, indices), elapsed = timed(lambda: lighting.assign_lights(
+            *lighting.cluster_bounds(centers, radii, projection, 0.1, 1000.0, grid), grid))
+        average = len(indices) / np.count_nonzero(table[..., 1]) if len(indices) else 0
+        print(f"{count:6,} lights: {elapsed * 1e3:6.2f} ms, {average:.1f} lights per occupied cluster")
+
+
+def benchmark_uniform_writes(num_meshes=10_000):
+    """Per mesh uniform cost of looking each one up by name and checking the camera vs cached handles"""
+
+    registry = programs.ProgramRegistry(SimpleNamespace(ctx=standalone_context()))
+    program = registry.get("base", "phong")
+    uniforms = registry.uniforms[("base", "phong")]
+    model = np.identity(4, np.float32)
+    camera = Matrix44.look_at((0, 0, 5), (0, 0, 0), (0, 1, 0), dtype="f4")
+    values = {"ghosting": False, "attention": 1.0, "material_color": (1.0, 1.0, 1.0, 1.0), "double_sided": False}
+
+    def by_name():
+        last_camera = None
+        for _ in range(num_meshes):
+            program["m_model"].write(model)
+            for name, value in values.items():
+                program[name].value = value
+            if list(camera) != last_camera:
+                last_camera = list(camera)
+
+    def cached():
+        for _ in range(num_meshes):
+            uniforms["m_model"].write(model)
+            for name, value in values.items():
+                uniforms[name].value = value
+
+    for name, function in [("By name", by_name), ("Cached", cached)]:
+        _, elapsed = timed(function)
+        print(f"{name + ':':9} {elapsed / num_meshes * 1e6:6.2f} us per mesh")
+
+
+def benchmark_frustum_culling(num_groups=1_000, per_group=100):
+    """Cost of culling grouped entities through the hierarchy vs testing every mesh on its own"""
+
+    rng = np.random.default_rng(0)
+    store = transforms.TransformStore()
+    root = transforms.TransformNode(store, "Root", matrix=np.identity(4, np.float32))
+    slots = []
+    for _ in range(num_groups):
+        matrix = np.identity(4, np.float32)
+        matrix[3, :3] = rng.uniform(-500, 500, 3)
+        group = transforms.TransformNode(store, matrix=matrix)
+        root.add_child(group)
+        for _ in range(per_group):
+            matrix = np.identity(4, np.float32)
+            matrix[3, :3] = rng.uniform(-5, 5, 3)
+            entity = transforms.TransformNode(store, matrix=matrix)
+            patch = transforms.TransformNode(store, matrix=np.identity(4, np.float32))
+            group.add_child(entity)
+            entity.add_child(patch)
+            slots.append(patch.slot)
+    store.update()
+
+    slots = np.array(slots)
+    centers, radii = np.zeros((len(slots), 3), np.float32), np.ones(len(slots), np.float32)
+    projection = np.array(Matrix44.perspective_projection(75.0, 16 / 9, 0.1, 1000.0, dtype="f4"))
+    planes = culling.frustum_planes(projection, np.identity(4))
+
+    bounds, bounds_time = timed(culling.Bounds, store, slots, centers, radii)
+    flat_view, flat_time = timed(culling.spheres_visible, planes, bounds.centers, bounds.radii)
+    (in_view, tested), tree_time = timed(culling.cull, store.parents, slots, bounds, planes)
+    assert np.array_equal(in_view, flat_view)
+    print(f"Bounds:     {bounds_time * 1e3:8.2f} ms, only when something moves")
+    print(f"Every mesh: {flat_time * 1e3:8.2f} ms for {len(slots):,} meshes")
+    print(f"Hierarchy:  {tree_time * 1e3:8.2f} ms, {tested:,} nodes tested, {in_view.sum():,} meshes in view")
+
+
+def benchmark_instance_culling(num_instances=200_000, draws=5):
+    """Frame time drawing every instance of a big instanced mesh vs culling them on the GPU first"""
+
+    ctx = standalone_context()
+    registry = programs.ProgramRegistry(SimpleNamespace(ctx=ctx))
+    program = registry.get("instance", "phong")
+    framebuffer = ctx.simple_framebuffer((640, 360))
+    framebuffer.use()
+    ctx.enable(moderngl.DEPTH_TEST)
+
+    vertices, triangles = grid_mesh(4)
+    content = [
+        (ctx.buffer(vertices), "3f", "in_position"),
+        (ctx.buffer(geometry.calculate_normals(vertices, triangles)), "3f", "in_normal"),
+        (ctx.buffer((vertices[:, :2] * 0.5 + 0.5).astype(np.float32)), "2f", "in_texture"),
+        (ctx.buffer(np.full((len(vertices), 4), 255, np.uint8)), "4f1", "in_color"),
+    ]
+    index_buffer = ctx.buffer(triangles.astype(np.uint32))
+
+    # Instances scattered all around the camera, so most of them are out of view
+    rng = np.random.default_rng(0)
+    instances = np.zeros((num_instances, 4, 4), np.float32)
+    instances[:, 0, :3] = rng.uniform(-300, 300, (num_instances, 3))
+    instances[:, 1] = instances[:, 2, 3] = instances[:, 3, :3] = 1.0
+    instance_buffer = ctx.buffer(instances)
+    sphere = geometry.bounding_sphere(vertices)
+
+    projection = np.array(Matrix44.perspective_projection(75.0, 16 / 9, 0.1, 1000.0, dtype="f4"))
+    camera = np.identity(4, np.float32)
+    frame = render.FrameState(ctx)
+    frame.update(projection, camera)
+    frame.use()
+    model = np.identity(4, np.float32)
+    program["m_model"].write(model)
+
+    culler = culling.InstanceCuller(ctx, registry.instance_cull_program, instance_buffer, num_instances, sphere)
+    every = ctx.vertex_array(program, content + [(instance_buffer, "16f/i", "instance_matrix")], index_buffer, 4)
+    culled = ctx.vertex_array(program, content + [(culler.outputs[0], "16f/i", "instance_matrix")], index_buffer, 4)
+
+    def draw_every():
+        for _ in range(draws):
+            framebuffer.clear()
+            every.render(instances=num_instances)
+        ctx.finish()
+
+    def draw_culled():
+        for _ in range(draws):
+            framebuffer.clear()
+            culler._key = None  # Force the pass, like a camera moving every frame
+            kept = culler.cull(model, frame.planes, frame.camera_position)[0]
+            culled.render(instances=kept)
+        ctx.finish()
+
+    draw_every()
+    draw_culled()
+    for name, function in [("Every instance", draw_every), ("Culled", draw_culled)]:
+        _, elapsed = timed(function)
+        print(f"{name + ':':15} {elapsed / draws * 1e3:8.2f} ms per frame")
+    print(f"Kept {culler.counts[0]:,} of {num_instances:,} instances")
+
+
+BENCHMARKS = {
+    "normals": benchmark_normals,
+    "extract": benchmark_extract,
+    "vertex_layout": benchmark_vertex_layout,
+    "scene_load": benchmark_scene_load,
+    "transform_update": benchmark_transform_update,
+    "mass_delete": benchmark_mass_delete,
+    "light_binning": benchmark_light_binning,
+    "uniform_writes": benchmark_uniform_writes,
+    "frustum_culling": benchmark_frustum_culling,
+    "instance_culling": benchmark_instance_culling,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Orzo's geometry processing")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run from {list(BENCHMARKS)}, defaults to all")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark '{name}'")
+
+    for name in args.names or BENCHMARKS:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+
+from orzo.cache import GeometryCache, PatchResources
+
+
+def test_geometry_cache_builds_once_and_releases_last():
+
+    cache = GeometryCache()
+    builds = []
+
+    def build():
+        builds.append(1)
+        return PatchResources(None, None, None)
+
+    first = cache.acquire(("geometry", 0), build)
+    second = cache.acquire(("geometry", 0), build)
+    assert first is second and len(builds) == 1 and first.references == 2
+
+    cache.release(("geometry", 0))
+    assert ("geometry", 0) in cache.patches
+    cache.release(("geometry", 0))
+    assert not cache.patches
@@ -0,0 +1,58 @@
+import numpy as np
+from pyrr import Matrix44
+
+from orzo.culling import Bounds, cull, frustum_planes, UNBOUNDED
+from orzo.transforms import TransformNode, TransformStore
+
+
+def translation(x, y, z):
+    matrix = np.identity(4)
+    matrix[3, :3] = x, y, z
+    return matrix
+
+
+def test_culling_skips_subtrees_out_of_view():
+
+    # Camera at the origin looking down -z
+    projection = np.array(Matrix44.perspective_projection(60.0, 1.0, 0.1, 100.0, dtype="f4"))
+    planes = frustum_planes(projection, np.identity(4))
+
+    # Two groups of ten children each, one in front of the camera and one behind it
+    store = TransformStore()
+    meshes = []
+    for z in (-10.0, 10.0):
+        group = TransformNode(store, matrix=translation(0, 0, z))
+        for i in range(10):
+            child = TransformNode(store, matrix=translation(2 * i - 9, 0, 0))
+            group.add_child(child)
+            meshes.append(child)
+    widget = TransformNode(store, matrix=translation(0, 0, 50))  # Behind, but without a sphere
+    store.update()
+
+    slots = np.array([node.slot for node in meshes + [widget]])
+    centers = np.zeros((len(slots), 3))
+    radii = np.full(len(slots), 0.5)
+    radii[-1] = UNBOUNDED
+    in_view, tested = cull(store.parents, slots, Bounds(store, slots, centers, radii), planes)
+
+    # Ends of the front row are outside the 60 degree view, everything behind is culled with its group
+    assert in_view[:10].tolist() == [False] * 2 + [True] * 6 + [False] * 2
+    assert not in_view[10:20].any() and in_view[20]
+    assert tested == 3 + 10
+
+
+def test_culling_follows_scale_and_moves():
+
+    projection = np.array(Matrix44.perspective_projection(60.0, 1.0, 0.1, 100.0, dtype="f4"))
+    planes = frustum_planes(projection, np.identity(4))
+    store = TransformStore()
+    node = TransformNode(store, matrix=translation(20, 0, -10))
+    store.update()
+    slots, centers, radii = np.array([node.slot]), np.zeros((1, 3)), np.ones(1)
+    version = store.version
+    assert not cull(store.parents, slots, Bounds(store, slots, centers, radii), planes)[0][0]
+
+    node.matrix = np.diag([20.0, 20.0, 20.0, 1.0]) @ translation(20, 0, -10)  # Big enough to reach the view
+    store.update()
+    assert store.version != version
+    assert cull(store.parents, slots, Bounds(store, slots, centers, radii), planes)[0][0]
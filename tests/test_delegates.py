@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from orzo import geometry
+from orzo.delegates import GeometryDelegate
+
+
+def test_triangulate_strip_keeps_winding():
+
+    triangles = geometry.triangulate(np.arange(5), "TRIANGLE_STRIP")
+    assert triangles.tolist() == [[0, 1, 2], [2, 1, 3], [2, 3, 4]]
+    assert geometry.triangulate(np.arange(5), "TRIANGLE_FAN").tolist() == [[0, 1, 2], [0, 2, 3], [0, 3, 4]]
+    assert geometry.triangulate(np.arange(4), "LINES") is None
+
+
+def test_calculate_normals_skips_degenerate():
+
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [2, 0, 0], [5, 5, 5]], np.float32)
+    triangles = np.array([[0, 1, 2], [0, 1, 3], [1, 1, 2]])
+    normals = geometry.calculate_normals(vertices, triangles)
+
+    assert np.allclose(np.abs(normals[:3, 2]), 1.0)
+    assert not np.isnan(normals).any()
+    assert np.allclose(normals[4], 0.0)  # Unused vertex
+    assert np.allclose(geometry.calculate_normals(vertices, triangles, angle_weighted=True)[:3], normals[:3])
+
+
+def test_calculate_tangents_follow_u():
+
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], np.float32)
+    normals = np.array([[0, 0, 1]] * 3, np.float32)
+    texcoords = np.array([[0, 0], [1, 0], [0, 1]], np.float32)
+    tangents = geometry.calculate_tangents(vertices, normals, texcoords, np.array([[0, 1, 2]]))
+    assert np.allclose(tangents, [[1, 0, 0, 1]] * 3)
+
+
+def test_strided_view_matches_interleaved_layout():
+
+    interleaved = np.arange(24, dtype=np.float32).reshape((4, 6))  # position and normal per vertex
+    data = interleaved.tobytes()
+    normals = geometry.strided_view(data, 12, 4, 24, np.float32, 3)
+    assert np.array_equal(normals, interleaved[:, 3:])
+    assert not normals.flags.c_contiguous
+    assert geometry.packed(normals).flags.c_contiguous
+
+    positions = geometry.strided_view(data, 0, 4, 0, np.float32, 6)
+    assert geometry.packed(positions) is positions  # Tightly packed views aren't copied
+
+
+def test_interleave_packs_records_without_padding():
+
+    positions = np.arange(6, dtype=np.float32).reshape((2, 3))
+    colors = np.array([[255, 0, 0, 255], [0, 255, 0, 255]], np.uint8)
+    records = geometry.interleave([positions, colors])
+    assert records.itemsize == 16
+    assert records.tobytes()[:16] == positions[0].tobytes() + colors[0].tobytes()
+
+
+def test_cluster_vertices_merges_cells():
+
+    # A quad and a thin strip next to it, whose two right vertices fall in the same cell
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0],
+                         [1.9, 0, 0], [1.9, 0.1, 0]], np.float32)
+    triangles = np.array([[0, 1, 2], [1, 3, 2], [1, 4, 3], [4, 5, 3], [0, 1, 2]])
+    simplified = geometry.cluster_vertices(vertices, triangles, 0.5)
+
+    # The strip collapses to one triangle, the duplicate is dropped, and every index is an original vertex
+    assert simplified.tolist() == [[0, 1, 2], [1, 3, 2], [1, 4, 3]]
+
+
+def interleaved_view_format(attributes, vertex_count, buffer_size):
+    """Run GeometryDelegate.interleaved_view_format on attributes from one view of a fake buffer"""
+    view_id = SimpleNamespace(slot=0, gen=0)
+    view = SimpleNamespace(offset=0, buffer_delegate=SimpleNamespace(bytes=bytes(buffer_size)))
+    delegate = SimpleNamespace(client=SimpleNamespace(get_delegate=lambda view_id: view))
+    patch = SimpleNamespace(vertex_count=vertex_count, attributes=[
+        SimpleNamespace(semantic=semantic, view=view_id, offset=offset, stride=stride, format=attr_format)
+        for semantic, offset, stride, attr_format in attributes
+    ])
+    return GeometryDelegate.interleaved_view_format(delegate, patch)
+
+
+def test_interleaved_view_format_uses_records():
+
+    attributes = [("POSITION", 0, 36, "VEC3"), ("NORMAL", 12, 36, "VEC3"),
+                  ("TEXTURE", 24, 36, "VEC2"), ("COLOR", 32, 36, "U8VEC4")]
+    start, size, buffer_format, names = interleaved_view_format(attributes, 10, 360)
+    assert (start, size) == (0, 360)
+    assert buffer_format == "3f 3f 2f 4f1"
+    assert names == ["in_position", "in_normal", "in_texture", "in_color"]
+
+
+def test_interleaved_view_format_rejects_planar_blocks():
+
+    # Tightly packed attributes one block after another, stride 0, can't be read as records
+    count = 100
+    attributes = [("POSITION", 0, 0, "VEC3"), ("NORMAL", 12 * count, 0, "VEC3"),
+                  ("TEXTURE", 24 * count, 0, "VEC2"), ("COLOR", 32 * count, 0, "U8VEC4")]
+    assert interleaved_view_format(attributes, count, 10_000_000) is None
@@ -0,0 +1,49 @@
+import numpy as np
+from pyrr import Matrix44
+
+from orzo.lighting import LIGHT_DTYPE, LightTable, DEFAULT_LIGHT_ROWS, assign_lights, cluster_bounds
+
+
+def light(x):
+    return {"world_position": (x, 0, 0), "color": (1, 1, 1, 1), "ambient": (.1, .1, .1), "type": 0,
+            "info": (1, -1, 0, 0), "direction": (0, 0, -1)}
+
+
+def test_light_table_stays_packed():
+
+    table = LightTable(ctx=None, capacity=2)
+    for i in range(10):
+        table[i] = light(float(i))
+    del table[2]
+    assert len(table) == 9 and 2 not in table
+    assert table[9]["world_position"][0] == 9  # Last light moved into the gap
+
+    rows = table.packed(default_lighting=True)
+    assert rows.dtype == LIGHT_DTYPE and rows.dtype.itemsize == 80
+    assert len(rows) == 11
+    assert np.array_equal(rows[-2].tobytes(), DEFAULT_LIGHT_ROWS[0].tobytes())
+
+
+def test_clusters_cover_every_point_a_light_reaches():
+
+    grid, near, far = (8, 6, 10), 0.1, 100.0
+    projection = np.array(Matrix44.perspective_projection(75.0, 16 / 9, near, far, dtype="f4"))
+    rng = np.random.default_rng(0)
+    centers = rng.uniform([-10, -10, -30], [10, 10, 1], (50, 3))
+    radii = rng.uniform(0.1, 5, 50)
+    radii[0] = np.inf
+    table, indices = assign_lights(*cluster_bounds(centers, radii, projection, near, far, grid), grid)
+
+    # Find the cluster of random points in each light's sphere the way the fragment shader does
+    for light_index, (center, radius) in enumerate(zip(centers, np.where(np.isfinite(radii), radii, 20))):
+        offsets = rng.normal(size=(200, 3))
+        points = center + offsets / np.linalg.norm(offsets, axis=1)[:, None] * radius * rng.random((200, 1))
+        clip = np.column_stack([points, np.ones(200)]) @ projection
+        ndc = clip[:, :3] / clip[:, 3:]
+        depth = -points[:, 2]
+        visible = (np.abs(ndc) <= 1).all(axis=1) & (depth > near) & (depth < far)
+        tile = np.floor((ndc[:, :2] * .5 + .5) * grid[:2]).clip(0, np.array(grid[:2]) - 1).astype(int)
+        depth_slice = np.floor(np.log(depth[visible] / near) * grid[2] / np.log(far / near)).clip(0, grid[2] - 1)
+        for (x, y), z in zip(tile[visible], depth_slice.astype(int)):
+            offset, count = table[z, y, x]
+            assert light_index in indices[offset:offset + count]
@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+
+import moderngl
+import numpy as np
+
+from orzo.picking import pick_matrix, decode_pixel, PickingPass, TriangleBVH, intersect_triangles, quat_transform
+from orzo.programs import FrameSelectProgram
+from orzo.render import StateTracker
+
+
+def test_pick_matrix_centers_pixel():
+
+    width, height = 640, 480
+    x, y = 100.5, 300.5
+    ndc = np.array([2 * x / width - 1, 2 * y / height - 1, 0.0, 1.0])
+
+    narrowed = np.matmul(ndc, pick_matrix(x, y, width, height))
+    assert np.allclose(narrowed[:2], [0.0, 0.0])
+
+    # Neighboring pixel is pushed outside of clip space
+    neighbor = np.array([2 * (x + 1) / width - 1, ndc[1], 0.0, 1.0])
+    assert np.matmul(neighbor, pick_matrix(x, y, width, height))[0] > 1.0
+
+
+def test_decode_pixel():
+
+    pixel = np.array([3, 1, 7, 1], np.uint32).tobytes()
+    assert decode_pixel(pixel) == (3, 1, 7, 1)
+
+
+def test_triangle_bvh_matches_brute_force():
+
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-1, 1, (300, 3)).astype(np.float32)
+    triangles = rng.integers(0, 300, (500, 3))
+    bvh = TriangleBVH(vertices, triangles, leaf_size=4)
+
+    corners = vertices[triangles].astype(np.float64)
+    for _ in range(50):
+        origin = rng.uniform(-2, 2, 3)
+        direction = rng.normal(size=3)
+        expected = intersect_triangles(origin, direction, corners[:, 0], corners[:, 1] - corners[:, 0],
+                                       corners[:, 2] - corners[:, 0]).min()
+        assert np.isclose(bvh.intersect(origin, direction), expected)
+
+
+def test_quat_transform_inverse():
+
+    q = np.array([0.0, 0.0, np.sin(np.pi / 8), np.cos(np.pi / 8)])
+    v = np.array([1.0, 2.0, 3.0])
+    rotated = quat_transform(q, v)
+    assert np.allclose(quat_transform(q * [-1, -1, -1, 1], rotated), v)
+
+
+def test_requested_pick_resolves_a_frame_later():
+
+    pixel = np.array([3, 1, 0, 1], np.uint32).tobytes()
+    ctx = SimpleNamespace(buffer=lambda reserve: SimpleNamespace(read=lambda: pixel),
+                          simple_framebuffer=lambda size, dtype=None: SimpleNamespace(size=size))
+    window = SimpleNamespace(ctx=ctx, wnd=SimpleNamespace(width=64, height=64))
+    picking = PickingPass(window)
+    framebuffer = SimpleNamespace(read_into=lambda *args, **kwargs: None)
+    picking.draw_pick = lambda x, y: (framebuffer, (0, 0, 1, 1))
+
+    results = []
+    picking.request(10, 10, lambda *result: results.append(result))
+    picking.update()  # Same frame, the copy may still be in flight
+    assert results == []
+    picking.update()
+    assert results == [(3, 1, 0, 1)]
+
+
+def test_pick_skips_enables_already_set():
+
+    calls = []
+    framebuffer = SimpleNamespace(size=(64, 64), use=lambda: None, clear=lambda: None, scissor=None)
+    ctx = SimpleNamespace(buffer=lambda reserve: None, simple_framebuffer=lambda size, dtype=None: framebuffer,
+                          fbo=framebuffer, enable_only=lambda flags: calls.append(("enable_only", flags)),
+                          enable=lambda flag: calls.append(("enable", flag)),
+                          disable=lambda flag: calls.append(("disable", flag)))
+    uniform = SimpleNamespace(write=lambda data: None, value=None)
+    registry = SimpleNamespace(get=lambda vertex, fragment: SimpleNamespace(glo=1),
+                               uniforms={("base", "select"): {"m_model": uniform, "id": uniform, "hit_value": uniform}})
+    window = SimpleNamespace(ctx=ctx, wnd=SimpleNamespace(width=64, height=64), program_registry=registry,
+                             gl_state=StateTracker(ctx),
+                             camera=SimpleNamespace(projection=SimpleNamespace(matrix=np.identity(4))))
+    picking = PickingPass(window)
+    program = FrameSelectProgram(window, -1)
+
+    # Two meshes with single sided materials drawn in the pick, neither needs to change any state
+    vao = SimpleNamespace(render=lambda program, instances: calls.append(("render", instances)))
+    meshes = [SimpleNamespace(entity_id=(i, 0), name=f"Mesh {i}", vao=vao, mesh_program=None,
+                              material=SimpleNamespace(double_sided=False)) for i in range(2)]
+    picking.draw_scene = lambda projection: [program.draw(mesh, model_matrix=np.identity(4)) for mesh in meshes]
+    window.gl_state.begin_frame()
+    picking.draw_pick(10, 10)
+
+    assert calls == [("enable_only", moderngl.DEPTH_TEST | moderngl.CULL_FACE), ("render", 1), ("render", 1)]
+    assert window.gl_state.skipped["enable"] == 4
@@ -0,0 +1,25 @@
+
+from types import SimpleNamespace
+
+from orzo.cache import GeometryCache
+from orzo.pipeline import DecodePipeline
+from orzo.scheduler import CallbackScheduler
+
+
+def test_decode_pipeline_shares_decodes_and_skips_cancelled():
+
+    window = SimpleNamespace(geometry_cache=GeometryCache(), callback_scheduler=CallbackScheduler())
+    decodes = []
+    geometry = SimpleNamespace(id=(0, 0), patches=[None], decode=lambda wnd: decodes.append(1) or ["patch"])
+    decode_pipeline = DecodePipeline(window)
+
+    results = []
+    decode_pipeline.load(geometry, results.append)
+    cancelled = decode_pipeline.load(geometry, results.append)
+    cancelled.cancel()
+    assert not results  # Callbacks only run from the scheduler on the render thread
+
+    decode_pipeline.finish()
+    window.callback_scheduler.run(window)
+    assert results == [["patch"]] and len(decodes) == 1
+    decode_pipeline.shutdown()
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from orzo.registry import NodeList, SceneRegistry
+from orzo.transforms import TransformNode, TransformStore
+
+
+def test_node_list_behaves_like_a_list():
+
+    items = NodeList(["a", "b", "c"])
+    items.remove("b")
+    items.append("d")
+    assert list(items) == ["a", "c", "d"]
+    assert items[1] == "c" and items[-1] == "d"
+    assert "b" not in items and len(items) == 3
+    with pytest.raises(ValueError):
+        items.remove("b")
+
+
+def test_registry_indexes_names_and_entities():
+
+    store = TransformStore()
+    registry = SceneRegistry()
+    widgets = TransformNode(store, "Widgets", matrix=np.identity(4))
+    entity = TransformNode(store, "Entity", matrix=np.identity(4))
+    registry.add(widgets)
+    registry.add(entity, entity_id=(0, 0))
+    assert registry.find("Widgets") is widgets
+    assert registry.entity_node((0, 0)) is entity
+
+    registry.remove(entity)
+    registry.remove(widgets)
+    assert registry.find("Widgets") is None
+    assert registry.entity_node((0, 0)) is None
+    assert not registry.nodes
@@ -1,8 +1,163 @@
+from types import SimpleNamespace
 
-from .servers import base_server
-from orzo.delegates import *
+import numpy as np
+
+from orzo.programs import PhongProgram
+from orzo.render import Batch, DrawList, StateTracker
+from orzo.transforms import TransformNode, TransformStore
+
+
+class FakeProgram(object):
+
+    def __init__(self, glo, drawn):
+        self.program = SimpleNamespace(glo=glo)
+        self.drawn = drawn
+
+    def draw(self, mesh, projection_matrix=None, model_matrix=None, camera_matrix=None, time=0):
+        self.drawn.append((mesh.name, model_matrix[3, 0]))
 
 
 def test_get_world_transform():
 
-    pass
+    # A node's world transform is its local matrix followed by every parent's, row vector style
+    store = TransformStore()
+    parent_matrix = np.diag([2.0, 2.0, 2.0, 1.0])
+    parent_matrix[3, :3] = 1.0, 0.0, 0.0
+    child_matrix = np.identity(4)
+    child_matrix[3, :3] = 0.0, 3.0, 0.0
+    parent = TransformNode(store, "Parent", matrix=parent_matrix)
+    child = TransformNode(store, "Child", matrix=child_matrix)
+    parent.add_child(child)
+    store.update()
+
+    assert np.allclose(child.matrix_global, child_matrix @ parent_matrix)
+    assert np.allclose(store.world[child.slot][3, :3], [1.0, 6.0, 0.0])
+
+    # Moving the parent carries the child along
+    parent.matrix = np.identity(4)
+    store.update()
+    assert np.allclose(child.matrix_global, child_matrix)
+
+
+def test_draw_list_flattens_scene_by_program():
+
+    drawn = []
+    base, instanced = FakeProgram(1, drawn), FakeProgram(2, drawn)
+    store = TransformStore()
+    root = TransformNode(store, "Root", matrix=np.identity(4))
+    for name, program, x in [("a", instanced, 1.0), ("b", base, 2.0), ("c", None, 3.0), ("d", base, 4.0)]:
+        matrix = np.identity(4)
+        matrix[3, 0] = x
+        mesh = SimpleNamespace(name=name, mesh_program=program, material=None, ghosting=False)
+        node = TransformNode(store, name, mesh=mesh, matrix=matrix)
+        (root.children[-1] if name == "d" else root).add_child(node)  # d is nested under c
+
+    window = SimpleNamespace(scene=SimpleNamespace(root_nodes=[root]), transform_store=store)
+    draw_list = DrawList(window)
+    draw_list.sort, draw_list.cull = False, False
+    store.update()
+    draw_list.draw(None, None)
+    assert drawn == [("b", 2.0), ("d", 7.0), ("a", 1.0)]
+
+    draw_list.draw(None, None)
+    assert draw_list.builds == 1
+
+
+def test_draw_list_sorts_by_state_and_draws_ghosts_last():
+
+    drawn = []
+    program = FakeProgram(1, drawn)
+    textured = SimpleNamespace(mat_texture=SimpleNamespace(texture=SimpleNamespace(glo=5)), double_sided=False)
+    plain = SimpleNamespace(mat_texture=None, double_sided=False)
+    store = TransformStore()
+    root = TransformNode(store, "Root", matrix=np.identity(4))
+    for name, material, z, ghosting in [("a", textured, -1.0, False), ("b", plain, -2.0, True),
+                                        ("c", plain, -1.0, False), ("d", textured, -5.0, True)]:
+        matrix = np.identity(4)
+        matrix[3, 2] = z
+        mesh = SimpleNamespace(name=name, mesh_program=program, material=material, ghosting=ghosting)
+        root.add_child(TransformNode(store, name, mesh=mesh, matrix=matrix))
+
+    window = SimpleNamespace(scene=SimpleNamespace(root_nodes=[root]), transform_store=store)
+    draw_list = DrawList(window)
+    draw_list.cull = False
+    store.update()
+    draw_list.draw(None, np.identity(4))
+    assert [name for name, _ in drawn] == ["c", "a", "d", "b"]  # Untextured first, then ghosts farthest first
+    assert draw_list.translucent == 2
+
+
+def test_state_tracker_skips_redundant_calls():
+
+    calls = []
+    ctx = SimpleNamespace(enable=lambda flag: calls.append(("enable", flag)),
+                          disable=lambda flag: calls.append(("disable", flag)),
+                          enable_only=lambda flags: calls.append(("enable_only", flags)))
+    texture = SimpleNamespace(glo=7, use=lambda location=0: calls.append(("texture", location)))
+    state = StateTracker(ctx)
+
+    state.enable_only(1 | 2)
+    state.enable(2)
+    state.disable(4)
+    state.disable(2)
+    state.disable(2)
+    state.texture(texture)
+    state.texture(texture)
+    state.texture(texture, location=1)
+    assert calls == [("enable_only", 3), ("disable", 2), ("texture", 0), ("texture", 1)]
+    assert state.issued == {"enable": 2, "texture": 2}
+    assert state.skipped == {"enable": 3, "texture": 1}
+
+    # A new frame forgets the state since something else may have changed it
+    state.begin_frame()
+    state.enable(2)
+    assert calls[-1] == ("enable", 2)
+    assert state.last_frame[0]["enable"] == 2 and state.issued == {"enable": 1}
+
+
+def test_batch_only_writes_moved_rows():
+
+    writes = []
+    buffer = SimpleNamespace(write=lambda data, offset=0: writes.append((offset, len(bytes(data)))))
+    ctx = SimpleNamespace(buffer=lambda reserve: buffer)
+    vao = SimpleNamespace(buffer=lambda *args: None)
+    mesh = SimpleNamespace(resources=SimpleNamespace(instanced_vao=lambda: vao))
+    records = [SimpleNamespace(mesh=mesh, program=None) for _ in range(6)]
+    batch = Batch(ctx, records, np.arange(6))
+
+    matrices = np.tile(np.identity(4, np.float32), (6, 1, 1))
+    batch.update(np.arange(6), matrices)
+    assert writes == [(0, 6 * 64)] and batch.count == 6
+
+    # Same members with one moved only writes its row, different members rewrite the buffer
+    moved = matrices.copy()
+    moved[4, 3, 0] = 2.0
+    batch.update(np.arange(6), moved)
+    assert writes[-1] == (4 * 64, 64)
+    batch.update(np.arange(3), moved[:3])
+    assert writes[-1] == (0, 3 * 64) and batch.count == 3
+
+
+def test_instanced_mesh_ignores_levels_without_culling():
+
+    rendered = []
+    uniform = SimpleNamespace(write=lambda data: None, value=None)
+    uniforms = {name: uniform for name in ["m_model", "ghosting", "attention", "material_color", "double_sided"]}
+    registry = SimpleNamespace(get=lambda vertex, fragment: SimpleNamespace(glo=vertex),
+                               uniforms={("instance", "phong"): uniforms}, bounding_sphere_program=None,
+                               default_texture=SimpleNamespace(glo=1, use=lambda location=0: None))
+    ctx = SimpleNamespace(enable=lambda flag: None, disable=lambda flag: None)
+    window = SimpleNamespace(program_registry=registry, draw_bs=False, selected_entity=None,
+                             gl_state=StateTracker(ctx), draw_list=SimpleNamespace(cull=False, lod=True),
+                             frame_state=SimpleNamespace(camera_position=np.array([0.0, 0.0, 1000.0]),
+                                                         focal_pixels=100.0))
+    program = PhongProgram(window, num_instances=10)
+
+    # Far enough away for the coarsest level, which has no instance buffer to draw with
+    level = SimpleNamespace(error=0.01, vao=SimpleNamespace(render=lambda *args, **kwargs: rendered.append("level")))
+    vao = SimpleNamespace(render=lambda program, instances: rendered.append(instances))
+    mesh = SimpleNamespace(vao=vao, lods=[level], local_sphere=((0.0, 0.0, 0.0), 1.0), instance_culler=object(),
+                           ghosting=False, has_bounding_sphere=False, entity_id=None,
+                           material=SimpleNamespace(color=(1, 1, 1, 1), double_sided=False, mat_texture=None))
+    program.draw(mesh, model_matrix=np.identity(4))
+    assert rendered == [10]
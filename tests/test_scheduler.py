@@ -0,0 +1,71 @@
+
+from orzo.scheduler import CallbackScheduler
+
+
+class FakeDelegate(object):
+
+    def __init__(self, name, ran):
+        self.name = name
+        self.ran = ran
+
+    def set_up_node(self, window):
+        self.ran.append((self.name, "set_up_node"))
+
+    def set_up_texture(self, window):
+        self.ran.append((self.name, "set_up_texture"))
+
+    def remove_from_render(self, window):
+        self.ran.append((self.name, "remove_from_render"))
+
+    def update_matrices(self, window):
+        self.ran.append((self.name, "update_matrices"))
+
+    def render_entity(self, window):
+        self.ran.append((self.name, "render_entity"))
+
+
+def test_scheduler_orders_by_priority_but_keeps_delegate_order():
+
+    ran = []
+    texture, entity = FakeDelegate("texture", ran), FakeDelegate("entity", ran)
+    scheduler = CallbackScheduler()
+    scheduler.add(texture.set_up_texture)
+    scheduler.add(entity.set_up_node)
+    scheduler.add(entity.set_up_texture)
+    scheduler.add(entity.remove_from_render)  # Can't jump ahead of its own texture set up
+    scheduler.run(None)
+
+    assert ran == [("entity", "set_up_node"), ("entity", "set_up_texture"), ("entity", "remove_from_render"),
+                   ("texture", "set_up_texture")]
+    assert scheduler.pending == 0 and scheduler.processed == 4
+
+
+def test_scheduler_carries_work_over_budget():
+
+    ran = []
+    scheduler = CallbackScheduler(budget=0.0)
+    for i in range(3):
+        scheduler.add(FakeDelegate(i, ran).set_up_node)
+    scheduler.run(None)
+    assert len(ran) == 1 and scheduler.pending == 2
+
+
+def test_scheduler_coalesces_redundant_callbacks():
+
+    ran = []
+    first, second = FakeDelegate("first", ran), FakeDelegate("second", ran)
+    scheduler = CallbackScheduler()
+    for _ in range(3):
+        scheduler.add(first.update_matrices)
+        scheduler.add(second.update_matrices)
+    scheduler.add(first.render_entity)
+    scheduler.add(first.render_entity)  # Superseded rebuild
+    scheduler.add(second.render_entity)
+    scheduler.add(second.remove_from_render)
+    scheduler.add(second.render_entity)  # Has to run again after the removal
+    scheduler.run(None)
+
+    assert ran.count(("first", "update_matrices")) + ran.count(("second", "update_matrices")) == 1
+    assert ran.count(("first", "render_entity")) == 1
+    assert ran.count(("second", "render_entity")) == 2
+    assert scheduler.dropped == 6
@@ -0,0 +1,62 @@
+from functools import partial
+
+import numpy as np
+import moderngl_window as mglw
+
+from orzo.transforms import TransformNode, TransformStore
+
+
+def build(node_class):
+    root = node_class("Root", matrix=np.identity(4, np.float32))
+    middle = node_class("Middle", matrix=np.diag([2.0, 2.0, 2.0, 1.0]).astype(np.float32))
+    leaf = node_class("Leaf", matrix=np.identity(4, np.float32))
+    empty = node_class("Empty")
+    leaf.matrix[3, :3] = [1.0, 2.0, 3.0]
+    root.add_child(middle)
+    middle.add_child(leaf)
+    middle.add_child(empty)
+    return root, middle, leaf
+
+
+def test_dirty_updates_match_full_updates():
+
+    store = TransformStore(capacity=2)
+    expected_root, expected_middle, expected_leaf = build(mglw.scene.Node)
+    root, middle, leaf = build(partial(TransformNode, store))
+    expected_root.calc_model_mat(np.identity(4))
+    assert np.array_equal(leaf.matrix_global, expected_leaf.matrix_global)  # Read before any update
+    assert store.update()
+    assert not store.update()
+
+    # Moving the middle node only dirties its subtree
+    moved = np.identity(4, np.float32)
+    moved[3, :3] = [5.0, 0.0, 0.0]
+    expected_middle.matrix = moved
+    middle.matrix = moved
+    assert middle.dirty and not (root.dirty or leaf.dirty)
+    expected_root.calc_model_mat(np.identity(4))
+    store.update()
+
+    assert np.array_equal(leaf.matrix_global, expected_leaf.matrix_global)
+    assert np.array_equal(middle.children[1].matrix_global, expected_middle.children[1].matrix_global)
+    assert not (leaf.dirty or middle.dirty or root.dirty)
+
+    # Directly set globals stick until the node is dirtied again
+    preview = np.diag([3.0, 3.0, 3.0, 1.0]).astype(np.float32)
+    leaf.matrix_global = preview
+    store.update()
+    assert np.array_equal(leaf.matrix_global, preview)
+
+
+def test_removed_nodes_give_back_slots():
+
+    store = TransformStore()
+    root = TransformNode(store, "Root", matrix=np.identity(4))
+    child = TransformNode(store, "Child", matrix=np.identity(4))
+    root.add_child(child)
+    root.remove_child(child)
+    assert len(store) == 2
+
+    del child
+    store.update()
+    assert len(store) == 1